@@ -0,0 +1,379 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Request instrumentation. Records wall time, database queries, template
+rendering time and cache hits per view, exposes them as Prometheus metrics
+and logs requests over budget with their slowest queries.
+Metrics are kept per process, in memory.
+"""
+import heapq
+import logging
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template import engines
+from django.utils.crypto import constant_time_compare
+
+# Upper bounds in seconds of the buckets of duration histograms
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+_MISS = object()
+
+
+class Histogram:
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        """
+        :return: exposition lines of the histogram, cumulative as
+        Prometheus expects them
+        """
+        cumulative = 0
+        lines = []
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(_line(
+                name + "_bucket", dict(labels, le=repr(float(bound))),
+                cumulative
+            ))
+        lines.append(_line(name + "_bucket", dict(labels, le="+Inf"), self.count))
+        lines.append(_line(name + "_sum", labels, self.sum))
+        lines.append(_line(name + "_count", labels, self.count))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _line(name, labels, value):
+    if labels:
+        name += "{" + ",".join(
+            '{}="{}"'.format(k, _escape(v)) for k, v in sorted(labels.items())
+        ) + "}"
+    return "{} {}".format(name, value)
+
+
+def exposition(metrics):
+    """
+    :param metrics: list of (name, type, help, samples) where samples are
+    (labels, value) tuples, values of histograms being Histograms
+    :return: the metrics in the Prometheus text format
+    """
+    lines = []
+    for name, kind, help_text, samples in metrics:
+        lines.append("# HELP {} {}".format(name, help_text))
+        lines.append("# TYPE {} {}".format(name, kind))
+        for labels, value in samples:
+            if kind == "histogram":
+                lines.extend(value.lines(name, labels))
+            else:
+                lines.append(_line(name, labels, value))
+    return "\n".join(lines) + "\n"
+
+
+class RequestStats:
+    """
+    What happened during a single request.
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.query_time = 0.0
+        self.slowest = []
+        self.template_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Whether get_many() of the cache is running
+        self.in_get_many = False
+
+    def record_query(self, sql, duration):
+        self.queries += 1
+        self.query_time += duration
+        entry = (duration, self.queries, sql)
+        if len(self.slowest) < settings.INSTRUMENTATION_SLOW_QUERIES:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heappushpop(self.slowest, entry)
+
+
+class ViewMetrics:
+    def __init__(self):
+        self.duration = Histogram()
+        self.requests = defaultdict(int)
+        self.queries = 0
+        self.query_time = 0.0
+        self.template_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = defaultdict(ViewMetrics)
+        # Functions returning further metrics, see exposition()
+        self.collectors = []
+
+    def record(self, view, method, status, duration, stats):
+        with self.lock:
+            metrics = self.views[view]
+            metrics.duration.observe(duration)
+            metrics.requests[(method, status)] += 1
+            metrics.queries += stats.queries
+            metrics.query_time += stats.query_time
+            metrics.template_time += stats.template_time
+            metrics.cache_hits += stats.cache_hits
+            metrics.cache_misses += stats.cache_misses
+
+    def collect(self):
+        with self.lock:
+            views = sorted(self.views.items())
+            metrics = [
+                ("berlyne_requests_total", "counter",
+                 "Requests by view, method and status",
+                 [({'view': view, 'method': method, 'status': status}, count)
+                  for view, m in views
+                  for (method, status), count in sorted(m.requests.items())]),
+                ("berlyne_request_duration_seconds", "histogram",
+                 "Wall time of requests by view",
+                 [({'view': view}, m.duration) for view, m in views]),
+            ]
+            for name, help_text, attr in [
+                ("berlyne_db_queries_total", "Database queries by view",
+                 'queries'),
+                ("berlyne_db_query_seconds_total",
+                 "Time spent in database queries by view", 'query_time'),
+                ("berlyne_template_render_seconds_total",
+                 "Time spent rendering templates by view", 'template_time'),
+                ("berlyne_cache_hits_total", "Cache hits by view",
+                 'cache_hits'),
+                ("berlyne_cache_misses_total", "Cache misses by view",
+                 'cache_misses'),
+            ]:
+                metrics.append((name, "counter", help_text, [
+                    ({'view': view}, getattr(m, attr)) for view, m in views
+                ]))
+            text = exposition(metrics)
+        for collector in self.collectors:
+            text += exposition(collector())
+        return text
+
+
+registry = Registry()
+
+
+def register_collector(collector):
+    """
+    Adds metrics of other parts to the metrics endpoint.
+    :param collector: function returning metrics as taken by exposition()
+    """
+    if collector not in registry.collectors:
+        registry.collectors.append(collector)
+
+
+def _current():
+    return getattr(_local, 'stats', None)
+
+
+def _timed(template):
+    """
+    Adds the rendering time of a template to the current request.
+    """
+    render = template.render
+
+    @wraps(render)
+    def timed_render(*args, **kwargs):
+        stats = _current()
+        if stats is None:
+            return render(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return render(*args, **kwargs)
+        finally:
+            stats.template_time += time.perf_counter() - start
+    template.render = timed_render
+    return template
+
+
+def _instrument_templates(engine):
+    """
+    Times the templates an engine returns. Included and extended
+    templates are rendered within them.
+    """
+    if getattr(engine, 'instrumented', False):
+        return
+    get_template, from_string = engine.get_template, engine.from_string
+    engine.get_template = wraps(get_template)(
+        lambda *args, **kwargs: _timed(get_template(*args, **kwargs))
+    )
+    engine.from_string = wraps(from_string)(
+        lambda *args, **kwargs: _timed(from_string(*args, **kwargs))
+    )
+    engine.instrumented = True
+
+
+def _instrument_cache(cache):
+    """
+    Counts hits and misses of get() and get_many() of a cache backend.
+    Backends without an own get_many() call get() for every key, these
+    calls are not counted again.
+    """
+    if getattr(cache, 'instrumented', False):
+        return
+    get, get_many = cache.get, cache.get_many
+
+    @wraps(get)
+    def counted_get(key, default=None, version=None):
+        value = get(key, _MISS, version)
+        stats = _current()
+        if stats is not None and not stats.in_get_many:
+            if value is _MISS:
+                stats.cache_misses += 1
+            else:
+                stats.cache_hits += 1
+        return default if value is _MISS else value
+
+    @wraps(get_many)
+    def counted_get_many(keys, version=None):
+        stats = _current()
+        if stats is None or stats.in_get_many:
+            return get_many(keys, version)
+        keys = list(keys)
+        stats.in_get_many = True
+        try:
+            found = get_many(keys, version)
+        finally:
+            stats.in_get_many = False
+        stats.cache_hits += len(found)
+        stats.cache_misses += len(keys) - len(found)
+        return found
+
+    cache.get, cache.get_many = counted_get, counted_get_many
+    cache.instrumented = True
+
+
+class InstrumentationMiddleware:
+    def __init__(self, get_response):
+        if not settings.INSTRUMENTATION_ENABLED:
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        # Backends are created per thread and may change, e.g. in tests,
+        # instrumenting them is a no-op once done
+        for engine in engines.all():
+            _instrument_templates(engine)
+        _instrument_cache(caches['default'])
+        stats = _local.stats = RequestStats()
+
+        def record_query(execute, sql, params, many, context):
+            start = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                stats.record_query(sql, time.perf_counter() - start)
+
+        try:
+            with _wrap_connections(record_query):
+                response = self.get_response(request)
+        finally:
+            _local.stats = None
+        duration = time.perf_counter() - stats.start
+
+        match = request.resolver_match
+        view = (match.view_name if match else None) or "unresolved"
+        registry.record(view, request.method, response.status_code,
+                        duration, stats)
+        self._check_budget(request, view, duration, stats)
+        return response
+
+    @staticmethod
+    def _check_budget(request, view, duration, stats):
+        time_budget, query_budget = settings.INSTRUMENTATION_VIEW_BUDGETS.get(
+            view,
+            (settings.INSTRUMENTATION_TIME_BUDGET,
+             settings.INSTRUMENTATION_QUERY_BUDGET)
+        )
+        if duration <= time_budget and stats.queries <= query_budget:
+            return
+        logger.warning(
+            "%s %s (%s) over budget: %.3fs, %d queries in %.3fs, "
+            "templates %.3fs, slowest queries:\n%s",
+            request.method, request.path, view, duration, stats.queries,
+            stats.query_time, stats.template_time,
+            "\n".join(
+                "  {:.3f}s {}".format(d, sql)
+                for d, _, sql in sorted(stats.slowest, reverse=True)
+            )
+        )
+
+
+class _wrap_connections:
+    """
+    Installs an execute wrapper on all database connections
+    of the current thread.
+    """
+    def __init__(self, wrapper):
+        self.contexts = [
+            connections[alias].execute_wrapper(wrapper)
+            for alias in connections
+        ]
+
+    def __enter__(self):
+        for context in self.contexts:
+            context.__enter__()
+
+    def __exit__(self, *exc_info):
+        for context in reversed(self.contexts):
+            context.__exit__(*exc_info)
+
+
+def metrics(request):
+    """
+    The metrics in the Prometheus text format, for superusers or
+    requests with settings.METRICS_TOKEN as bearer token.
+    """
+    token = settings.METRICS_TOKEN
+    auth = request.META.get('HTTP_AUTHORIZATION', '')
+    if not request.user.is_superuser and not (
+            token and constant_time_compare(auth, "Bearer " + token)
+    ):
+        return HttpResponseForbidden()
+    return HttpResponse(registry.collect(), content_type=CONTENT_TYPE)
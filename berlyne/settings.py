@@ -69,6 +69,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so it measures the time of all other middleware as well
+    'berlyne.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -80,6 +82,23 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'berlyne.urls'
 
+# Instrumentation of requests, see berlyne/instrumentation.py.
+# Requests taking longer than INSTRUMENTATION_TIME_BUDGET seconds or
+# more than INSTRUMENTATION_QUERY_BUDGET queries are logged with their
+# INSTRUMENTATION_SLOW_QUERIES slowest queries
+INSTRUMENTATION_ENABLED = True
+INSTRUMENTATION_TIME_BUDGET = 0.5
+INSTRUMENTATION_QUERY_BUDGET = 50
+INSTRUMENTATION_SLOW_QUERIES = 5
+# Budgets of single views, by URL name: (seconds, queries)
+INSTRUMENTATION_VIEW_BUDGETS = {
+    'wui_course_problems': (0.3, 20),
+    'wui_course_scoreboard': (0.3, 10),
+}
+# Token Prometheus can use to scrape /metrics/ as bearer token,
+# superusers can always see the metrics
+METRICS_TOKEN = os.getenv('BERLYNE_METRICS_TOKEN', '')
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -113,6 +132,47 @@ DATABASES = {
     }
 }
 
+# The cache has to be shared by the web and the autotask workers,
+# use memcached or similar when they run on different hosts
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': '/tmp/berlyne_cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    }
+}
+
+# Time in seconds the flag digests of a course are cached, they are
+# dropped whenever a problem or the problems of a course change
+FLAGS_CACHE_TTL = 60 * 60 * 24
+
+# Time in seconds the rendered course list is cached, it is rendered
+# again when a course or a teacher changes
+COURSES_CACHE_TTL = 60 * 60 * 24
+
+# Flag submissions per second and problem a user gets, and the
+# number of submissions that can be made at once. The limits are only
+# exact with a cache with atomic add() and incr(), e.g. memcached
+SUBMISSION_RATE = 1 / 6
+SUBMISSION_BURST = 5
+# Seconds submitted flags are remembered to answer repeated ones
+SUBMISSION_SEEN_TTL = 60 * 60
+# Wrong submissions are written once this many are pending or the
+# oldest one waited this many seconds
+SUBMISSION_BATCH_SIZE = 50
+SUBMISSION_BATCH_DELAY = 2
+# Where pending wrong submissions are kept until they are written
+SUBMISSION_SPOOL_PATH = os.path.join(BASE_DIR, 'submission_spool')
+
+# Live updates of courses, they are kept in the cache, see wui/live.py
+# Seconds between the polls of browsers
+LIVE_RETRY = 5
+# Events sent per poll at most, clients further behind skip older ones
+LIVE_QUEUE_LEN = 100
+# Seconds events are kept for polling browsers
+LIVE_EVENT_TTL = 60
 
 # Password validation
 # https://docs.djangoproject.com/en/1.10/ref/settings/#auth-password-validators
@@ -173,10 +233,43 @@ DEFAULT_UNUSED_ACTION = "stop"
 # this has to be the opposite of DEFAULT_UNUSED_ACTION
 DEFAULT_USED_ACTION = "start"
 
+# Number of VM actions a fleet operation (e.g. starting all VMs of
+# a course) runs at the same time per provider. Providers not listed
+# use FLEET_DEFAULT_CONCURRENCY
+FLEET_PROVIDER_CONCURRENCY = {
+    "virtualbox": 2,
+    "docker": 8,
+    "digital_ocean": 4,
+}
+FLEET_DEFAULT_CONCURRENCY = 2
+
+# VMs of problems marked "keep warm" are kept booted and suspended
+# while no course uses them, so they only need a resume when a course
+# adds them. This is the maximum number of VMs kept that way
+WARM_POOL_SIZE = 10
+# Interval in seconds in which VMs of the warm pool that were stopped
+# or not created yet are booted and suspended again
+WARM_POOL_REFILL_INTERVAL = 60 * 10
+
 # autotask
 AUTOTASK_IS_ACTIVE = "runserver" in sys.argv or "run_autotask" in sys.argv
 # Time the VMs tasks should be stored in the DB
 TASK_TTL = 60 * 60 * 24
+# Interval in seconds in which the states of all VMs are refreshed
+STATE_SWEEP_INTERVAL = 60 * 5
+# Time in seconds a state sweep may take per provider backend
+STATE_SWEEP_TIMEOUT = 60
+# Interval in seconds in which the state and task history of VMs is
+# compacted and entries older than the retention times are deleted
+HISTORY_COMPACT_INTERVAL = 60 * 60 * 24
+# Time in seconds states are kept after they were last seen,
+# the current state of a VM is always kept
+STATE_RETENTION = 60 * 60 * 24 * 90
+# Time in seconds finished tasks of VMs are kept
+TASK_RETENTION = 60 * 60 * 24 * 14
+# Time in seconds of the timing spans of tasks that are included in
+# the task metrics and the task dashboard
+TASK_METRICS_WINDOW = 60 * 60 * 24
 
 # uptomate
 # Define where the problem folder is
@@ -185,4 +278,60 @@ VAGR_DEPLOYMENT_PATH = os.path.join(BASE_DIR, 'problems')
 VAGR_VAGRANT_PATH = os.path.join(BASE_DIR, 'vagrantfiles')
 # Define the default vagrant file name
 VAGR_DEFAULT_VAGR_FILE = 'ubuntu_docker'
+# Where the deployments of per user instances of problems are created
+VAGR_INSTANCE_PATH = os.path.join(BASE_DIR, 'instances')
+# Take a snapshot of VMs after they were installed, so they can be reset
+# to it with the "reset" action, see vmmanage/snapshots.py
+SNAPSHOT_AFTER_INSTALL = True
+# Time in seconds taking or restoring a snapshot may take
+SNAPSHOT_TIMEOUT = 60 * 5
+# Interval in seconds in which VMs of problems with a reset interval
+# are checked for being due for a reset
+SNAPSHOT_RESET_CHECK_INTERVAL = 60
+# Maximum number of per user instances that run at the same time,
+# further instances are queued until others stop
+INSTANCE_CAPACITY = 20
+# Time in seconds after which an unused instance is reaped with
+# INSTANCE_IDLE_ACTION, either "stop" or "destroy"
+INSTANCE_IDLE_TIMEOUT = 60 * 60
+INSTANCE_IDLE_ACTION = "stop"
+# Interval in seconds in which idle instances are reaped and
+# queued ones are spun up
+INSTANCE_REAP_INTERVAL = 60 * 5
+# Time in seconds after which the index of installable problems
+# is checked for changed config files
+CATALOGUE_MAX_AGE = 60
+# How downloads are sent: 'direct' by Django, or by the front-end
+# server with 'x-accel-redirect' (nginx) or 'x-sendfile'
+DOWNLOAD_BACKEND = 'direct'
+# For x-accel-redirect: the internal location of nginx that serves
+# DOWNLOAD_ACCEL_ROOT
+DOWNLOAD_ACCEL_ROOT = VAGR_DEPLOYMENT_PATH
+DOWNLOAD_ACCEL_PREFIX = '/protected-downloads/'
+# Where compressed copies of downloads are kept. Files smaller than
+# DOWNLOAD_GZIP_MIN_SIZE bytes are not compressed, copies larger than
+# DOWNLOAD_GZIP_MAX_RATIO of the original are not used. With
+# x-accel-redirect copies are only sent if they are below
+# DOWNLOAD_ACCEL_ROOT, otherwise the original files are
+DOWNLOAD_GZIP_PATH = os.path.join(BASE_DIR, 'compressed_downloads')
+DOWNLOAD_GZIP_MIN_SIZE = 1024 * 16
+DOWNLOAD_GZIP_MAX_RATIO = 0.9
+# Time in seconds parsed problem configs are cached, changed
+# config files are read again regardless
+PROBLEM_CONFIG_CACHE_TTL = 60 * 60 * 24
+# Time in seconds rendered problem descriptions are cached, they
+# are rendered again when the problem or the address of its VM changes
+DESC_CACHE_TTL = 60 * 60
+# Provider the VMs of a vagrant file run on
+VAGR_FILE_PROVIDERS = {
+    'ubuntu_docker': 'docker',
+    'ubuntu_virtualbox': 'virtualbox',
+    'ubuntu_digital_ocean': 'digital_ocean',
+}
+
+# Host ports that get assigned to VMs, per provider. Providers
+# not listed use the "default" range. Ranges must not overlap.
+PORT_RANGES = {
+    'default': (1025, 2**16 - 1),
+}
 
@@ -16,8 +16,11 @@ Including another URLconf
 from django.conf.urls import url, include
 from django.contrib import admin
 
+from berlyne import instrumentation
+
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
+    url(r'^metrics/$', instrumentation.metrics, name='metrics'),
     url('^', include('wui.urls')),
     url(r'^vm/', include('vmmanage.urls'))
 ]
@@ -0,0 +1,48 @@
+/*
+ * Live updates of a course, the events are sent by wui.views.course_live
+ */
+(function ($) {
+    var feed = $('#live-feed');
+    if (!feed.length || !window.EventSource) {
+        return;
+    }
+    var source = new EventSource(feed.data('live-url'));
+
+    source.addEventListener('solve', function (e) {
+        var solve = JSON.parse(e.data);
+        var text = (solve.first_blood ? feed.data('first-blood') : feed.data('solved')) +
+            ': ' + solve.title + ' [' + solve.points + ']';
+        if (solve.user) {
+            text += ' - ' + solve.user;
+        }
+        var item = $('<li>').text(text);
+        if (solve.first_blood) {
+            item.addClass('text-danger');
+        }
+        feed.prepend(item);
+    });
+
+    source.addEventListener('scoreboard', function (e) {
+        var board = $('#live-scoreboard');
+        if (!board.length) {
+            return;
+        }
+        var threshold = board.data('threshold');
+        var crown = board.find('.live-crown').detach();
+        var entries = board.children('.live-entry').detach();
+        $.each(JSON.parse(e.data), function (i, score) {
+            var entry = entries.filter(function () {
+                return $(this).attr('data-username') === score.username;
+            });
+            if (!entry.length) {
+                // Joined after the page was loaded
+                return;
+            }
+            entry.find('.live-place').text(i + 1);
+            entry.find('.live-points').text(score.points)
+                .css('color', score.points >= threshold ? 'green' : 'red');
+            board.append(entry);
+        });
+        board.children('.live-entry').first().find('.live-place').after(crown);
+    });
+})(jQuery);
@@ -0,0 +1,20 @@
+/*
+ * Submits flags to wui.views.course_submit, so the problem page
+ * is only loaded again once a flag was correct
+ */
+(function ($) {
+    $('form.flag-form').submit(function (e) {
+        var form = $(this);
+        var result = form.find('.flag-result');
+        e.preventDefault();
+        $.post(form.data('submit-url'), form.serialize()).always(function (data, status, xhr) {
+            var answer = data.responseJSON || data;
+            result.text(answer.message || '')
+                .toggleClass('text-success', answer.status === 'correct')
+                .toggleClass('text-danger', answer.status !== 'correct');
+            if (answer.status === 'correct') {
+                window.location = answer.writeup || window.location.pathname;
+            }
+        });
+    });
+})(jQuery);
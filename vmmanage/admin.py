@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from django.contrib import admin
 
+from . import signals
 from .models import *
 
 admin.site.register(VirtualMachine)
@@ -23,4 +24,9 @@ admin.site.register(Task)
 admin.site.register(Port)
 admin.site.register(State)
 admin.site.register(Tag)
-admin.site.register(Download)
\ No newline at end of file
+admin.site.register(Download)
+admin.site.register(ParkedAction)
+admin.site.register(FleetOperation)
+admin.site.register(FleetResult)
+admin.site.register(PortPool)
+admin.site.register(CatalogueEntry)
\ No newline at end of file
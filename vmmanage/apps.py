@@ -18,4 +18,9 @@ from django.apps import AppConfig
 
 class VmapiConfig(AppConfig):
     name = 'vmmanage'
-    verbose_name = "VM management"
\ No newline at end of file
+    verbose_name = "VM management"
+
+    def ready(self):
+        from berlyne import instrumentation
+        from . import metrics
+        instrumentation.register_collector(metrics.collect)
\ No newline at end of file
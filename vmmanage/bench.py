@@ -0,0 +1,87 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Helpers to benchmark VM handling without calling vagrant.
+"""
+from collections import namedtuple
+from time import sleep, perf_counter
+
+from uptomate import Deployment
+from uptomate.Provider import LOCALHOST
+
+FakeStatus = namedtuple('FakeStatus', ['provider', 'state'])
+
+
+class FakeVagrant(Deployment.Vagrant):
+    """
+    Stand-in for a vagrant deployment. Actions only sleep for
+    action_time seconds and change the state accordingly.
+    Finished actions are recorded in FakeVagrant.finished by token,
+    so they can be tracked across pickling.
+    """
+    finished = {}
+
+    def __init__(self, slug, token=None, action_time=0.0, provider="docker"):
+        self.slug = slug
+        self.token = token
+        self.action_time = action_time
+        self.provider = provider
+        self.state = Deployment.VAGRANT_UNKNOWN
+
+    def _act(self, action):
+        sleep(self.action_time)
+        self.state = Deployment.ASSOCIATED_STATES.get(action, self.state)
+
+    def install(self, **kwargs):
+        self._act('install')
+
+    def start(self, **kwargs):
+        self._act('start')
+
+    def stop(self, **kwargs):
+        self._act('stop')
+
+    def resume(self, **kwargs):
+        self._act('resume')
+
+    def suspend(self, **kwargs):
+        self._act('suspend')
+
+    def reload(self, **kwargs):
+        self._act('reload')
+
+    def destroy(self, **kwargs):
+        self._act('destroy')
+
+    def status(self):
+        if self.token is not None:
+            FakeVagrant.finished[self.token] = perf_counter()
+        return FakeStatus(self.provider, self.state)
+
+    def service_network_address(self):
+        return LOCALHOST
+
+
+def percentile(values, pct):
+    """
+    :param values: sorted list of numbers
+    :param pct: percentile between 0 and 100
+    :return: nearest rank percentile of values
+    """
+    if not values:
+        return 0.0
+    rank = max(int(round(pct / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
@@ -0,0 +1,133 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Index of the problems available in settings.VAGR_DEPLOYMENT_PATH.
+Config files are only read and parsed again if their mtime changed.
+"""
+import hashlib
+import json
+import os
+from os import path
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from uptomate import Deployment
+from .models import CatalogueEntry, Problem
+
+REQUIRED_CONFIG_KEYS = ('name', 'desc', 'category', 'points', 'tags')
+REFRESH_CACHE_KEY = "vmmanage_catalogue_refreshed"
+
+
+def validate_config(config):
+    """
+    :return: error message or an empty string if the config is valid
+    """
+    if not isinstance(config, dict):
+        return "The config has to be a JSON object"
+    missing = [k for k in REQUIRED_CONFIG_KEYS if k not in config]
+    if missing:
+        return "Missing mandatory field(s): {}".format(", ".join(missing))
+    try:
+        Problem.check_config(config)
+    except ValueError as ex:
+        return str(ex)
+    return ""
+
+
+def _scan_entry(entry, config_path):
+    with open(config_path, 'rb') as f:
+        content = f.read()
+    config_hash = hashlib.sha256(content).hexdigest()
+    if entry.config_hash == config_hash:
+        return
+
+    entry.config_hash = config_hash
+    try:
+        config = json.loads(content.decode())
+    except ValueError as ex:
+        entry.config_json = ""
+        entry.error = "Invalid JSON: {}".format(ex)
+    else:
+        entry.config_json = json.dumps(config)
+        entry.error = validate_config(config)
+
+
+def refresh():
+    """
+    Updates the index from the problem directories. Only configs
+    whose mtime changed are read, entries of removed problems
+    are deleted.
+    :return: number of added, changed and removed entries
+    """
+    entries = {e.slug: e for e in CatalogueEntry.objects.all()}
+    new = []
+    changed = []
+    found = set()
+    now = timezone.now()
+
+    with os.scandir(settings.VAGR_DEPLOYMENT_PATH) as problem_dirs:
+        for problem_dir in problem_dirs:
+            config_path = path.join(problem_dir.path, Deployment.CONFIG_FILE_NAME)
+            try:
+                mtime = os.stat(config_path).st_mtime
+            except OSError:
+                continue
+            slug = problem_dir.name
+            found.add(slug)
+            entry = entries.get(slug)
+            if entry and entry.mtime == mtime:
+                continue
+            if not entry:
+                entry = CatalogueEntry(slug=slug)
+            entry.mtime = mtime
+            entry.scanned = now
+            try:
+                _scan_entry(entry, config_path)
+            except OSError as ex:
+                entry.error = "Could not read config: {}".format(ex)
+                # Parsed again once it can be read, which sets the error
+                entry.config_hash = ""
+            (changed if entry.pk else new).append(entry)
+
+    CatalogueEntry.objects.bulk_create(new)
+    CatalogueEntry.objects.bulk_update(
+        changed,
+        ['mtime', 'config_hash', 'config_json', 'error', 'scanned']
+    )
+    removed, _ = CatalogueEntry.objects.exclude(slug__in=found).delete()
+    cache.set(REFRESH_CACHE_KEY, True, settings.CATALOGUE_MAX_AGE)
+    return len(new) + len(changed) + removed
+
+
+def refresh_if_stale():
+    """
+    Refreshes the index, if it was not refreshed within
+    settings.CATALOGUE_MAX_AGE seconds.
+    """
+    if not cache.get(REFRESH_CACHE_KEY):
+        refresh()
+
+
+def installable():
+    """
+    :return: entries of all problems that are not installed yet
+    """
+    refresh_if_stale()
+    return CatalogueEntry.objects.exclude(
+        slug__in=Problem.objects.values('slug')
+    )
@@ -16,10 +16,15 @@
 from glob import glob
 from os import path
 
+from autotask.tasks import DelayedTask
 from django.conf import settings
+from django.db import transaction
+from django.db.models import QuerySet
 
 from uptomate import Deployment
+from . import catalogue
 from . import models
+from . import snapshots
 from . import tasks
 from .models import (
     vagr_factory,
@@ -53,6 +58,9 @@ def install_deployment(vagr_depl: Deployment.Vagrant, vm):
 
 def _install_deployment_callback(vagr_depl, f, vm_db, **kwargs):
     install_deployment(vagr_depl, vm_db)
+    # Taken after the flag was written, so resets keep it
+    if settings.SNAPSHOT_AFTER_INSTALL:
+        snapshots.take_after_install(vm_db)
 
 
 def create_problem(problem_slug, vagrant_name):
@@ -64,8 +72,12 @@ def create_problem(problem_slug, vagrant_name):
     # Set name as work around, so unique contraint is not violated
     # in case two VMs get created at the same time
     # This raises an IntegretyError if the problem slug already exists
-    problem = models.Problem.create(slug=problem_slug, name=problem_slug,
-                                    config=vagr.get_config())
+    problem = models.Problem.create(
+        slug=problem_slug, name=problem_slug, config=vagr.get_config(),
+        provider=settings.VAGR_FILE_PROVIDERS.get(vagrant_name)
+    )
+    if problem.download_set.exists():
+        tasks.update_download_manifests(problem)
     vm = problem.vm
 
     if vm:
@@ -81,47 +93,186 @@ def create_problem(problem_slug, vagrant_name):
     return problem
 
 
-def destroy_problem(problem):
-    return tasks.destroy_problem(problem)
+class BulkInstallError(ValueError):
+    def __init__(self, errors):
+        super().__init__(
+            "; ".join("{}: {}".format(k, v) for k, v in errors.items())
+        )
+        self.errors = errors
+
+
+def _check_new_problems(problem_slugs):
+    """
+    :return: configs and errors of the problems, by slug
+    """
+    configs = {}
+    errors = {}
+    installed = set(models.Problem.objects.filter(
+        slug__in=problem_slugs
+    ).values_list('slug', flat=True))
+    for slug in problem_slugs:
+        vagr = vagr_factory(slug)
+        if slug in installed or vagr.installed:
+            errors[slug] = "Problem is already installed"
+            continue
+        try:
+            config = vagr.get_config()
+        except (OSError, ValueError) as ex:
+            errors[slug] = "Config can't be read: {}".format(ex)
+            continue
+        error = catalogue.validate_config(config)
+        if error:
+            errors[slug] = error
+        else:
+            configs[slug] = config
+
+    names = [c['name'] for c in configs.values()]
+    taken = set(models.Problem.objects.filter(
+        name__in=names
+    ).values_list('name', flat=True))
+    for slug, config in configs.items():
+        if config['name'] in taken or names.count(config['name']) > 1:
+            errors[slug] = "Name '{}' is used twice".format(config['name'])
+    return configs, errors
 
 
-def _task_from_slug(action, vm_slug, vm_db=None, **kwargs):
-    vagr = vagr_factory(vm_slug)
-    return tasks.run_on_vagr(vagr, action, vm_db, **kwargs)
+def create_problems(problem_slugs, vagrant_name, concurrency=None):
+    """
+    Installs many problems at once. All configs are checked first,
+    the problems are created in one transaction and the VMs are
+    installed concurrently by a single task.
+    :param problem_slugs: problems to install
+    :param vagrant_name: vagrant file to use for all VMs
+    :param concurrency: number of concurrent installs, by default
+    limited per provider by settings.FLEET_PROVIDER_CONCURRENCY
+    :raises BulkInstallError: with the errors by slug, in this case
+    nothing was installed
+    :return: FleetOperation tracking the installs
+    """
+    problem_slugs = list(dict.fromkeys(problem_slugs))
+    if not problem_slugs:
+        raise BulkInstallError({"": "No problems given"})
+    configs, errors = _check_new_problems(problem_slugs)
+    if errors:
+        raise BulkInstallError(errors)
+
+    provider = settings.VAGR_FILE_PROVIDERS.get(vagrant_name)
+    with transaction.atomic():
+        problems = [
+            models.Problem.create(
+                slug=slug, name=slug, config=configs[slug], provider=provider
+            )
+            for slug in problem_slugs
+        ]
+
+    jobs = [(vagr_factory(p.slug), p.vm) for p in problems if p.vm]
+    without_vm = [p.slug for p in problems if not p.vm]
+    with transaction.atomic():
+        operation = models.FleetOperation.objects.create(
+            action='install',
+            total=len(problems)
+        )
+        models.FleetResult.objects.bulk_create([
+            models.FleetResult(operation=operation, slug=slug,
+                               outcome=models.FLEET_SUCCEEDED,
+                               message="no VM needed")
+            for slug in without_vm
+        ])
+    for problem in problems:
+        if problem.download_set.exists():
+            tasks.update_download_manifests(problem)
+
+    t = tasks.run_fleet_action(
+        operation,
+        jobs,
+        callback=_install_deployment_callback,
+        concurrency=concurrency,
+        vagrant_file_path=path.join(settings.VAGR_VAGRANT_PATH, vagrant_name)
+    )
+    _link_fleet_task(operation, t, [vm for _, vm in jobs])
+    return operation
+
+
+def destroy_problem(problem):
+    return tasks.destroy_problem(problem)
 
 
 def run_on_existing(action, vm_obj, **kwargs):
     if action not in LEGAL_API_VM_ACTIONS:
         raise IllegalAction("Illegal action '{}'".format(action))
-    t = _task_from_slug(action, vm_obj.problem.slug, vm_obj, **kwargs)
+    t = tasks.run_on_vagr(vm_obj.get_vagrant(), action, vm_obj, **kwargs)
     vm_obj.add_task(t, action)
     return t
 
 
-# Todo: make cheaper
 def find_installable_problems():
-    problems = []
-    existing_slugs = models.Problem.objects.all().values_list('slug', flat=True)
-    for task_path in glob(
-            path.join(
-                settings.VAGR_DEPLOYMENT_PATH,
-                "*",
-                Deployment.CONFIG_FILE_NAME
-            )
-    ):
-        task_path = path.dirname(task_path)
-        task_name = path.split(task_path)[-1]
-        if task_name not in existing_slugs:
-            problems.append(task_name)
-    return problems
+    """
+    :return: CatalogueEntries of all problems that can be installed
+    """
+    return catalogue.installable()
 
 
 def action_on_state(vms, action, states, **action_kwargs):
-    for vm in vms:
-        predicted_state = vm.predict_state()
-        if predicted_state == Deployment.VAGRANT_UNKNOWN or \
-                        predicted_state in states:
-            run_on_existing(action, vm, **action_kwargs)
+    """
+    Runs action as one fleet operation on all VMs that are predicted
+    to be in one of the given states.
+    :return: the FleetOperation or None if no VM matched
+    """
+    vms = list(vms)
+    predicted_states = models.VirtualMachine.predict_states(vms)
+    matching = [
+        vm for vm in vms
+        if predicted_states[vm.pk] == Deployment.VAGRANT_UNKNOWN or
+        predicted_states[vm.pk] in states
+    ]
+    if not matching:
+        return None
+    return run_fleet_action(action, matching, **action_kwargs)
+
+
+def run_fleet_action(action, vms, **action_kwargs):
+    """
+    Runs an action on many VMs using a single task. The task runs
+    the actions concurrently, limited per provider.
+    :param action: action to apply
+    :param vms: VMs to apply the action on
+    :return: FleetOperation tracking the progress
+    """
+    if action not in LEGAL_API_VM_ACTIONS:
+        raise IllegalAction("Illegal action '{}'".format(action))
+
+    vms = list(vms)
+    operation = models.FleetOperation.objects.create(
+        action=action,
+        total=len(vms)
+    )
+    t = tasks.run_fleet_action(
+        operation,
+        [(vm.get_vagrant(), vm) for vm in vms],
+        **action_kwargs
+    )
+
+    _link_fleet_task(operation, t, vms)
+    return operation
+
+
+def _link_fleet_task(operation, t, vms):
+    if isinstance(t, DelayedTask):
+        operation.task_id = t.pk
+        operation.save()
+        # Link the task to every VM, so their state can be predicted
+        models.Task.objects.bulk_create(
+            [models.Task.create(vm, t, operation.action) for vm in vms]
+        )
+        # Not every backend returns the primary keys of bulk_create
+        task_pks = dict(
+            models.Task.objects.filter(task_id=t.pk).values_list(
+                'virtual_machine_id', 'pk'
+            )
+        )
+        for vm in vms:
+            vm.last_task_id = task_pks[vm.pk]
+        models.VirtualMachine.objects.bulk_update(vms, ['last_task'])
 
 
 def vm_action_on_states(action, states, vms=None):
@@ -133,8 +284,10 @@ def vm_action_on_states(action, states, vms=None):
     :param vms: VMs to iterate over, if None, all VMs will be used instead
     :param action: action to apply
     :param states: states the VM should be in to apply action.
-    :return: task object
+    :return: FleetOperation or None
     """
     if vms is None:
         vms = models.VirtualMachine.objects.all()
-    action_on_state(vms, action, states)
\ No newline at end of file
+    if isinstance(vms, QuerySet):
+        vms = vms.select_related('problem')
+    return action_on_state(vms, action, states)
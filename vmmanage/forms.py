@@ -13,7 +13,14 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-from django.forms import Form, ChoiceField, ModelForm
+from django.forms import (
+    CheckboxSelectMultiple,
+    ChoiceField,
+    Form,
+    IntegerField,
+    ModelForm,
+    MultipleChoiceField,
+)
 
 from . import deploy_controller
 from . import models
@@ -25,7 +32,20 @@ class VagrantFilesForm(Form):
     )
 
 
+class BulkInstallForm(VagrantFilesForm):
+    problems = MultipleChoiceField(widget=CheckboxSelectMultiple)
+    concurrency = IntegerField(
+        min_value=1, required=False,
+        help_text="Concurrent installs, by default limited per provider"
+    )
+
+    def __init__(self, *args, problem_slugs=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['problems'].choices = [(s, s) for s in problem_slugs]
+
+
 class ProblemEditForm(ModelForm):
     class Meta:
         model = models.Problem
-        fields = ["name", "desc", "category"]
\ No newline at end of file
+        fields = ["name", "desc", "category", "keep_warm", "instance_per_user",
+                  "reset_interval"]
\ No newline at end of file
@@ -0,0 +1,121 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Compaction and retention of the state and task history of VMs.
+"""
+from datetime import timedelta
+
+from autotask import models as task_models
+from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import VirtualMachine, State, Task, latest_state_subquery
+
+
+def compact_states(vm):
+    """
+    Merges consecutive states of a VM with the same name into one,
+    spanning from the first to the last time it was seen.
+    :return: number of deleted states
+    """
+    merged = []
+    redundant = []
+    with transaction.atomic():
+        states = vm.state_set.select_for_update().order_by(
+            'created', 'pk'
+        ).values_list('pk', 'name', 'created', 'last_seen')
+        for pk, name, created, last_seen in states:
+            seen_until = last_seen or created
+            if merged and merged[-1][1] == name:
+                merged[-1][2] = max(merged[-1][2], seen_until)
+                merged[-1][3] = True
+                redundant.append(pk)
+            else:
+                merged.append([pk, name, seen_until, False])
+
+        if redundant:
+            State.objects.filter(pk__in=redundant).delete()
+            for pk, _, seen_until, changed in merged:
+                if changed:
+                    State.objects.filter(pk=pk).update(last_seen=seen_until)
+    return len(redundant)
+
+
+def purge_states(retention):
+    """
+    Deletes states that were last seen before the retention period.
+    The latest state of every VM is kept.
+    :param retention: timedelta
+    :return: number of deleted states
+    """
+    # VMs without states annotate NULL, which would make NOT IN never match
+    latest = VirtualMachine.objects.annotate(
+        latest_state_pk=latest_state_subquery('pk')
+    ).filter(latest_state_pk__isnull=False).values('latest_state_pk')
+    deleted, _ = State.objects.annotate(
+        seen_until=Coalesce('last_seen', 'created')
+    ).filter(
+        seen_until__lt=timezone.now() - retention
+    ).exclude(pk__in=latest).delete()
+    return deleted
+
+
+def purge_tasks(retention):
+    """
+    Deletes finished tasks of VMs created before the retention period,
+    including their autotask TaskQueue entries.
+    :param retention: timedelta
+    :return: number of deleted TaskQueue entries
+    """
+    deleted, per_model = task_models.TaskQueue.objects.filter(
+        pk__in=Task.objects.filter(
+            creation_date__lt=timezone.now() - retention,
+            task__status__in=[task_models.DONE, task_models.ERROR]
+        ).values('task_id'),
+        is_periodic=False
+    ).delete()
+    return per_model.get(task_models.TaskQueue._meta.label, 0)
+
+
+def fill_current_states():
+    """
+    Sets the current state of VMs that do not have one yet
+    from their state history.
+    :return: number of updated VMs
+    """
+    return VirtualMachine.objects.filter(current_state="").exclude(
+        state__isnull=True
+    ).update(
+        current_state=latest_state_subquery(),
+        state_changed=latest_state_subquery('created')
+    )
+
+
+def compact_history():
+    """
+    Runs the compaction and retention of the VM history,
+    see settings.STATE_RETENTION and settings.TASK_RETENTION.
+    :return: summary
+    """
+    fill_current_states()
+    merged = sum(compact_states(vm) for vm in VirtualMachine.objects.all())
+    states = purge_states(timedelta(seconds=settings.STATE_RETENTION))
+    task_count = purge_tasks(timedelta(seconds=settings.TASK_RETENTION))
+    return "{} states merged, {} states and {} tasks deleted".format(
+        merged, states, task_count
+    )
@@ -0,0 +1,225 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Instances of problems for a single user. They are created the first
+time a user asks for them, get their own ports and are reaped after
+settings.INSTANCE_IDLE_TIMEOUT. At most settings.INSTANCE_CAPACITY
+instances are active, further ones wait in a queue.
+"""
+import logging
+import shutil
+from datetime import timedelta
+from os import path
+
+from autotask import models as task_models
+from autotask.tasks import DelayedTask
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from uptomate.Deployment import VAGRANT_STOPPED_STATES
+
+from . import deploy_controller
+from . import tasks
+from .models import PortPool, Task, VirtualMachine
+from .sweeper import STATE_NOT_CREATED
+
+DESTROY_TASK_NAME = "destroy"
+
+logger = logging.getLogger(__name__)
+
+
+def instances():
+    return VirtualMachine.objects.filter(owner__isnull=False)
+
+
+def active_instances():
+    """
+    :return: instances that run or are being spun up
+    """
+    return instances().filter(queued=None).filter(
+        Q(spinning_up__isnull=False) |
+        ~Q(current_state__in=list(VAGRANT_STOPPED_STATES) + [""])
+    )
+
+
+def _lock_capacity():
+    # All changes of the number of active instances hold the lock of
+    # the default port pool, so the capacity is never exceeded
+    PortPool.get_for_update()
+
+
+def request_instance(problem, user):
+    """
+    Gets the instance of problem for user. A missing instance is created
+    and a stopped one is started, both are queued if the capacity is
+    exceeded.
+    :return: the VM of the instance
+    """
+    shared = problem.vm
+    with transaction.atomic():
+        _lock_capacity()
+        vm, created = VirtualMachine.objects.get_or_create(
+            problem=problem,
+            owner=user,
+            defaults={'provider': shared.provider if shared else ""}
+        )
+        if created and shared:
+            vm.assign_ports([
+                {
+                    'guest': port.guest_port,
+                    'host': None,
+                    'desc': port.description
+                }
+                for port in shared.port_set.all()
+            ])
+        vm.last_used = timezone.now()
+        if vm.queued is None and (
+                created or vm.predict_state() in VAGRANT_STOPPED_STATES):
+            vm.queued = vm.last_used
+        vm.save(update_fields=['last_used', 'queued'])
+    spin_up_queued()
+    return vm
+
+
+def touch(vms):
+    """
+    Marks instances as used, so they are not reaped.
+    """
+    VirtualMachine.objects.filter(
+        pk__in=[vm.pk for vm in vms]
+    ).update(last_used=timezone.now())
+
+
+def queue_position(vm):
+    """
+    :return: number of instances queued before vm
+    """
+    return instances().filter(queued__lt=vm.queued).count()
+
+
+def vagrant_file_of(provider):
+    """
+    :return: vagrant file name for provider, the default one if
+    no vagrant file uses it
+    """
+    return next(
+        (name for name, p in settings.VAGR_FILE_PROVIDERS.items()
+         if p == provider),
+        settings.VAGR_DEFAULT_VAGR_FILE
+    )
+
+
+def _spin_up(vm):
+    vagr = vm.get_vagrant()
+    if vagr.installed:
+        deploy_controller.run_on_existing(settings.DEFAULT_USED_ACTION, vm)
+        return
+
+    # The instance is created from the problem's files, without the
+    # state of the shared deployment
+    shutil.copytree(
+        path.join(settings.VAGR_DEPLOYMENT_PATH, vm.problem.slug),
+        vm.deployment_dir,
+        ignore=shutil.ignore_patterns(".vagrant"),
+        dirs_exist_ok=True
+    )
+    t = tasks.run_on_vagr(
+        vagr,
+        'install',
+        vm,
+        deploy_controller._install_deployment_callback,
+        vagrant_file_path=path.join(
+            settings.VAGR_VAGRANT_PATH, vagrant_file_of(vm.provider)
+        )
+    )
+    if isinstance(t, DelayedTask):
+        vm.add_task(t, 'install')
+
+
+def spin_up_queued():
+    """
+    Spins up queued instances, oldest first, as long as there is capacity.
+    :return: number of instances spun up
+    """
+    with transaction.atomic():
+        _lock_capacity()
+        free = settings.INSTANCE_CAPACITY - active_instances().count()
+        if free <= 0:
+            return 0
+        queued = list(
+            instances().filter(
+                queued__isnull=False
+            ).select_related('problem').order_by('queued')[:free]
+        )
+        # Counts as active from now on
+        now = timezone.now()
+        VirtualMachine.objects.filter(
+            pk__in=[vm.pk for vm in queued]
+        ).update(queued=None, spinning_up=now)
+        for vm in queued:
+            vm.queued = None
+            vm.spinning_up = now
+
+    for vm in queued:
+        try:
+            _spin_up(vm)
+        except Exception:
+            # The instance would count against the capacity forever
+            logger.exception("Could not spin up %s", vm.deployment_slug)
+            VirtualMachine.objects.filter(pk=vm.pk).update(spinning_up=None)
+            vm.spinning_up = None
+            if vm.current_state not in VAGRANT_STOPPED_STATES:
+                vm.record_state(STATE_NOT_CREATED)
+    return len(queued)
+
+
+def reap_idle():
+    """
+    Applies settings.INSTANCE_IDLE_ACTION to instances that were not
+    used for settings.INSTANCE_IDLE_TIMEOUT. Instances that are already
+    being destroyed are skipped.
+    :return: number of reaped instances
+    """
+    destroying = Task.objects.filter(
+        task_name=DESTROY_TASK_NAME,
+        task__status__in=[task_models.WAITING, task_models.RUNNING]
+    ).values('virtual_machine')
+    idle = list(
+        instances().filter(
+            queued=None,
+            last_used__lt=timezone.now() - timedelta(
+                seconds=settings.INSTANCE_IDLE_TIMEOUT
+            )
+        ).exclude(
+            pk__in=destroying
+        ).select_related('problem')
+    )
+    if settings.INSTANCE_IDLE_ACTION == "destroy":
+        for vm in idle:
+            t = tasks.destroy_instance(vm)
+            if isinstance(t, DelayedTask):
+                vm.add_task(t, DESTROY_TASK_NAME)
+        return len(idle)
+
+    states = VirtualMachine.predict_states(idle)
+    running = [vm for vm in idle if states[vm.pk] not in VAGRANT_STOPPED_STATES]
+    if running:
+        deploy_controller.run_fleet_action(
+            settings.INSTANCE_IDLE_ACTION, running
+        )
+    return len(running)
@@ -0,0 +1,97 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measures allocating and releasing host ports with many ports in use.
+"""
+import uuid
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from vmmanage import models
+from vmmanage.bench import percentile
+
+
+class Command(BaseCommand):
+    help = "benchmarks the host port pool with many allocated ports"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--allocated', type=int, default=50000,
+                            help="number of ports in use before measuring")
+        parser.add_argument('--rounds', type=int, default=1000,
+                            help="number of measured allocations")
+        parser.add_argument('--ports-per-vm', type=int, default=3,
+                            help="number of ports allocated at once")
+
+    def handle(self, *args, **options):
+        pool = models.PortPool.objects.create(
+            name="bench-{}".format(uuid.uuid4().hex[:8]),
+            start=models.MIN_PORT,
+            end=models.MAX_PORT
+        )
+        try:
+            self._run(pool, options)
+        finally:
+            pool.delete()
+
+    def _run(self, pool, options):
+        pool.freeportrange_set.create(start=pool.start, end=pool.end)
+
+        # Leave every fourth port free, so the pool is fragmented
+        with transaction.atomic():
+            allocated = self._locked(pool).allocate(
+                min(options['allocated'], pool.end - pool.start + 1)
+            )
+        with transaction.atomic():
+            locked = self._locked(pool)
+            for port in allocated[::4]:
+                locked.release(port)
+        self.stdout.write("{} ports in use, {} free ranges".format(
+            len(allocated) - len(allocated[::4]),
+            pool.freeportrange_set.count()
+        ))
+
+        alloc_times = []
+        release_times = []
+        for _ in range(options['rounds']):
+            start = perf_counter()
+            with transaction.atomic():
+                ports = self._locked(pool).allocate(options['ports_per_vm'])
+            alloc_times.append(perf_counter() - start)
+
+            start = perf_counter()
+            with transaction.atomic():
+                locked = self._locked(pool)
+                for port in ports:
+                    locked.release(port)
+            release_times.append(perf_counter() - start)
+
+        for name, times in (("allocate", alloc_times),
+                            ("release", release_times)):
+            times.sort()
+            self.stdout.write(
+                "{}: p50 {:.2f}ms, p95 {:.2f}ms, max {:.2f}ms".format(
+                    name,
+                    percentile(times, 50) * 1000,
+                    percentile(times, 95) * 1000,
+                    percentile(times, 100) * 1000,
+                )
+            )
+
+    @staticmethod
+    def _locked(pool):
+        return models.PortPool.objects.select_for_update().get(pk=pool.pk)
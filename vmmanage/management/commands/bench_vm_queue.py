@@ -0,0 +1,133 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measures the end-to-end latency of actions queued on VMs, using
+a fake vagrant deployment and in-process workers instead of autotask.
+"""
+import pickle
+import queue
+import threading
+import uuid
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from vmmanage import models
+from vmmanage import tasks
+from vmmanage.bench import FakeVagrant, percentile
+
+BENCH_ACTIONS = ['start', 'stop']
+
+
+class Command(BaseCommand):
+    help = "benchmarks the per VM action queue against a fake deployment"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--actions', type=int, default=100,
+                            help="number of queued actions")
+        parser.add_argument('--vms', type=int, default=1,
+                            help="number of VMs the actions are spread over")
+        parser.add_argument('--workers', type=int, default=4,
+                            help="number of simulated task workers")
+        parser.add_argument('--action-time', type=float, default=0.05,
+                            help="seconds a fake vagrant action takes")
+
+    def handle(self, *args, **options):
+        prefix = "bench-{}".format(uuid.uuid4().hex[:8])
+        vms = [self._create_vm("{}-{}".format(prefix, i))
+               for i in range(options['vms'])]
+        try:
+            latencies, duration, errors = self._run(vms, options)
+        finally:
+            models.Problem.objects.filter(slug__startswith=prefix).delete()
+
+        self.stdout.write(
+            "{} actions on {} VM(s) with {} worker(s) in {:.2f}s "
+            "({:.1f} actions/s)".format(
+                len(latencies), len(vms), options['workers'],
+                duration, len(latencies) / duration
+            )
+        )
+        for pct in (50, 95, 99, 100):
+            self.stdout.write("p{}: {:.3f}s".format(
+                pct, percentile(latencies, pct)
+            ))
+        for ex in errors:
+            self.stderr.write("Action failed: {}".format(ex))
+
+    @staticmethod
+    def _create_vm(slug):
+        problem = models.Problem.objects.create(
+            slug=slug, name=slug, desc="", category="bench", flag=slug
+        )
+        return models.VirtualMachine.objects.create(problem=problem)
+
+    @staticmethod
+    def _run(vms, options):
+        work = queue.Queue()
+
+        def dispatch(*args, **kwargs):
+            # Like autotask, hand a pickled copy of the arguments to the workers
+            work.put(pickle.loads(pickle.dumps((args, kwargs))))
+
+        def worker():
+            try:
+                for args, kwargs in iter(work.get, None):
+                    try:
+                        tasks.perform_action(*args, **kwargs)
+                    except Exception as ex:
+                        errors.append(ex)
+                    finally:
+                        work.task_done()
+            finally:
+                connection.close()
+
+        submitted = {}
+        errors = []
+        FakeVagrant.finished.clear()
+        threads = [threading.Thread(target=worker)
+                   for _ in range(options['workers'])]
+        # Parked actions get dispatched again through tasks.run_on_vagr
+        orig_run_on_vagr = tasks.run_on_vagr
+        tasks.run_on_vagr = dispatch
+        try:
+            for t in threads:
+                t.start()
+            start = perf_counter()
+            for i in range(options['actions']):
+                vm = vms[i % len(vms)]
+                submitted[i] = perf_counter()
+                dispatch(
+                    FakeVagrant(vm.problem.slug, token=i,
+                                action_time=options['action_time']),
+                    BENCH_ACTIONS[i % len(BENCH_ACTIONS)],
+                    vm
+                )
+            work.join()
+            duration = perf_counter() - start
+        finally:
+            for _ in threads:
+                work.put(None)
+            for t in threads:
+                t.join()
+            tasks.run_on_vagr = orig_run_on_vagr
+
+        latencies = sorted(
+            FakeVagrant.finished[i] - submitted[i]
+            for i in submitted if i in FakeVagrant.finished
+        )
+        return latencies, duration, errors
@@ -0,0 +1,62 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Installs many problems of the catalogue at once, e.g. when importing the
+problems of a course, with their VMs installing concurrently.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from vmmanage import deploy_controller
+
+
+class Command(BaseCommand):
+    help = "installs problems of the catalogue and waits for their VMs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('problems', nargs='*',
+                            help="slugs of the problems to install")
+        parser.add_argument('--all', action='store_true',
+                            help="all valid problems which are not installed")
+        parser.add_argument('--vagrant-file',
+                            default=settings.VAGR_DEFAULT_VAGR_FILE)
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help="concurrent installs, limited per provider "
+                                 "by default")
+
+    def handle(self, *args, **options):
+        slugs = options['problems']
+        if options['all']:
+            slugs = [p.slug for p in deploy_controller.find_installable_problems()
+                     if p.is_valid]
+        if not slugs:
+            raise CommandError("no problems to install")
+
+        try:
+            operation = deploy_controller.create_problems(
+                slugs, options['vagrant_file'], options['concurrency']
+            )
+        except deploy_controller.BulkInstallError as ex:
+            for slug, error in ex.errors.items():
+                self.stderr.write("{}: {}".format(slug, error))
+            raise CommandError("no problems were installed")
+
+        for result in operation.results:
+            self.stdout.write(str(result))
+        self.stdout.write("{} {}: {} / {} finished, {} failed".format(
+            operation.action, operation.pk, operation.finished,
+            operation.total, operation.failed
+        ))
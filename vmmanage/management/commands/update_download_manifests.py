@@ -0,0 +1,55 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Builds the manifests of downloads, e.g. for problems installed before
+downloads had manifests or after their files were replaced.
+"""
+import os
+
+from django.core.management.base import BaseCommand
+
+from vmmanage import models
+
+
+class Command(BaseCommand):
+    help = "hashes download files and creates their compressed copies"
+
+    def add_arguments(self, parser):
+        parser.add_argument('problems', nargs='*',
+                            help="slugs of the problems, all if omitted")
+        parser.add_argument('--changed', action='store_true',
+                            help="only downloads whose file changed")
+
+    def handle(self, *args, **options):
+        downloads = models.Download.objects.select_related('problem')
+        if options['problems']:
+            downloads = downloads.filter(problem__slug__in=options['problems'])
+
+        updated = 0
+        for download in downloads:
+            if options['changed'] and download.sha256:
+                try:
+                    if download.matches_manifest(os.stat(download.file_path)):
+                        continue
+                except OSError:
+                    pass
+            download.update_manifest()
+            updated += 1
+            self.stdout.write("{}/{}: {}".format(
+                download.problem.slug, download.slug,
+                download.sha256 or "not found"
+            ))
+        self.stdout.write("{} manifests updated".format(updated))
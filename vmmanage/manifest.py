@@ -0,0 +1,64 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Content hashes and compressed copies of download files, recorded in
+the manifest of a Download when its problem is installed.
+"""
+import gzip
+import hashlib
+import os
+import shutil
+
+from django.conf import settings
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def gzip_path_of(sha256):
+    return os.path.join(settings.DOWNLOAD_GZIP_PATH, sha256 + '.gz')
+
+
+def compressed_copy(file_path, sha256, size):
+    """
+    Creates a gzip compressed copy of a file, named by its hash, so
+    identical files share it. The copy is only kept if it is at most
+    settings.DOWNLOAD_GZIP_MAX_RATIO of the original size.
+    :param file_path: path of the file
+    :param sha256: hex digest of the file
+    :param size: size of the file in bytes
+    :return: path of the copy or "" if compression does not help
+    """
+    if size < settings.DOWNLOAD_GZIP_MIN_SIZE:
+        return ""
+    gz_path = gzip_path_of(sha256)
+    if not os.path.exists(gz_path):
+        os.makedirs(settings.DOWNLOAD_GZIP_PATH, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(gz_path, os.getpid())
+        with open(file_path, 'rb') as src, gzip.open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.replace(tmp_path, gz_path)
+    if os.path.getsize(gz_path) > size * settings.DOWNLOAD_GZIP_MAX_RATIO:
+        os.remove(gz_path)
+        return ""
+    return gz_path
@@ -0,0 +1,142 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Metrics of the task queue and of the timing spans of VM actions,
+see Task.record_spans. They are exported by the metrics endpoint
+and shown on the task dashboard.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from autotask import models as task_models
+from django.conf import settings
+from django.db.models import Avg, Count, Min
+from django.utils import timezone
+
+from berlyne.instrumentation import Histogram
+from .bench import percentile
+from .models import Task, TASK_SPANS
+
+
+def queue_depth():
+    """
+    :return: dict with the number of due, running and scheduled tasks and
+    the seconds the oldest due task is waiting
+    """
+    now = timezone.now()
+    waiting = task_models.TaskQueue.objects.filter(status=task_models.WAITING)
+    due = waiting.filter(scheduled__lte=now).aggregate(
+        count=Count('pk'), oldest=Min('scheduled')
+    )
+    return {
+        'due': due['count'],
+        'scheduled': waiting.filter(scheduled__gt=now).count(),
+        'running': task_models.TaskQueue.objects.filter(
+            status=task_models.RUNNING
+        ).count(),
+        'oldest_wait': (now - due['oldest']).total_seconds()
+        if due['oldest'] else 0,
+    }
+
+
+def recent_tasks():
+    """
+    :return: Tasks with spans of the last settings.TASK_METRICS_WINDOW
+    seconds
+    """
+    return Task.objects.filter(
+        started__gte=timezone.now() - timedelta(
+            seconds=settings.TASK_METRICS_WINDOW
+        )
+    )
+
+
+def action_percentiles():
+    """
+    :return: list of dicts with action, count and p50/p95 of the wait
+    and run time, by action
+    """
+    times = defaultdict(lambda: ([], []))
+    for action, wait, run in recent_tasks().values_list(
+            'task_name', 'wait_time', 'run_time'
+    ):
+        waits, runs = times[action]
+        if wait is not None:
+            waits.append(wait)
+        if run is not None:
+            runs.append(run)
+
+    rows = []
+    for action, (waits, runs) in sorted(times.items()):
+        waits.sort()
+        runs.sort()
+        row = {
+            'action': action,
+            'count': max(len(waits), len(runs)),
+        }
+        for name, values in [('wait', waits), ('run', runs)]:
+            for pct in [50, 95]:
+                # None instead of 0 if the action has no timings yet
+                row['{}_p{}'.format(name, pct)] = (
+                    percentile(values, pct) if values else None
+                )
+        rows.append(row)
+    return rows
+
+
+def slowest_vms(limit=10):
+    """
+    :return: VMs with the highest average run time of their actions
+    """
+    return recent_tasks().filter(
+        run_time__isnull=False
+    ).values(
+        'virtual_machine', 'virtual_machine__problem__slug',
+        'virtual_machine__owner__username', 'provider'
+    ).annotate(
+        avg_run_time=Avg('run_time'), actions=Count('pk')
+    ).order_by('-avg_run_time')[:limit]
+
+
+def collect():
+    """
+    :return: metrics as taken by berlyne.instrumentation.exposition
+    """
+    depth = queue_depth()
+    histograms = defaultdict(Histogram)
+    for row in recent_tasks().values_list(
+            'task_name', 'provider', *[s + "_time" for s in TASK_SPANS]
+    ):
+        action, provider, times = row[0], row[1], row[2:]
+        for span, seconds in zip(TASK_SPANS, times):
+            if seconds is not None:
+                histograms[(action, provider, span)].observe(seconds)
+
+    return [
+        ("berlyne_task_queue_depth", "gauge",
+         "Tasks in the queue by status",
+         [({'status': status}, depth[status])
+          for status in ('due', 'scheduled', 'running')]),
+        ("berlyne_task_queue_oldest_wait_seconds", "gauge",
+         "Time the oldest due task is waiting",
+         [({}, depth['oldest_wait'])]),
+        ("berlyne_vm_action_span_seconds", "histogram",
+         "Duration of the phases of VM actions, over the last "
+         "TASK_METRICS_WINDOW seconds",
+         [({'action': action, 'provider': provider, 'span': span}, histogram)
+          for (action, provider, span), histogram
+          in sorted(histograms.items())]),
+    ]
@@ -13,20 +13,29 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import hashlib
+import json
 import logging
+import os
+import shutil
 import string
+import time
 from collections import defaultdict
-from random import randint, choice as rand_choice
+from random import choice as rand_choice
+from stat import S_ISREG
 
 from autotask import models as task_models
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
+from django.core.cache import cache
 from django.db import models, transaction
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.translation import ugettext_lazy as _
 
 from uptomate import Deployment
 from uptomate.Provider import LOCALHOST, ALLOWED_PROVIDERS
+from . import manifest
 
 LEGAL_API_VM_ACTIONS = [
     'start',
@@ -35,11 +44,14 @@ LEGAL_API_VM_ACTIONS = [
     # 'address',
     'resume',
     'suspend',
-    'reload'
+    'reload',
+    # Restores the snapshot taken after the install, see snapshots.py
+    'reset'
 ]
 
 MIN_PORT = 1025
 MAX_PORT = 2**16-1
+DEFAULT_PORT_POOL = "default"
 
 RANDOM_FLAG_TEMPLATE = "flag{{{}}}"
 FLAG_FILE_NAME = "flag.txt"
@@ -49,7 +61,21 @@ RANDOM_FLAG_LEN = 24
 UNKNOWN_HOST = "*unknown*"
 
 DEFAULT_TASK_NAME = "unnamed_task"
+FLEET_SUCCEEDED = "succeeded"
+FLEET_FAILED = "failed"
+# The VM was busy, the action runs later, outside of the operation
+FLEET_PARKED = "parked"
+FLEET_OUTCOMES = [FLEET_SUCCEEDED, FLEET_FAILED, FLEET_PARKED]
 TASK_STATUS_NAMES = dict(task_models.STATUS_CHOICES)
+# Phases of an action whose duration is stored with its Task: waiting in
+# the queue, waiting for the VM lock, the action, the callback, getting
+# the status and the address and the whole run after the lock was taken
+TASK_SPANS = ["wait", "lock", "action", "callback", "status", "address", "run"]
+
+CONFIG_CACHE_KEY = "vmmanage_problem_config_{slug}_{version}_{stamp}"
+CONFIG_VERSION_CACHE_KEY = "vmmanage_problem_config_version_{slug}"
+DESC_CACHE_KEY = "vmmanage_problem_desc_{pk}_{version}_{digest}"
+DESC_VERSION_CACHE_KEY = "vmmanage_problem_desc_version_{pk}"
 
 
 logger = logging.getLogger(__name__)
@@ -65,6 +91,16 @@ class Problem(models.Model):
     category = models.CharField(_("Category"), max_length=255)
     flag = models.CharField(max_length=255)
     default_points = models.PositiveSmallIntegerField(default=0)
+    # High-demand problems whose VM is kept suspended while unused,
+    # see warm_pool.py
+    keep_warm = models.BooleanField(_("keep warm"), default=False)
+    # Every user gets an instance of their own, see instances.py
+    instance_per_user = models.BooleanField(_("instance per user"),
+                                            default=False)
+    # Seconds after which the shared VM is reset to its snapshot,
+    # None to never reset it
+    reset_interval = models.PositiveIntegerField(_("reset interval"),
+                                                 null=True, blank=True)
 
     # Stores config of problem running on this machine
     __vagr_config = None
@@ -74,14 +110,14 @@ class Problem(models.Model):
         ordering = ("slug", )
 
     @classmethod
-    def create(cls, slug, name, config):
+    def create(cls, slug, name, config, provider=None):
         cls.check_config(config)
         problem = cls(slug=slug, name=name)
         problem.set_basic_config(config)
         problem.save()
         problem.assign_tags(config['tags'])
         problem.assign_downloads(config.get('downloads', {}))
-        problem.assign_vm(config.get('ports', []))
+        problem.assign_vm(config.get('ports', []), provider)
         return problem
 
     def destroy(self):
@@ -91,16 +127,20 @@ class Problem(models.Model):
         This method is **blocking**! It should only be called asynchronously
         since interaction with Vagrant is pretty slow.
         """
-        if self.vm:
-            self.get_vagrant().destroy()
+        for vm in self.virtualmachine_set.all():
+            vm.destroy_deployment()
         self.delete()
 
     @property
     def vm(self):
         """
-        :return: Associated VM or None if problem is DL_only
+        :return: Shared VM or None if problem is DL_only
         """
-        return self.virtualmachine_set.first()
+        # Goes through all(), so a prefetched VM is used if there is one
+        return next(
+            (vm for vm in self.virtualmachine_set.all() if vm.owner_id is None),
+            None
+        )
 
     @staticmethod
     def check_config(config):
@@ -111,11 +151,12 @@ class Problem(models.Model):
             raise ValueError("A download only challenge MUST "
                              "contain a flag in it's meta data!")
 
-    def assign_vm(self, ports):
+    def assign_vm(self, ports, provider=None):
         # In case ports are defined, we need a VM
         if ports:
-            vm = VirtualMachine.objects.create(problem=self)
-            vm.assign_ports(ports)
+            vm = VirtualMachine.objects.create(problem=self,
+                                               provider=provider or "")
+            vm.assign_ports(ports, provider)
             self.virtualmachine_set.add(vm)
 
     def assign_tags(self, tags):
@@ -130,15 +171,17 @@ class Problem(models.Model):
                         slug
                     )
                 )
-            self.download_set.add(
-                Download.objects.create(
-                    slug=slug,
-                    problem=self,
-                    path=self.get_vagrant().normalize_dl_path(
-                        d
-                    )
+            download = Download.objects.create(
+                slug=slug,
+                problem=self,
+                path=self.get_vagrant().normalize_dl_path(
+                    d
                 )
             )
+            # Hashes are added by tasks.update_download_manifests
+            download.update_manifest(hash_content=False)
+            self.download_set.add(download)
+        Problem.invalidate_desc(self.pk)
 
     def set_basic_config(self, config):
         self.name = config['name']
@@ -165,7 +208,11 @@ class Problem(models.Model):
             )
         )
 
-    def parse_desc(self):
+    def parse_desc(self, vm=None):
+        """
+        :param vm: VM whose address is shown, by default the shared one
+        :return: the description or None if the VM is not ready
+        """
         ctx = {}
 
         for download in self.download_set.all():
@@ -174,7 +221,7 @@ class Problem(models.Model):
                 kwargs={'download_id': download.pk}
             )
 
-        vm = self.vm
+        vm = vm or self.vm
         if vm:
             if not vm.provider or vm.ip_addr == UNKNOWN_HOST:
                 return None
@@ -189,7 +236,7 @@ class Problem(models.Model):
             except KeyError:
                 logger.warning(
                     "Illegal provider '%s' used in VM %s",
-                    vm.provider, vm.slug
+                    vm.provider, vm.deployment_slug
                 )
                 return None
 
@@ -205,14 +252,82 @@ class Problem(models.Model):
             self.__vagr_instance = vagr_factory(self.slug)
         return self.__vagr_instance
 
+    def __config_cache_key(self):
+        """
+        :return: cache key of the config, which changes with the
+        mtime and size of the config file and on invalidate_config().
+        None if the file can't be accessed.
+        """
+        try:
+            stat = os.stat(os.path.join(
+                settings.VAGR_DEPLOYMENT_PATH, self.slug,
+                Deployment.CONFIG_FILE_NAME
+            ))
+        except OSError:
+            return None
+        version_key = CONFIG_VERSION_CACHE_KEY.format(slug=self.slug)
+        version = cache_versions([version_key])[version_key]
+        return CONFIG_CACHE_KEY.format(
+            slug=self.slug, version=version,
+            stamp="{}-{}".format(stat.st_mtime_ns, stat.st_size)
+        )
+
     def __get_problem_config(self):
-        if not self.__vagr_config:
-            self.__vagr_config = self.get_vagrant().get_config()
+        if self.__vagr_config is None:
+            key = self.__config_cache_key()
+            config = cache.get(key) if key else None
+            if config is None:
+                config = self.get_vagrant().get_config()
+                if key:
+                    cache.set(key, config, settings.PROBLEM_CONFIG_CACHE_TTL)
+            self.__vagr_config = config
         return self.__vagr_config.copy()
 
     def get_problem_config(self):
+        """
+        The parsed config file of the problem. It is kept in the cache
+        framework, so all web and task workers share it, and read again
+        once the file changed on disk.
+        :return: copy of the config
+        """
         return self.__get_problem_config()
 
+    def invalidate_config(self):
+        """
+        Drops the cached config of this problem in all processes.
+        """
+        bump_cache_version(CONFIG_VERSION_CACHE_KEY.format(slug=self.slug))
+        self.__vagr_config = None
+
+    @staticmethod
+    def desc_cache_keys(problems):
+        """
+        Cache keys for the rendered descriptions of problems. A key
+        changes with the description and on invalidate_desc(), which
+        is called when downloads, ports or the address of the VM change.
+        :param problems: list of Problems
+        :return: dict of problem pk -> key
+        """
+        version_keys = {
+            p.pk: DESC_VERSION_CACHE_KEY.format(pk=p.pk) for p in problems
+        }
+        versions = cache_versions(version_keys.values())
+        return {
+            p.pk: DESC_CACHE_KEY.format(
+                pk=p.pk,
+                version=versions[version_keys[p.pk]],
+                digest=hashlib.md5(p.desc.encode()).hexdigest()
+            )
+            for p in problems
+        }
+
+    @staticmethod
+    def invalidate_desc(problem_pk):
+        """
+        Drops the cached rendered description of a problem.
+        """
+        bump_cache_version(DESC_VERSION_CACHE_KEY.format(pk=problem_pk))
+
     def __str__(self):
         return "{}[{}] ({}) - {}".format(
             self.name, self.default_points, self.category,
@@ -225,10 +340,67 @@ class VirtualMachine(models.Model):
     ip_addr = models.CharField(_("IP Address"), max_length=45)
     provider = models.CharField(max_length=255)
 
+    # Set for instances of a single user, the shared VM has no owner
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, null=True,
+                              blank=True, related_name='vm_instances',
+                              on_delete=models.CASCADE)
+    last_used = models.DateTimeField(_("last used"), null=True, blank=True,
+                                     db_index=True)
+    last_reset = models.DateTimeField(_("last reset"), null=True, blank=True)
+    # Since when an instance waits for capacity, see instances.py
+    queued = models.DateTimeField(_("queued"), null=True, blank=True,
+                                  db_index=True)
+    # Since when a queued instance is being spun up. It counts as active
+    # until the action that spins it up has finished
+    spinning_up = models.DateTimeField(_("spinning up"), null=True,
+                                       blank=True)
+
     # This should only be modified using the
     # lock() and unlock() method
     locked = models.BooleanField(default=False)
 
+    # Copies of the latest state and task, so they can be shown
+    # without querying the history. These are maintained by
+    # record_state() and add_task()
+    current_state = models.CharField(_("state"), max_length=255,
+                                     blank=True, default="", db_index=True)
+    state_changed = models.DateTimeField(_("state changed"), null=True,
+                                         db_index=True)
+    last_task = models.ForeignKey('Task', null=True, blank=True,
+                                  related_name='+',
+                                  on_delete=models.SET_NULL)
+
+    class Meta:
+        unique_together = ("problem", "owner")
+
+    @property
+    def deployment_slug(self):
+        if self.owner_id is None:
+            return self.problem.slug
+        return "{}-{}".format(self.problem.slug, self.owner_id)
+
+    @property
+    def deployment_dir(self):
+        if self.owner_id is None:
+            return os.path.join(settings.VAGR_DEPLOYMENT_PATH,
+                                self.deployment_slug)
+        return os.path.join(settings.VAGR_INSTANCE_PATH, self.deployment_slug)
+
+    def get_vagrant(self):
+        if self.owner_id is None:
+            return self.problem.get_vagrant()
+        return vagr_factory(self.deployment_slug,
+                            settings.VAGR_INSTANCE_PATH)
+
+    def destroy_deployment(self):
+        """
+        Destroys the vagrant deployment, instances are removed from
+        the disk as well. This is **blocking**.
+        """
+        self.get_vagrant().destroy()
+        if self.owner_id is not None:
+            shutil.rmtree(self.deployment_dir, ignore_errors=True)
+
     def predict_state(self):
         """
         Predict the state the VM will be in after its tasks are done.
@@ -236,38 +408,117 @@ class VirtualMachine(models.Model):
         in a atomic DB block in case the state should be manipulated.
         :return: predicted state
         """
-        ts = self.task_set.filter(
-            task__status__in=[
-                task_models.RUNNING,
-                task_models.WAITING
-            ]
-        ).order_by('-task__scheduled')
-        for t in ts:
+        return VirtualMachine.predict_states([self])[self.pk]
+
+    @staticmethod
+    def predict_states(vms):
+        """
+        Same as predict_state, but for many VMs in a fixed number of queries.
+        :param vms: VMs or their primary keys
+        :return: dict mapping the VM pks to their predicted state
+        """
+        pks = [getattr(vm, 'pk', vm) for vm in vms]
+        pending = defaultdict(list)
+
+        for vm_id, scheduled, task_name in Task.objects.filter(
+                virtual_machine__in=pks,
+                task__status__in=[
+                    task_models.RUNNING,
+                    task_models.WAITING
+                ]
+        ).values_list('virtual_machine_id', 'task__scheduled', 'task_name'):
+            pending[vm_id].append((scheduled, task_name))
+
+        # Parked actions are not in the TaskQueue anymore, but will
+        # be dispatched again as soon as the VM is free
+        for vm_id, created, task_name in ParkedAction.objects.filter(
+                vm__in=pks
+        ).values_list('vm_id', 'created', 'task_name'):
+            pending[vm_id].append((created, task_name))
+
+        current = dict(
+            VirtualMachine.objects.filter(pk__in=pks).values_list(
+                'pk', 'current_state'
+            )
+        )
+
+        states = {}
+        for pk in pks:
+            states[pk] = VirtualMachine._predict(pending[pk], current.get(pk))
+        return states
+
+    @staticmethod
+    def _predict(pending, current_state):
+        for _, task_name in sorted(pending, reverse=True):
             # Move down the task stack until one is found that changes the state
             try:
-                return Deployment.ASSOCIATED_STATES[t.task_name]
+                return Deployment.ASSOCIATED_STATES[task_name]
             except KeyError:
                 pass
         # if no state manipulating task is found, return the current state
-        try:
-            return self.state_set.latest().name
-        except ObjectDoesNotExist:
+        if not current_state:
             # No state, means somebody messed around with the DB
             # return not_created, so actions will called anyways
             return Deployment.VAGRANT_UNKNOWN
+        return current_state
+
+    def _lock_row(self):
+        """
+        Locks the DB row of the VM until the surrounding transaction
+        ends and reloads the instance from it.
+        """
+        VirtualMachine.objects.select_for_update().get(pk=self.pk)
+        self.refresh_from_db()
 
     def lock(self):
         with transaction.atomic():
-            self.refresh_from_db()
+            self._lock_row()
+            if self.locked:
+                return False
+            self.locked = True
+            self.save(update_fields=['locked'])
+        return True
+
+    def lock_or_park(self, task_name, arguments):
+        """
+        Like lock(), but if the VM is in use, the action is parked
+        instead. Parked actions are handed out by release().
+        :param task_name: name of the action
+        :param arguments: pickled arguments to dispatch the action again
+        :return: True if the lock was acquired, False if it was parked
+        """
+        with transaction.atomic():
+            self._lock_row()
             if self.locked:
+                ParkedAction.objects.create(
+                    vm=self,
+                    task_name=task_name,
+                    arguments=arguments
+                )
                 return False
             self.locked = True
-            self.save()
+            self.save(update_fields=['locked'])
         return True
 
+    def release(self):
+        """
+        Unlocks the VM. In case there are parked actions, the VM stays
+        locked and the oldest one is returned instead. The caller has
+        to dispatch it, it owns the lock from now on.
+        :return: ParkedAction or None
+        """
+        with transaction.atomic():
+            VirtualMachine.objects.select_for_update().get(pk=self.pk)
+            parked = self.parkedaction_set.first()
+            if parked:
+                parked.delete()
+            self.locked = parked is not None
+            self.save(update_fields=['locked', 'provider', 'ip_addr'])
+        return parked
+
     def unlock(self):
         self.locked = False
-        self.save()
+        self.save(update_fields=['locked'])
 
     def get_port_list(self):
         """
@@ -282,21 +533,76 @@ class VirtualMachine(models.Model):
             for port in self.port_set.all()
         ]
 
-    def assign_ports(self, ports):
-        for port in ports:
-            with transaction.atomic():
+    def assign_ports(self, ports, provider=None):
+        """
+        Creates the ports of the VM. Ports without a host port get one
+        from the port pool of the provider, all in one transaction.
+        :raises PortInUse: a given host port is already used
+        :return: ports with their host ports set
+        """
+        with transaction.atomic():
+            pool = PortPool.get_for_update(provider)
+            for port in ports:
                 if not port['host']:
-                    port['host'] = Port.random_port()
-                Port.objects.create(
+                    continue
+                if pool.start <= port['host'] <= pool.end:
+                    owner = pool
+                else:
+                    owner = PortPool.get_for_port(port['host'])
+                if owner is None:
+                    taken = Port.objects.filter(
+                        host_port=port['host']
+                    ).exists()
+                else:
+                    taken = not owner.reserve(port['host'])
+                if taken:
+                    raise PortInUse(
+                        "Host port {} is already used".format(port['host'])
+                    )
+            free_ports = iter(
+                pool.allocate(len([p for p in ports if not p['host']]))
+            )
+            for port in ports:
+                if not port['host']:
+                    port['host'] = next(free_ports)
+            Port.objects.bulk_create([
+                Port(
                     guest_port=port['guest'],
                     host_port=port['host'],
                     description=port['desc'],
                     vm=self
                 )
+                for port in ports
+            ])
+        Problem.invalidate_desc(self.problem_id)
         return ports
 
+    def record_state(self, name):
+        """
+        Records the current state of the VM. If it did not change,
+        only the last_seen time of the latest state is updated.
+        """
+        with transaction.atomic():
+            latest = self.state_set.select_for_update().first()
+            if latest and latest.name == name:
+                latest.last_seen = timezone.now()
+                latest.save(update_fields=['last_seen'])
+            else:
+                state = State.objects.create(vm=self, name=name)
+                self.current_state = name
+                self.state_changed = state.created
+                VirtualMachine.objects.filter(pk=self.pk).update(
+                    current_state=self.current_state,
+                    state_changed=self.state_changed
+                )
+
     def add_task(self, task, task_name=None):
-        self.task_set.add(Task.create(self, task, task_name), bulk=False)
+        with transaction.atomic():
+            self.last_task = Task.create(self, task, task_name)
+            self.last_task.save()
+            VirtualMachine.objects.filter(pk=self.pk).update(
+                last_task=self.last_task
+            )
 
     def has_task_in_queue(self, task_name):
         return self.task_set.filter(
@@ -307,7 +613,7 @@ class VirtualMachine(models.Model):
 
     @property
     def is_running(self):
-        return self.state_set.latest().name in Deployment.VAGRANT_RUNNING_STATES
+        return self.current_state in Deployment.VAGRANT_RUNNING_STATES
 
 
 class Download(models.Model):
@@ -315,14 +621,72 @@ class Download(models.Model):
     problem = models.ForeignKey(Problem, on_delete=models.CASCADE)
     path = models.CharField(max_length=4096)
 
+    # Manifest of the file, see update_manifest()
+    file_path = models.CharField(max_length=4096, blank=True, default="")
+    size = models.BigIntegerField(_("size"), null=True)
+    mtime = models.FloatField(null=True)
+    sha256 = models.CharField(_("SHA-256"), max_length=64, blank=True,
+                              default="")
+    gzip_path = models.CharField(max_length=4096, blank=True, default="")
+
     @property
     def abspath(self):
+        if self.file_path:
+            return self.file_path
         vagr = self.problem.get_vagrant()
         return vagr.normalize_dl_path(
             self.path,
             absolut=True
         )
 
+    @property
+    def filename(self):
+        return os.path.basename(self.path)
+
+    def update_manifest(self, hash_content=True):
+        """
+        Records path, size and mtime of the file. With hash_content its
+        SHA-256 and a compressed copy are created as well, which takes
+        a while for big files. Symlinks and missing files get an
+        empty manifest, they are not served.
+        """
+        file_path = self.problem.get_vagrant().normalize_dl_path(
+            self.path,
+            absolut=True
+        )
+        try:
+            stat = os.lstat(file_path)
+        except OSError:
+            stat = None
+
+        self.sha256 = ""
+        self.gzip_path = ""
+        if stat is None or not S_ISREG(stat.st_mode):
+            self.file_path = ""
+            self.size = None
+            self.mtime = None
+        else:
+            self.file_path = file_path
+            self.size = stat.st_size
+            self.mtime = stat.st_mtime
+            if hash_content:
+                self.sha256 = manifest.file_sha256(file_path)
+                self.gzip_path = manifest.compressed_copy(
+                    file_path, self.sha256, self.size
+                )
+        self.save(update_fields=[
+            'file_path', 'size', 'mtime', 'sha256', 'gzip_path'
+        ])
+
+    def matches_manifest(self, stat):
+        """
+        :param stat: os.stat() of the file
+        :return: True if the file did not change since the manifest
+        was built
+        """
+        return bool(self.sha256) and self.size == stat.st_size and \
+            self.mtime == stat.st_mtime
+
     class Meta:
         unique_together = ('problem', 'slug')
 
@@ -343,37 +707,211 @@ class Port(models.Model):
     description = models.CharField(_("description"), max_length=255)
     vm = models.ForeignKey(VirtualMachine, on_delete=models.CASCADE)
 
+    def __str__(self):
+        return "{}->{}:{}".format(self.host_port, self.vm.problem.slug, self.guest_port)
+
+
+class PortPoolExhausted(ValueError):
+    pass
+
+
+class PortInUse(ValueError):
+    pass
+
+
+class PortPool(models.Model):
+    """
+    Range of host ports VMs of a provider get their ports from.
+    The free ports are stored as FreePortRanges, so allocating
+    and releasing ports only touches a few indexed rows.
+    All methods have to be called on a pool locked by
+    get_for_update() within the same atomic block.
+    """
+    name = models.SlugField(_("name"), unique=True)
+    start = models.IntegerField(_("first port"))
+    end = models.IntegerField(_("last port"))
+
+    @staticmethod
+    def get_for_update(provider=None):
+        """
+        Gets the pool of provider and locks it until the transaction ends.
+        The pool is created from settings.PORT_RANGES if needed.
+        Providers without a range of their own use the default pool.
+        """
+        name = provider if provider in settings.PORT_RANGES else DEFAULT_PORT_POOL
+        start, end = settings.PORT_RANGES.get(name, (MIN_PORT, MAX_PORT))
+        pool, created = PortPool.objects.select_for_update().get_or_create(
+            name=name,
+            defaults={'start': start, 'end': end}
+        )
+        if created or (pool.start, pool.end) != (start, end):
+            pool.start, pool.end = start, end
+            pool.save()
+            pool.rebuild()
+        return pool
+
     @staticmethod
-    def random_port():
+    def get_for_port(port):
+        """
+        :return: the locked pool containing port or None
+        """
+        return PortPool.objects.select_for_update().filter(
+            start__lte=port,
+            end__gte=port
+        ).first()
+
+    def rebuild(self):
+        """
+        Recreates the free ranges from the ports in use.
+        """
+        self.freeportrange_set.all().delete()
+        free = []
+        start = self.start
+        for used in Port.objects.filter(
+                host_port__range=(self.start, self.end)
+        ).order_by('host_port').values_list('host_port', flat=True):
+            if used > start:
+                free.append(FreePortRange(pool=self, start=start, end=used - 1))
+            start = used + 1
+        if start <= self.end:
+            free.append(FreePortRange(pool=self, start=start, end=self.end))
+        FreePortRange.objects.bulk_create(free)
+
+    def _range_of(self, port):
+        free = self.freeportrange_set.filter(
+            start__lte=port
+        ).order_by('-start').first()
+        if free and free.end >= port:
+            return free
+        return None
+
+    def allocate(self, count):
+        """
+        Takes count free ports out of the pool.
+        :return: list of ports
         """
-        Gets a free port num. This is not thread save and has to be used
-        within an atomic block together with the creation of the port obj.
-        :return:
+        ports = []
+        while len(ports) < count:
+            free = self.freeportrange_set.order_by('start').first()
+            if free is None:
+                raise PortPoolExhausted(
+                    "No free ports left in pool '{}'".format(self.name)
+                )
+            take = min(count - len(ports), free.end - free.start + 1)
+            ports.extend(range(free.start, free.start + take))
+            free.start += take
+            if free.start > free.end:
+                free.delete()
+            else:
+                free.save()
+        return ports
+
+    def reserve(self, port):
         """
-        used = Port.objects.all().values_list('host_port', flat=True)
+        Takes a given port out of the pool.
+        :return: False if the port was not free
+        """
+        free = self._range_of(port)
+        if free is None:
+            return False
+        if free.start == free.end:
+            free.delete()
+            return True
+        if port == free.start:
+            free.start += 1
+        elif port == free.end:
+            free.end -= 1
+        else:
+            FreePortRange.objects.create(pool=self, start=port + 1, end=free.end)
+            free.end = port - 1
+        free.save()
+        return True
 
-        p = randint(MIN_PORT, MAX_PORT)
-        while p in used:
-            p = randint(MIN_PORT, MAX_PORT)
-        return p
+    def release(self, port):
+        """
+        Puts a port back into the pool.
+        """
+        if not self.start <= port <= self.end or self._range_of(port):
+            return
+        left = self.freeportrange_set.filter(end=port - 1).first()
+        right = self.freeportrange_set.filter(start=port + 1).first()
+        if left and right:
+            left.end = right.end
+            right.delete()
+            left.save()
+        elif left:
+            left.end = port
+            left.save()
+        elif right:
+            right.start = port
+            right.save()
+        else:
+            FreePortRange.objects.create(pool=self, start=port, end=port)
+
+    @property
+    def free_count(self):
+        return self.freeportrange_set.aggregate(
+            free=models.Sum(models.F('end') - models.F('start') + 1)
+        )['free'] or 0
 
     def __str__(self):
-        return "{}->{}:{}".format(self.host_port, self.vm.problem.slug, self.guest_port)
+        return "{} ({}-{})".format(self.name, self.start, self.end)
+
+
+class FreePortRange(models.Model):
+    pool = models.ForeignKey(PortPool, on_delete=models.CASCADE)
+    start = models.IntegerField()
+    end = models.IntegerField()
+
+    class Meta:
+        ordering = ["start"]
+        index_together = [('pool', 'start'), ('pool', 'end')]
+
+    def __str__(self):
+        return "{}-{}".format(self.start, self.end)
 
 
 class State(models.Model):
+    """
+    A state a VM was in. Only changes of the state are stored,
+    the state was seen from created until last_seen. last_seen
+    is None if the state was only seen once.
+    """
     name = models.CharField(_("name"), max_length=255)
-    created = models.DateTimeField(auto_now_add=True)
+    created = models.DateTimeField(_("first seen"), auto_now_add=True)
+    last_seen = models.DateTimeField(_("last seen"), null=True)
     vm = models.ForeignKey(VirtualMachine, on_delete=models.CASCADE)
 
     class Meta:
         get_latest_by = "created"
         ordering = ["-created"]
 
+    @property
+    def seen_until(self):
+        return self.last_seen or self.created
+
     def __str__(self):
         return self.name
 
 
+class ParkedAction(models.Model):
+    """
+    An action that found its VM in use. It waits here until the
+    action holding the lock is done and dispatches it again.
+    """
+    vm = models.ForeignKey(VirtualMachine, on_delete=models.CASCADE)
+    task_name = models.CharField(_("name"), max_length=255)
+    arguments = models.BinaryField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        get_latest_by = "created"
+        ordering = ["created", "pk"]
+
+    def __str__(self):
+        return "{} (parked)".format(self.task_name)
+
+
 class Task(models.Model):
     """
     Used to link a task to a virtual machine.
@@ -385,10 +923,48 @@ class Task(models.Model):
     task_name = models.CharField(_("name"), max_length=255)
     creation_date = models.DateTimeField(auto_now_add=True)
 
+    # Timing spans of the action in seconds, recorded by
+    # tasks.perform_action once it ran, see TASK_SPANS
+    provider = models.CharField(max_length=255, blank=True, default="")
+    started = models.DateTimeField(null=True, blank=True, db_index=True)
+    wait_time = models.FloatField(null=True, blank=True)
+    lock_time = models.FloatField(null=True, blank=True)
+    action_time = models.FloatField(null=True, blank=True)
+    callback_time = models.FloatField(null=True, blank=True)
+    status_time = models.FloatField(null=True, blank=True)
+    address_time = models.FloatField(null=True, blank=True)
+    run_time = models.FloatField(null=True, blank=True)
+
     class Meta:
         get_latest_by = "creation_date"
         ordering = ["-creation_date"]
 
+    @classmethod
+    def record_spans(cls, vm, task_name, started, spans):
+        """
+        Stores the spans of an action with the Task the worker is running.
+        Actions that did not run as a task are not recorded.
+        :param started: when the action was started
+        :param spans: dict of span name (see TASK_SPANS) -> seconds
+        """
+        task = cls.objects.filter(
+            virtual_machine=vm,
+            task_name=task_name,
+            task__status=task_models.RUNNING
+        ).select_related('task').order_by('-pk').first()
+        if task is None:
+            return
+        task.provider = vm.provider
+        task.started = started
+        task.wait_time = max(
+            (started - task.task.scheduled).total_seconds(), 0
+        )
+        for name, seconds in spans.items():
+            setattr(task, name + "_time", seconds)
+        task.save(update_fields=[
+            'provider', 'started', 'wait_time'
+        ] + [name + "_time" for name in spans])
+
     # Factory method
     @classmethod
     def create(cls, virtual_machine, task, task_name=None):
@@ -436,8 +1012,204 @@ class Task(models.Model):
         return "{} [{}]".format(self.task_name, TASK_STATUS_NAMES[self.task.status])
 
 
-def vagr_factory(vm_slug):
+class CatalogueEntry(models.Model):
+    """
+    A problem directory found in settings.VAGR_DEPLOYMENT_PATH.
+    The parsed config is kept, together with the mtime and hash of
+    the config file to find out if it has to be parsed again.
+    """
+    slug = models.SlugField(unique=True)
+    mtime = models.FloatField()
+    config_hash = models.CharField(max_length=64)
+    config_json = models.TextField(blank=True, default="")
+    error = models.TextField(blank=True, default="")
+    scanned = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ("slug", )
+
+    @property
+    def config(self):
+        if not self.config_json:
+            return {}
+        return json.loads(self.config_json)
+
+    @property
+    def is_valid(self):
+        return not self.error
+
+    def __str__(self):
+        return self.slug
+
+
+class FleetOperation(models.Model):
+    """
+    One action run on many VMs by a single task.
+    Progress is recorded by the workers while the task is running,
+    one FleetResult per VM.
+    """
+    action = models.CharField(_("action"), max_length=255)
+    task = models.ForeignKey(task_models.TaskQueue, null=True,
+                             on_delete=models.SET_NULL)
+    created = models.DateTimeField(auto_now_add=True)
+    total = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        get_latest_by = "created"
+        ordering = ["-created"]
+
+    def record(self, vm, result, failed=False, parked=False):
+        """
+        Records the result of the action on one VM. This is safe
+        to be called by concurrent workers.
+
+        :param failed: the action raised an error
+        :param parked: the action was parked because the VM was busy,
+        it has not run yet
+        """
+        outcome = FLEET_SUCCEEDED
+        if failed:
+            outcome = FLEET_FAILED
+        elif parked:
+            outcome = FLEET_PARKED
+        FleetResult.objects.create(
+            operation=self,
+            vm=vm,
+            slug=vm.problem.slug,
+            outcome=outcome,
+            message=str(result)
+        )
+        self.__dict__.pop('counts', None)
+
+    @staticmethod
+    def prefetch_counts(operations):
+        """
+        Counts the results of many operations with a single query.
+        :param operations: list of FleetOperations
+        """
+        counts = {op.pk: dict.fromkeys(FLEET_OUTCOMES, 0) for op in operations}
+        rows = FleetResult.objects.filter(
+            operation__in=operations
+        ).order_by().values_list('operation', 'outcome').annotate(
+            models.Count('pk')
+        )
+        for operation_pk, outcome, count in rows:
+            counts[operation_pk][outcome] = count
+        for operation in operations:
+            operation.counts = counts[operation.pk]
+
+    @cached_property
+    def counts(self):
+        """
+        :return: dict of outcome -> number of VMs
+        """
+        counts = dict.fromkeys(FLEET_OUTCOMES, 0)
+        counts.update(
+            self.fleetresult_set.order_by().values_list(
+                'outcome'
+            ).annotate(models.Count('pk'))
+        )
+        return counts
+
+    @property
+    def succeeded(self):
+        return self.counts[FLEET_SUCCEEDED]
+
+    @property
+    def failed(self):
+        return self.counts[FLEET_FAILED]
+
+    @property
+    def parked(self):
+        return self.counts[FLEET_PARKED]
+
+    @property
+    def finished(self):
+        return sum(self.counts.values())
+
+    @property
+    def results(self):
+        """
+        :return: FleetResults in the order the actions finished
+        """
+        return self.fleetresult_set.all()
+
+    @property
+    def is_done(self):
+        return self.finished >= self.total
+
+    def __str__(self):
+        return "{} [{}/{}, {} failed, {} parked]".format(
+            self.action, self.finished, self.total, self.failed, self.parked
+        )
+
+
+class FleetResult(models.Model):
+    """
+    The result of the action of a FleetOperation on one VM.
+    """
+    operation = models.ForeignKey(FleetOperation, on_delete=models.CASCADE)
+    # None for problems that do not need a VM
+    vm = models.ForeignKey(VirtualMachine, null=True,
+                           on_delete=models.SET_NULL)
+    slug = models.SlugField()
+    outcome = models.CharField(
+        max_length=16,
+        choices=[(outcome, outcome) for outcome in FLEET_OUTCOMES]
+    )
+    message = models.TextField(blank=True, default="")
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["pk"]
+
+    def __str__(self):
+        if self.outcome == FLEET_SUCCEEDED:
+            return "{}: {}".format(self.slug, self.message)
+        return "{}: {}: {}".format(self.slug, self.outcome, self.message)
+
+
+def latest_state_subquery(field='name'):
+    """
+    :param field: field of the state to annotate
+    :return: Subquery annotating VMs with a field of their latest state
+    """
+    return models.Subquery(
+        State.objects.filter(
+            vm=models.OuterRef('pk')
+        ).order_by('-created').values(field)[:1]
+    )
+
+
+def cache_versions(keys):
+    """
+    Reads version counters that are part of other cache keys. Missing
+    counters start at the current time, so a counter that was evicted
+    does not make outdated entries reachable again.
+    :param keys: cache keys of the counters
+    :return: dict of key -> version
+    """
+    versions = cache.get_many(keys)
+    missing = {k: time.time_ns() for k in keys if k not in versions}
+    if missing:
+        cache.set_many(missing, None)
+        versions.update(missing)
+    return versions
+
+
+def bump_cache_version(key):
+    """
+    Increments a version counter that is part of other cache keys,
+    which makes the entries stored under the old keys unreachable.
+    """
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, time.time_ns(), None)
+
+
+def vagr_factory(vm_slug, deployment_path=None):
     return Deployment.Vagrant(
         vm_slug,
-        deployment_path=settings.VAGR_DEPLOYMENT_PATH,
+        deployment_path=deployment_path or settings.VAGR_DEPLOYMENT_PATH,
     )
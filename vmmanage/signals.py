@@ -0,0 +1,42 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import os
+
+from django.db import transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from . import models
+
+
+@receiver(post_delete, sender=models.Port)
+def release_port(sender, instance, **kwargs):
+    with transaction.atomic():
+        pool = models.PortPool.get_for_port(instance.host_port)
+        if pool:
+            pool.release(instance.host_port)
+
+
+@receiver(post_delete, sender=models.Download)
+def remove_compressed_copy(sender, instance, **kwargs):
+    # Copies are shared by downloads with the same content
+    if instance.gzip_path and not models.Download.objects.filter(
+            gzip_path=instance.gzip_path
+    ).exists():
+        try:
+            os.remove(instance.gzip_path)
+        except FileNotFoundError:
+            pass
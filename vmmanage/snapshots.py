@@ -0,0 +1,159 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Snapshots of VMs, taken right after a problem was installed, so a broken
+VM can be reset to a clean state within seconds instead of reinstalling it.
+Vagrant snapshots are not supported by the docker provider. Containers are
+destroyed and created again instead, which provisions them anew and takes
+as long as the install.
+"""
+import glob
+import logging
+import os
+from datetime import timedelta
+from subprocess import check_output, CalledProcessError, TimeoutExpired
+
+from autotask import models as task_models
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from uptomate.Deployment import VAGRANT_RUNNING_STATES
+
+from . import deploy_controller
+from .models import VirtualMachine, ParkedAction, Task
+
+SNAPSHOT_NAME = "berlyne-clean"
+DOCKER_PROVIDER = "docker"
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotError(OSError):
+    pass
+
+
+def vagrant_dir(vm):
+    """
+    The directory of the Vagrantfile of vm. It is a subdirectory of the
+    deployment, the Vagrantfiles refer to the problem's files in '..'
+    and take the slug of the machine from the name of the deployment.
+    :raises SnapshotError: vm is not installed
+    """
+    vagrant_files = glob.glob(
+        os.path.join(glob.escape(vm.deployment_dir), "*", "Vagrantfile")
+    )
+    if not vagrant_files:
+        raise SnapshotError(
+            "No Vagrantfile below {}".format(vm.deployment_dir)
+        )
+    return os.path.dirname(vagrant_files[0])
+
+
+def _vagrant(vm, *args):
+    cmd = ["vagrant"] + list(args)
+    cwd = vagrant_dir(vm)
+    try:
+        return check_output(
+            cmd,
+            cwd=cwd,
+            universal_newlines=True,
+            timeout=settings.SNAPSHOT_TIMEOUT
+        )
+    except (OSError, CalledProcessError, TimeoutExpired) as ex:
+        raise SnapshotError("Could not run '{}': {}".format(" ".join(cmd), ex))
+
+
+def take(vm):
+    """
+    Takes the snapshot of vm, replacing an older one.
+    """
+    if vm.provider == DOCKER_PROVIDER:
+        # The image of the container is the snapshot
+        return
+    _vagrant(vm, "snapshot", "save", "--force", SNAPSHOT_NAME)
+
+
+def take_after_install(vm):
+    """
+    Like take(), but failures are only logged, the install
+    itself succeeded anyways.
+    """
+    try:
+        take(vm)
+    except SnapshotError as ex:
+        logger.warning("No snapshot of %s: %s", vm.deployment_slug, ex)
+
+
+def restore(vm):
+    """
+    Resets vm to its snapshot. This is **blocking**.
+    """
+    if vm.provider == DOCKER_PROVIDER:
+        # Provisions the new container, like the install did
+        _vagrant(vm, "destroy", "--force")
+        _vagrant(vm, "up")
+    else:
+        _vagrant(vm, "snapshot", "restore", "--no-provision", SNAPSHOT_NAME)
+    vm.last_reset = timezone.now()
+    VirtualMachine.objects.filter(pk=vm.pk).update(last_reset=vm.last_reset)
+
+
+# Actions the deployment does not implement itself, see tasks.perform_action
+ACTIONS = {
+    'reset': restore,
+}
+
+
+def due_for_reset():
+    """
+    :return: running shared VMs whose problem's reset interval passed
+    since their last reset, or since they started if never reset.
+    VMs that are busy or already have a reset pending are left out,
+    last_reset is only set once a reset finished.
+    """
+    now = timezone.now()
+    pending = Q(
+        pk__in=Task.objects.filter(
+            task_name='reset',
+            task__status__in=[task_models.WAITING, task_models.RUNNING]
+        ).values('virtual_machine_id')
+    ) | Q(
+        pk__in=ParkedAction.objects.filter(
+            task_name='reset'
+        ).values('vm_id')
+    )
+    return [
+        vm for vm in VirtualMachine.objects.filter(
+            owner=None,
+            locked=False,
+            problem__reset_interval__isnull=False,
+            current_state__in=VAGRANT_RUNNING_STATES
+        ).exclude(pending).select_related('problem')
+        if (vm.last_reset or vm.state_changed) +
+        timedelta(seconds=vm.problem.reset_interval) <= now
+    ]
+
+
+def reset_due():
+    """
+    Resets the VMs returned by due_for_reset() as one fleet operation.
+    :return: number of VMs reset
+    """
+    vms = due_for_reset()
+    if vms:
+        deploy_controller.run_fleet_action('reset', vms)
+    return len(vms)
@@ -0,0 +1,234 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Collects the states of all deployments with one call per provider
+backend, instead of one vagrant call per VM.
+"""
+import logging
+import re
+from os import path
+from subprocess import check_output, CalledProcessError, TimeoutExpired
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .models import (
+    Problem,
+    VirtualMachine,
+    State,
+    latest_state_subquery
+)
+
+STATE_RUNNING = "running"
+STATE_STOPPED = "stopped"
+STATE_NOT_CREATED = "not_created"
+
+DOCKER_PROVIDER = "docker"
+
+# vagrant's docker provider appends a timestamp to the container name
+_DOCKER_NAME_SUFFIX = re.compile(r"_\d+$")
+
+logger = logging.getLogger(__name__)
+
+
+class SweepError(OSError):
+    pass
+
+
+def _run(cmd):
+    try:
+        return check_output(
+            cmd,
+            universal_newlines=True,
+            timeout=settings.STATE_SWEEP_TIMEOUT
+        )
+    except (OSError, CalledProcessError, TimeoutExpired) as ex:
+        raise SweepError("Could not run '{}': {}".format(" ".join(cmd), ex))
+
+
+def parse_global_status(output, deployment_path):
+    """
+    Parses the output of 'vagrant global-status'.
+    Machines outside of deployment_path are ignored.
+    :return: dict mapping machine names to (provider, state) tuples
+    """
+    states = {}
+    lines = iter(output.splitlines())
+    # Skip the header
+    for line in lines:
+        if line.startswith("---"):
+            break
+    for line in lines:
+        fields = line.split(None, 4)
+        if len(fields) != 5:
+            # The machine table ends with an empty line
+            break
+        _, name, provider, state, directory = fields
+        directory = path.normpath(directory.strip())
+        if path.commonpath([directory, deployment_path]) != deployment_path:
+            continue
+        states[name] = (provider, state)
+    return states
+
+
+def parse_docker_ps(output, slugs):
+    """
+    Parses the output of 'docker ps -a --format "{{.Names}}\t{{.Status}}"'
+    :param slugs: slugs of the VMs to look for
+    :return: dict mapping slugs to states
+    """
+    states = {}
+    for line in output.splitlines():
+        try:
+            name, status = line.split("\t", 1)
+        except ValueError:
+            continue
+        name = _DOCKER_NAME_SUFFIX.sub("", name)
+        # Container names are '<vagrant dir>_<machine name>'
+        slug = next(
+            (name[i + 1:] for i, c in enumerate(name)
+             if c == "_" and name[i + 1:] in slugs),
+            None
+        )
+        if slug is None:
+            continue
+        if status.startswith("Up") and "(Paused)" not in status:
+            states[slug] = STATE_RUNNING
+        else:
+            states[slug] = STATE_STOPPED
+    return states
+
+
+def vagrant_states():
+    output = _run(["vagrant", "global-status"])
+    states = parse_global_status(
+        output, path.normpath(settings.VAGR_DEPLOYMENT_PATH)
+    )
+    states.update(parse_global_status(
+        output, path.normpath(settings.VAGR_INSTANCE_PATH)
+    ))
+    return states
+
+
+def docker_states(slugs):
+    return parse_docker_ps(
+        _run(["docker", "ps", "-a", "--format", "{{.Names}}\t{{.Status}}"]),
+        slugs
+    )
+
+
+def collect_states(vms):
+    """
+    Gets the states of the given VMs. Docker VMs are looked up using
+    one 'docker ps', all others using one 'vagrant global-status'.
+    VMs whose backend could not be queried are left out.
+    :return: dict mapping VM pks to (provider, state) tuples
+    """
+    docker_vms = [vm for vm in vms if vm.provider == DOCKER_PROVIDER]
+    other_vms = [vm for vm in vms if vm.provider != DOCKER_PROVIDER]
+    states = {}
+
+    if docker_vms:
+        try:
+            found = docker_states({vm.deployment_slug for vm in docker_vms})
+        except SweepError as ex:
+            logger.warning("Skipping docker VMs in state sweep: %s", ex)
+        else:
+            for vm in docker_vms:
+                states[vm.pk] = (
+                    DOCKER_PROVIDER,
+                    found.get(vm.deployment_slug, STATE_NOT_CREATED)
+                )
+
+    if other_vms:
+        try:
+            found = vagrant_states()
+        except SweepError as ex:
+            logger.warning("Skipping vagrant VMs in state sweep: %s", ex)
+        else:
+            for vm in other_vms:
+                states[vm.pk] = found.get(
+                    vm.deployment_slug,
+                    (vm.provider, STATE_NOT_CREATED)
+                )
+    return states
+
+
+def _apply(vm, provider, state):
+    """
+    Stores the swept provider and state of vm, unless an action locked
+    the VM or recorded a state since vm was read. Otherwise the newer
+    state would be replaced by the one of the sweep.
+    :return: True if vm was updated
+    """
+    with transaction.atomic():
+        new_state = None
+        state_changed = vm.state_changed
+        if state != vm.current_state:
+            new_state = State.objects.create(vm=vm, name=state)
+            state_changed = new_state.created
+        updated = VirtualMachine.objects.filter(
+            pk=vm.pk, locked=False, state_changed=vm.state_changed
+        ).update(
+            provider=provider,
+            current_state=state,
+            state_changed=state_changed
+        )
+        if not updated and new_state:
+            new_state.delete()
+    return bool(updated)
+
+
+def sweep():
+    """
+    Records the current state of all VMs. A state is only recorded
+    if it differs from the latest one, otherwise the latest one is
+    marked as seen. VMs that are locked are skipped,
+    the running action records their state anyways.
+    :return: number of VMs whose state changed
+    """
+    vms = {
+        vm.pk: vm for vm in VirtualMachine.objects.filter(
+            # Queued instances are not created yet, see instances.py
+            locked=False, queued=None
+        ).select_related(
+            'problem'
+        ).annotate(
+            latest_state_pk=latest_state_subquery('pk')
+        )
+    }
+    seen_states = []
+    changed = 0
+
+    for pk, (provider, state) in collect_states(vms.values()).items():
+        vm = vms[pk]
+        provider = provider or vm.provider
+        if state == vm.current_state and vm.latest_state_pk:
+            seen_states.append(vm.latest_state_pk)
+        if state == vm.current_state and provider == vm.provider:
+            continue
+        if not _apply(vm, provider, state):
+            continue
+        if provider != vm.provider:
+            Problem.invalidate_desc(vm.problem_id)
+        if state != vm.current_state:
+            changed += 1
+
+    State.objects.filter(pk__in=seen_states).update(
+        last_seen=timezone.now()
+    )
+    return changed
@@ -13,61 +13,244 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import logging
+import pickle
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import CalledProcessError
-from time import sleep
 
-from autotask.tasks import delayed_task
+from autotask.tasks import delayed_task, periodic_task
 from django.conf import settings
+from django.db import connection
+from django.utils import timezone
 
-from uptomate import Deployment
-from .models import State, UNKNOWN_HOST
+from . import catalogue
+from . import history
+from . import instances
+from . import snapshots
+from . import sweeper
+from . import warm_pool
+from .models import Problem, Task, VirtualMachine, UNKNOWN_HOST
 
 MSG_SUCCESS = "Finished"
-IN_USE_SLEEP_TIME = 10
+MSG_PARKED = "Parked, VM is in use"
+
+logger = logging.getLogger(__name__)
+
 
 @delayed_task(ttl=settings.TASK_TTL)
-def run_on_vagr(vagr_depl, f, vm_db, callback=None, **kwargs):
+def run_on_vagr(vagr_depl, f, vm_db, callback=None, lock_held=False, **kwargs):
     """
     This runs an action on a vagrant deployment. A action is
     a method defined on vagr_depl. If autotask is active, this
     will be done by a autotask worker.
+    See perform_action for the arguments.
+    """
+    return perform_action(vagr_depl, f, vm_db, callback, lock_held, **kwargs)
+
+
+def perform_action(vagr_depl, f, vm_db, callback=None, lock_held=False, **kwargs):
+    """
+    Runs an action on a vagrant deployment in the current process.
+    In case the VM is in use, the action is parked and dispatched
+    again once the VM is free, instead of waiting for it.
     :param vagr_depl: the vagrant deployment
     :param f: the action to call
     :param vm_db: the VM ORM object
     :param callback: if not None, callback will be called after the action
+    :param lock_held: True if the lock was handed over by the previous action
     :param kwargs: Arguments to call the callback with
     :return:
     """
-    # TODO: Would be better to schedule the other tasks here
-    # instead of waiting for the VM to get free
-    # Wait until VM is free
-    succeed = False
-    while not succeed:
-        succeed = vm_db.lock()
-        sleep(IN_USE_SLEEP_TIME)
-
-    if f != "status":
+    started = timezone.now()
+    spans = {}
+    with _span(spans, "lock"):
+        locked = lock_held or vm_db.lock_or_park(
+            f, pickle.dumps((vagr_depl, f, callback, kwargs))
+        )
+    if not locked:
+        return MSG_PARKED
+
+    address = (vm_db.provider, vm_db.ip_addr)
+    run_start = time.perf_counter()
+    try:
+        with _span(spans, "action"):
+            if f in snapshots.ACTIONS:
+                snapshots.ACTIONS[f](vm_db)
+            elif f != "status":
+                getattr(type(vagr_depl), f)(vagr_depl, **kwargs)
+        if callback:
+            with _span(spans, "callback"):
+                callback(vagr_depl, f, vm_db, **kwargs)
+
+        with _span(spans, "status"):
+            status = vagr_depl.status()
+        vm_db.provider = status.provider
+        vm_db.record_state(status.state)
+
         try:
-            getattr(Deployment.Vagrant, f)(vagr_depl, **kwargs)
-        except BaseException:
-            vm_db.unlock()
-            raise
-    if callback:
-        callback(vagr_depl, f, vm_db, **kwargs)
+            with _span(spans, "address"):
+                vm_db.ip_addr = vagr_depl.service_network_address()
+        except CalledProcessError:
+            # this does not work all the time, e.g. when the command
+            # was 'stop', however, that should never affect the
+            # result of the actual command called
+            vm_db.ip_addr = UNKNOWN_HOST
+    finally:
+        # The instance is spun up, it counts by its state from now on
+        VirtualMachine.objects.filter(
+            pk=vm_db.pk, spinning_up__isnull=False
+        ).update(spinning_up=None)
+        _dispatch_parked(vm_db)
+        if address != (vm_db.provider, vm_db.ip_addr):
+            Problem.invalidate_desc(vm_db.problem_id)
+        spans["run"] = time.perf_counter() - run_start
+        Task.record_spans(vm_db, f, started, spans)
+    return MSG_SUCCESS
 
-    status = vagr_depl.status()
-    vm_db.provider = status.provider
-    vm_db.state_set.add(State(name=status.state), bulk=False)
 
+@contextmanager
+def _span(spans, name):
+    start = time.perf_counter()
     try:
-        vm_db.ip_addr = vagr_depl.service_network_address()
-    except CalledProcessError:
-        # this does not work all the time, e.g. when the command
-        # was 'stop', however, that should never affect the
-        # result of the actual command called
-        vm_db.ip_addr = UNKNOWN_HOST
-    vm_db.unlock()
-    return MSG_SUCCESS
+        yield
+    finally:
+        spans[name] = time.perf_counter() - start
+
+
+def _dispatch_parked(vm_db):
+    """
+    Frees the VM or hands its lock over to the next parked action.
+    Parked actions that can't be dispatched are dropped and the lock
+    goes to the next one, so they never keep the VM locked.
+    """
+    parked = vm_db.release()
+    while parked:
+        try:
+            vagr_depl, f, callback, kwargs = pickle.loads(parked.arguments)
+        except Exception:
+            logger.exception("Could not load parked action %s of %s",
+                             parked.task_name, vm_db.deployment_slug)
+            parked = vm_db.release()
+            continue
+        if not settings.AUTOTASK_IS_ACTIVE:
+            # Runs right away and releases the lock itself
+            run_on_vagr(vagr_depl, f, vm_db, callback, lock_held=True,
+                        **kwargs)
+            return
+        try:
+            t = run_on_vagr(vagr_depl, f, vm_db, callback, lock_held=True,
+                            **kwargs)
+        except Exception:
+            logger.exception("Could not dispatch parked action %s of %s",
+                             parked.task_name, vm_db.deployment_slug)
+            parked = vm_db.release()
+            continue
+        vm_db.add_task(t, parked.task_name)
+        return
+
+
+@delayed_task(ttl=settings.TASK_TTL)
+def run_fleet_action(operation, jobs, callback=None, concurrency=None,
+                     **kwargs):
+    """
+    Runs the action of a fleet operation on many deployments at once.
+    The number of concurrent actions is limited per provider, see
+    settings.FLEET_PROVIDER_CONCURRENCY.
+    :param operation: the FleetOperation ORM object
+    :param jobs: list of (vagr_depl, vm_db) tuples
+    :param callback: if not None, called after the action on each VM
+    :param concurrency: overrides the limit of every provider
+    :param kwargs: arguments of the action
+    :return: summary of the operation
+    """
+    by_provider = {}
+    for vagr_depl, vm_db in jobs:
+        by_provider.setdefault(vm_db.provider, []).append((vagr_depl, vm_db))
+
+    def run(vagr_depl, vm_db):
+        try:
+            result = perform_action(
+                vagr_depl, operation.action, vm_db, callback, **kwargs
+            )
+            operation.record(vm_db, result, parked=result == MSG_PARKED)
+        except Exception as ex:
+            operation.record(vm_db, ex, failed=True)
+        finally:
+            connection.close()
+
+    pools = [
+        ThreadPoolExecutor(
+            max_workers=concurrency or fleet_concurrency(provider)
+        )
+        for provider in by_provider
+    ]
+    for pool, provider_jobs in zip(pools, by_provider.values()):
+        for vagr_depl, vm_db in provider_jobs:
+            pool.submit(run, vagr_depl, vm_db)
+    for pool in pools:
+        pool.shutdown(wait=True)
+
+    operation.refresh_from_db()
+    return str(operation)
+
+
+def fleet_concurrency(provider):
+    return settings.FLEET_PROVIDER_CONCURRENCY.get(
+        provider,
+        settings.FLEET_DEFAULT_CONCURRENCY
+    )
+
+
+@periodic_task(seconds=settings.STATE_SWEEP_INTERVAL, start_now=True)
+def sweep_states():
+    return "{} states changed".format(sweeper.sweep())
+
+
+@delayed_task(ttl=settings.TASK_TTL)
+def sweep_states_now():
+    return "{} states changed".format(sweeper.sweep())
+
+
+@periodic_task(seconds=settings.CATALOGUE_MAX_AGE, start_now=True)
+def refresh_catalogue():
+    return "{} catalogue entries changed".format(catalogue.refresh())
+
+
+@periodic_task(seconds=settings.HISTORY_COMPACT_INTERVAL)
+def compact_history():
+    return history.compact_history()
+
+
+@periodic_task(seconds=settings.WARM_POOL_REFILL_INTERVAL, start_now=True)
+def refill_warm_pool():
+    started, suspended = warm_pool.refill()
+    return "{} started, {} suspended".format(
+        started.total if started else 0,
+        suspended.total if suspended else 0
+    )
+
+
+@periodic_task(seconds=settings.SNAPSHOT_RESET_CHECK_INTERVAL)
+def reset_due_vms():
+    return "{} VMs reset".format(snapshots.reset_due())
+
+
+@periodic_task(seconds=settings.INSTANCE_REAP_INTERVAL)
+def reap_instances():
+    reaped = instances.reap_idle()
+    return "{} reaped, {} spun up".format(reaped, instances.spin_up_queued())
+
+
+@delayed_task(ttl=settings.TASK_TTL)
+def update_download_manifests(problem):
+    """
+    Hashes the downloads of a problem and creates compressed copies.
+    """
+    for download in problem.download_set.all():
+        download.update_manifest()
+    return "{} downloads".format(problem.download_set.count())
 
 
 @delayed_task(ttl=settings.TASK_TTL)
@@ -86,6 +269,13 @@ def destroy_vm_db(vm):
     return MSG_SUCCESS
 
 
+@delayed_task(ttl=settings.TASK_TTL)
+def destroy_instance(vm):
+    vm.destroy_deployment()
+    vm.delete()
+    return MSG_SUCCESS
+
+
 @delayed_task(ttl=settings.TASK_TTL)
 def destroy_problem(problem):
     problem.destroy()
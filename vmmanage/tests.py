@@ -13,6 +13,864 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-# from django.test import TestCase, Client
+import json
+import os
+import pickle
+import tempfile
+from datetime import timedelta
+from unittest import mock
 
-# TODO: Write actual tests
+from autotask import models as task_models
+from autotask.tasks import DelayedTask
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from uptomate import Deployment
+from . import (
+    catalogue,
+    deploy_controller,
+    history,
+    instances,
+    metrics,
+    models,
+    snapshots,
+    sweeper,
+    tasks,
+    warm_pool
+)
+
+
+class QueryCountTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_superuser(
+            "admin", "admin@localhost", "NoGood123"
+        )
+        self.client.force_login(self.user)
+
+    def _create_problems(self, count):
+        offset = models.Problem.objects.count()
+        for i in range(offset, offset + count):
+            slug = "problem{}".format(i)
+            problem = models.Problem.objects.create(
+                slug=slug, name=slug, desc="", category="test", flag=slug
+            )
+            vm = models.VirtualMachine.objects.create(problem=problem)
+            vm.record_state("running")
+            vm.add_task(
+                task_models.TaskQueue.objects.create(
+                    module="vmmanage.tasks",
+                    function="run_on_vagr_delayed"
+                ),
+                "start"
+            )
+
+    def _count_queries(self, url):
+        # Warm up per process caches, e.g. the current site
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx)
+
+    def test_overview_query_count(self):
+        url = reverse('vmmanage_show_problems')
+        self._create_problems(1)
+        queries = self._count_queries(url)
+        self._create_problems(10)
+        self.assertEqual(queries, self._count_queries(url))
+
+    def test_detail_query_count(self):
+        self._create_problems(1)
+        url = reverse('vmmanage_detail_problem', args=["problem0"])
+        queries = self._count_queries(url)
+        vm = models.VirtualMachine.objects.get()
+        for state in ["stopped", "running"] * 10:
+            vm.record_state(state)
+        self.assertEqual(queries, self._count_queries(url))
+
+    def test_current_state_is_maintained(self):
+        self._create_problems(1)
+        vm = models.VirtualMachine.objects.get()
+        vm.record_state("stopped")
+        vm.record_state("stopped")
+        vm.refresh_from_db()
+        self.assertEqual(vm.current_state, "stopped")
+        self.assertEqual(vm.state_changed, vm.state_set.latest().created)
+        self.assertEqual(vm.last_task, vm.task_set.latest())
+        self.assertEqual(vm.state_set.count(), 2)
+
+
+class ProblemCacheTest(TestCase):
+    def setUp(self):
+        self.deployment_path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.deployment_path, "problem"))
+        self.problem = models.Problem.objects.create(
+            slug="problem", name="problem", desc="", category="test"
+        )
+
+    def _write_config(self, config):
+        config_path = os.path.join(self.deployment_path, "problem",
+                                   Deployment.CONFIG_FILE_NAME)
+        with open(config_path, "w") as f:
+            json.dump(config, f)
+
+    def test_config_is_shared_and_refreshed(self):
+        with override_settings(VAGR_DEPLOYMENT_PATH=self.deployment_path):
+            self._write_config({"name": "first"})
+            self.assertEqual(self.problem.get_problem_config()["name"],
+                             "first")
+
+            # A change of the file is seen by every instance
+            self._write_config({"name": "second version"})
+            problem = models.Problem.objects.get()
+            self.assertEqual(problem.get_problem_config()["name"],
+                             "second version")
+
+            problem.invalidate_config()
+            self.assertEqual(problem.get_problem_config()["name"],
+                             "second version")
+
+    def test_desc_cache_key_changes(self):
+        key = models.Problem.desc_cache_keys([self.problem])[self.problem.pk]
+        self.assertEqual(
+            key, models.Problem.desc_cache_keys([self.problem])[self.problem.pk]
+        )
+        models.Problem.invalidate_desc(self.problem.pk)
+        invalidated = models.Problem.desc_cache_keys([self.problem])
+        self.assertNotEqual(key, invalidated[self.problem.pk])
+        self.problem.desc = "changed"
+        changed = models.Problem.desc_cache_keys([self.problem])
+        self.assertNotEqual(invalidated, changed)
+
+
+class DownloadManifestTest(TestCase):
+    def setUp(self):
+        self.deployment_path = tempfile.mkdtemp()
+        self.problem = models.Problem.objects.create(
+            slug="problem", name="problem", desc="", category="test"
+        )
+
+    def _download(self, name, content):
+        file_path = self.problem.get_vagrant().normalize_dl_path(
+            name, absolut=True
+        )
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "wb") as f:
+            f.write(content)
+        download = models.Download.objects.create(
+            slug=name.replace(".", ""), problem=self.problem,
+            path=self.problem.get_vagrant().normalize_dl_path(name)
+        )
+        return download, file_path
+
+    @override_settings(DOWNLOAD_GZIP_MIN_SIZE=0)
+    def test_manifest(self):
+        with override_settings(VAGR_DEPLOYMENT_PATH=self.deployment_path,
+                               DOWNLOAD_GZIP_PATH=self.deployment_path):
+            download, file_path = self._download("a.txt", b"a" * 1000)
+            download.update_manifest()
+            self.assertEqual(download.size, 1000)
+            self.assertEqual(len(download.sha256), 64)
+            self.assertTrue(os.path.exists(download.gzip_path))
+            self.assertTrue(download.matches_manifest(os.stat(file_path)))
+
+            with open(file_path, "ab") as f:
+                f.write(b"changed")
+            self.assertFalse(download.matches_manifest(os.stat(file_path)))
+
+            link, link_path = self._download("link.txt", b"")
+            os.remove(link_path)
+            os.symlink(file_path, link_path)
+            link.update_manifest()
+            self.assertEqual((link.file_path, link.size), ("", None))
+
+
+class CatalogueTest(TestCase):
+    def setUp(self):
+        self.deployment_path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.deployment_path, "problem"))
+        self.config_path = os.path.join(self.deployment_path, "problem",
+                                        Deployment.CONFIG_FILE_NAME)
+
+    def _refresh(self, mtime):
+        os.utime(self.config_path, (mtime, mtime))
+        with override_settings(VAGR_DEPLOYMENT_PATH=self.deployment_path):
+            catalogue.refresh()
+        return models.CatalogueEntry.objects.get(slug="problem")
+
+    def test_read_error_is_cleared(self):
+        with open(self.config_path, "w") as f:
+            f.write("{}")
+        error = self._refresh(1).error
+        with mock.patch.object(catalogue, "_scan_entry",
+                               side_effect=OSError("unreadable")):
+            self.assertIn("unreadable", self._refresh(2).error)
+        self.assertEqual(self._refresh(3).error, error)
+
+
+class BulkInstallTest(TestCase):
+    def setUp(self):
+        self.deployment_path = tempfile.mkdtemp()
+        models.Problem.objects.create(
+            slug="installed", name="installed", desc="", category="test"
+        )
+
+    def test_nothing_installed_on_error(self):
+        with override_settings(VAGR_DEPLOYMENT_PATH=self.deployment_path):
+            with self.assertRaises(deploy_controller.BulkInstallError) as ctx:
+                deploy_controller.create_problems(
+                    ["installed", "missing"], "vagrant_file"
+                )
+        self.assertEqual(set(ctx.exception.errors), {"installed", "missing"})
+        self.assertEqual(models.Problem.objects.count(), 1)
+        self.assertFalse(models.FleetOperation.objects.exists())
+
+    def test_bulk_install_view_shows_errors(self):
+        user = User.objects.create_superuser(
+            "admin", "admin@localhost", "NoGood123"
+        )
+        self.client.force_login(user)
+        response = self.client.post(
+            reverse('vmmanage_install_problems'),
+            {"problems": ["missing"], "vagrant_file": "vagrant_file"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(models.FleetOperation.objects.exists())
+        operation = models.FleetOperation.objects.create(
+            action="install", total=2
+        )
+        models.FleetResult.objects.create(
+            operation=operation, slug="installed",
+            outcome=models.FLEET_SUCCEEDED, message="no VM needed"
+        )
+        response = self.client.get(
+            reverse('vmmanage_show_fleet_operation', args=[operation.pk])
+        )
+        self.assertContains(response, "no VM needed")
+        self.assertContains(response, "location.reload")
+        response = self.client.get(reverse('vmmanage_show_fleet'))
+        self.assertContains(response, "installed: no VM needed")
+        self.assertContains(response, "1 / 2")
+
+
+@override_settings(PORT_RANGES={"docker": (2000, 2009),
+                                 "default": (3000, 3009)})
+class PortPoolTest(TestCase):
+    def setUp(self):
+        problem = models.Problem.objects.create(
+            slug="web", name="web", desc="", category="test"
+        )
+        self.vm = models.VirtualMachine.objects.create(problem=problem)
+
+    def _free(self, pool):
+        return list(pool.freeportrange_set.values_list('start', 'end'))
+
+    def test_allocate(self):
+        pool = models.PortPool.get_for_update("docker")
+        self.assertEqual(self._free(pool), [(2000, 2009)])
+        self.assertEqual(pool.allocate(3), [2000, 2001, 2002])
+        pool.reserve(2005)
+        self.assertEqual(pool.allocate(3), [2003, 2004, 2006])
+        self.assertEqual(pool.free_count, 3)
+        with self.assertRaises(models.PortPoolExhausted):
+            pool.allocate(4)
+
+    def test_reserve_splits_ranges(self):
+        pool = models.PortPool.get_for_update("docker")
+        self.assertTrue(pool.reserve(2000))
+        self.assertTrue(pool.reserve(2009))
+        self.assertTrue(pool.reserve(2004))
+        self.assertEqual(self._free(pool), [(2001, 2003), (2005, 2008)])
+        self.assertFalse(pool.reserve(2004))
+        self.assertFalse(pool.reserve(1999))
+        for port in [2001, 2002, 2003]:
+            self.assertTrue(pool.reserve(port))
+        self.assertEqual(self._free(pool), [(2005, 2008)])
+
+    def test_release_merges_ranges(self):
+        pool = models.PortPool.get_for_update("docker")
+        pool.allocate(10)
+        pool.release(2004)
+        self.assertEqual(self._free(pool), [(2004, 2004)])
+        pool.release(2006)
+        pool.release(2005)
+        self.assertEqual(self._free(pool), [(2004, 2006)])
+        pool.release(2003)
+        pool.release(2007)
+        self.assertEqual(self._free(pool), [(2003, 2007)])
+        pool.release(2005)
+        pool.release(1999)
+        self.assertEqual(self._free(pool), [(2003, 2007)])
+
+    def test_rebuild(self):
+        for host_port in [2000, 2005, 2006, 3000]:
+            models.Port.objects.create(
+                vm=self.vm, guest_port=80, host_port=host_port
+            )
+        pool = models.PortPool.get_for_update("docker")
+        self.assertEqual(self._free(pool), [(2001, 2004), (2007, 2009)])
+        with override_settings(PORT_RANGES={"docker": (2004, 2012)}):
+            pool = models.PortPool.get_for_update("docker")
+        self.assertEqual(self._free(pool), [(2004, 2004), (2007, 2012)])
+
+    def test_assign_ports(self):
+        ports = self.vm.assign_ports([
+            {'host': 2005, 'guest': 22, 'desc': "ssh"},
+            {'host': None, 'guest': 80, 'desc': "web"},
+        ], "docker")
+        self.assertEqual([p['host'] for p in ports], [2005, 2000])
+        pool = models.PortPool.get_for_update("docker")
+        self.assertEqual(self._free(pool), [(2001, 2004), (2006, 2009)])
+
+        self.vm.port_set.filter(host_port=2005).delete()
+        self.assertEqual(self._free(pool), [(2001, 2009)])
+
+    def test_assign_used_port(self):
+        self.vm.assign_ports([{'host': 2005, 'guest': 22, 'desc': ""}],
+                             "docker")
+        # Fixed ports are checked in the pool they belong to
+        for provider in ["docker", "virtualbox"]:
+            with self.assertRaises(models.PortInUse):
+                self.vm.assign_ports(
+                    [{'host': 2005, 'guest': 80, 'desc': ""}], provider
+                )
+        self.assertEqual(self.vm.port_set.count(), 1)
+
+
+class FleetActionTest(TestCase):
+    def setUp(self):
+        self.vms = []
+        for slug in ["one", "two"]:
+            problem = models.Problem.objects.create(
+                slug=slug, name=slug, desc="", category="test"
+            )
+            self.vms.append(
+                models.VirtualMachine.objects.create(problem=problem)
+            )
+
+    def test_fleet_action_links_last_task(self):
+        queued = task_models.TaskQueue.objects.create(
+            module="vmmanage.tasks", function="run_fleet_action"
+        )
+        with mock.patch.object(tasks, "run_fleet_action",
+                               return_value=DelayedTask(queued.pk)):
+            operation = deploy_controller.run_fleet_action("start", self.vms)
+        self.assertEqual(operation.task_id, queued.pk)
+        for vm in self.vms:
+            vm.refresh_from_db()
+            self.assertIsNotNone(vm.last_task)
+            self.assertEqual(vm.last_task.task_id, queued.pk)
+            self.assertEqual(vm.last_task.task_name, "start")
+
+
+class WarmPoolTest(TestCase):
+    def setUp(self):
+        self.vms = {}
+        for slug, keep_warm in [("warm", True), ("cold", False)]:
+            problem = models.Problem.objects.create(
+                slug=slug, name=slug, desc="", category="test", flag=slug,
+                keep_warm=keep_warm
+            )
+            self.vms[slug] = models.VirtualMachine.objects.create(
+                problem=problem
+            )
+
+    @override_settings(WARM_POOL_SIZE=1)
+    def test_pool_members(self):
+        self.assertEqual(warm_pool.pool_vms(), [self.vms["warm"]])
+        pool, others = warm_pool.split_pool(self.vms.values())
+        self.assertEqual((pool, others), ([self.vms["warm"]], [self.vms["cold"]]))
+
+        self.vms["warm"].record_state("saved")
+        self.assertEqual(
+            warm_pool.stats(),
+            {'size': 1, 'members': 1, 'ready': 1, 'warming': 0}
+        )
+
+    @override_settings(WARM_POOL_SIZE=1)
+    def test_refill_suspends_after_start(self):
+        warm = self.vms["warm"]
+        with mock.patch.object(deploy_controller, "run_fleet_action") as run:
+            warm_pool.refill()
+        # The suspend is part of the start, not a task of its own
+        run.assert_called_once_with(
+            'start', [warm], callback=warm_pool.suspend_after_start
+        )
+
+        vagr = mock.Mock()
+        warm_pool.suspend_after_start(vagr, 'start', warm)
+        vagr.suspend.assert_called_once_with()
+
+        warm.record_state("running")
+        with mock.patch.object(deploy_controller, "run_fleet_action") as run:
+            warm_pool.refill()
+        run.assert_called_once_with('suspend', [warm])
+
+    @override_settings(WARM_POOL_SIZE=0)
+    def test_pool_size(self):
+        self.assertEqual(warm_pool.pool_vms(), [])
+
+
+class InstanceTest(TestCase):
+    def setUp(self):
+        self.deployment_path = tempfile.mkdtemp()
+        self.instance_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.deployment_path, "web"))
+        self.problem = models.Problem.objects.create(
+            slug="web", name="web", desc="{HOST}:{PORT_80}", category="test",
+            flag="web", instance_per_user=True
+        )
+        self.problem.assign_vm([{'guest': 80, 'host': None, 'desc': "web"}])
+        self.users = [
+            User.objects.create_user("user{}".format(i), password="NoGood123")
+            for i in range(2)
+        ]
+
+    def test_instances_are_queued_and_reaped(self):
+        with override_settings(VAGR_DEPLOYMENT_PATH=self.deployment_path,
+                               VAGR_INSTANCE_PATH=self.instance_path,
+                               INSTANCE_CAPACITY=1,
+                               SNAPSHOT_AFTER_INSTALL=False,
+                               INSTANCE_IDLE_ACTION="destroy"):
+            first = instances.request_instance(self.problem, self.users[0])
+            second = instances.request_instance(self.problem, self.users[1])
+            first.refresh_from_db()
+            second.refresh_from_db()
+            self.assertTrue(first.is_running)
+            self.assertIsNone(first.spinning_up)
+            self.assertIsNotNone(second.queued)
+            self.assertFalse(second.state_set.exists())
+            self.assertTrue(os.path.isdir(
+                os.path.join(self.instance_path, first.deployment_slug)
+            ))
+
+            ports = {vm.port_set.get().host_port
+                     for vm in [self.problem.vm, first, second]}
+            self.assertEqual(len(ports), 3)
+            self.assertEqual(self.problem.vm.owner, None)
+
+            models.VirtualMachine.objects.filter(pk=first.pk).update(
+                last_used=first.last_used - timedelta(days=1)
+            )
+            self.assertEqual(instances.reap_idle(), 1)
+            self.assertEqual(instances.spin_up_queued(), 1)
+            self.assertFalse(
+                models.VirtualMachine.objects.filter(pk=first.pk).exists()
+            )
+            second.refresh_from_db()
+            self.assertTrue(second.is_running)
+
+
+    @override_settings(INSTANCE_CAPACITY=1)
+    def test_failed_spin_up_frees_capacity(self):
+        vms = [
+            models.VirtualMachine.objects.create(
+                problem=self.problem, owner=user,
+                queued=timezone.now() + timedelta(seconds=i)
+            )
+            for i, user in enumerate(self.users)
+        ]
+        with mock.patch.object(instances, "_spin_up", side_effect=OSError):
+            with self.assertLogs('vmmanage.instances', 'ERROR'):
+                self.assertEqual(instances.spin_up_queued(), 1)
+        vms[0].refresh_from_db()
+        self.assertIsNone(vms[0].queued)
+        self.assertIsNone(vms[0].spinning_up)
+        self.assertEqual(vms[0].current_state, "not_created")
+        self.assertFalse(instances.active_instances().exists())
+
+        with mock.patch.object(instances, "_spin_up") as spin_up:
+            self.assertEqual(instances.spin_up_queued(), 1)
+        spin_up.assert_called_once_with(vms[1])
+        vms[1].refresh_from_db()
+        self.assertIsNotNone(vms[1].spinning_up)
+        self.assertFalse(vms[1].state_set.exists())
+        self.assertEqual(list(instances.active_instances()), [vms[1]])
+        self.assertEqual(instances.spin_up_queued(), 0)
+
+    @override_settings(INSTANCE_IDLE_ACTION="destroy")
+    def test_destroy_is_queued_once(self):
+        vm = models.VirtualMachine.objects.create(
+            problem=self.problem, owner=self.users[0],
+            last_used=timezone.now() - timedelta(days=1)
+        )
+        vm.add_task(
+            task_models.TaskQueue.objects.create(
+                module="vmmanage.tasks", function="destroy_instance",
+                status=task_models.WAITING
+            ),
+            instances.DESTROY_TASK_NAME
+        )
+        with mock.patch.object(tasks, "destroy_instance") as destroy:
+            self.assertEqual(instances.reap_idle(), 0)
+        destroy.assert_not_called()
+
+
+class SnapshotTest(TestCase):
+    def test_due_for_reset(self):
+        problem = models.Problem.objects.create(
+            slug="web", name="web", desc="", category="test", flag="web",
+            reset_interval=60
+        )
+        vm = models.VirtualMachine.objects.create(problem=problem)
+        vm.record_state("running")
+        self.assertEqual(snapshots.due_for_reset(), [])
+
+        models.VirtualMachine.objects.filter(pk=vm.pk).update(
+            state_changed=vm.state_changed - timedelta(minutes=2)
+        )
+        self.assertEqual(snapshots.due_for_reset(), [vm])
+
+        models.VirtualMachine.objects.filter(pk=vm.pk).update(
+            last_reset=vm.state_changed
+        )
+        self.assertEqual(snapshots.due_for_reset(), [])
+
+    def test_pending_reset_is_not_due(self):
+        problem = models.Problem.objects.create(
+            slug="web", name="web", desc="", category="test", flag="web",
+            reset_interval=60
+        )
+        vm = models.VirtualMachine.objects.create(problem=problem)
+        vm.record_state("running")
+        models.VirtualMachine.objects.filter(pk=vm.pk).update(
+            state_changed=vm.state_changed - timedelta(minutes=2)
+        )
+
+        # A reset that takes longer than the check interval
+        vm.lock()
+        self.assertEqual(snapshots.due_for_reset(), [])
+        vm.unlock()
+        models.ParkedAction.objects.create(
+            vm=vm, task_name="reset", arguments=b""
+        )
+        self.assertEqual(snapshots.due_for_reset(), [])
+
+        models.ParkedAction.objects.all().delete()
+        queued = task_models.TaskQueue.objects.create(
+            module="vmmanage.tasks", function="run_fleet_action"
+        )
+        vm.add_task(queued, "reset")
+        self.assertEqual(snapshots.due_for_reset(), [])
+
+        queued.status = task_models.DONE
+        queued.save()
+        self.assertEqual(snapshots.due_for_reset(), [vm])
+
+
+@override_settings(VAGR_DEPLOYMENT_PATH=tempfile.mkdtemp())
+class SnapshotCommandTest(TestCase):
+    def setUp(self):
+        problem = models.Problem.objects.create(
+            slug="web", name="web", desc="", category="test", flag="web"
+        )
+        self.vm = models.VirtualMachine.objects.create(
+            problem=problem, provider="virtualbox"
+        )
+        self.vagrant_dir = os.path.join(self.vm.deployment_dir, "vagrant")
+        os.makedirs(self.vagrant_dir, exist_ok=True)
+        open(os.path.join(self.vagrant_dir, "Vagrantfile"), "w").close()
+
+    def _commands(self, function):
+        with mock.patch.object(snapshots, "check_output") as check_output:
+            function(self.vm)
+        for args, kwargs in check_output.call_args_list:
+            self.assertEqual(kwargs['cwd'], self.vagrant_dir)
+        return [args[0][1:] for args, _ in check_output.call_args_list]
+
+    def test_take(self):
+        self.assertEqual(self._commands(snapshots.take), [
+            ["snapshot", "save", "--force", snapshots.SNAPSHOT_NAME]
+        ])
+
+    def test_restore(self):
+        self.assertEqual(self._commands(snapshots.restore), [
+            ["snapshot", "restore", "--no-provision", snapshots.SNAPSHOT_NAME]
+        ])
+        self.vm.refresh_from_db()
+        self.assertIsNotNone(self.vm.last_reset)
+
+        self.vm.provider = snapshots.DOCKER_PROVIDER
+        self.assertEqual(self._commands(snapshots.take), [])
+        self.assertEqual(self._commands(snapshots.restore), [
+            ["destroy", "--force"], ["up"]
+        ])
+
+    def test_not_installed(self):
+        os.remove(os.path.join(self.vagrant_dir, "Vagrantfile"))
+        with self.assertRaises(snapshots.SnapshotError):
+            snapshots.take(self.vm)
+
+
+class ParkedActionTest(TestCase):
+    def setUp(self):
+        problem = models.Problem.objects.create(
+            slug="web", name="web", desc="", category="test", flag="web"
+        )
+        self.vm = models.VirtualMachine.objects.create(problem=problem)
+        self.vm.lock()
+
+    def _park(self, arguments):
+        models.ParkedAction.objects.create(
+            vm=self.vm, task_name="start", arguments=arguments
+        )
+
+    def test_broken_action_unlocks(self):
+        self._park(b"broken")
+        with self.assertLogs('vmmanage.tasks', 'ERROR'):
+            tasks._dispatch_parked(self.vm)
+        self.vm.refresh_from_db()
+        self.assertFalse(self.vm.locked)
+        self.assertFalse(self.vm.parkedaction_set.exists())
+
+    @override_settings(AUTOTASK_IS_ACTIVE=True)
+    def test_failed_dispatch_hands_over(self):
+        arguments = pickle.dumps((self.vm.get_vagrant(), "start", None, {}))
+        self._park(arguments)
+        self._park(arguments)
+        with mock.patch.object(tasks, "run_on_vagr",
+                               side_effect=[OSError, mock.DEFAULT]) as run:
+            run.return_value = task_models.TaskQueue.objects.create(
+                module="vmmanage.tasks", function="run_on_vagr"
+            )
+            with self.assertLogs('vmmanage.tasks', 'ERROR'):
+                tasks._dispatch_parked(self.vm)
+        self.assertEqual(run.call_count, 2)
+        self.vm.refresh_from_db()
+        # The second action owns the lock now
+        self.assertTrue(self.vm.locked)
+        self.assertEqual(self.vm.last_task.task_name, "start")
+
+    def test_parked_fleet_result_is_not_a_success(self):
+        operation = models.FleetOperation.objects.create(
+            action="start", total=1
+        )
+        operation.record(self.vm, tasks.MSG_PARKED, parked=True)
+        self.assertEqual(operation.succeeded, 0)
+        self.assertEqual(operation.parked, 1)
+        self.assertTrue(operation.is_done)
+        self.assertEqual(
+            [(r.slug, r.message, r.outcome) for r in operation.results],
+            [("web", tasks.MSG_PARKED, models.FLEET_PARKED)]
+        )
+
+    def test_fleet_results_keep_messages(self):
+        operation = models.FleetOperation.objects.create(
+            action="start", total=2
+        )
+        message = "Could not run 'vagrant up': exit 1\nweb: failed"
+        operation.record(self.vm, OSError(message), failed=True)
+        operation.record(self.vm, "done: running")
+        self.assertEqual(
+            [(r.slug, r.message, r.outcome) for r in operation.results],
+            [("web", message, models.FLEET_FAILED),
+             ("web", "done: running", models.FLEET_SUCCEEDED)]
+        )
+        self.assertEqual(operation.counts, {
+            models.FLEET_SUCCEEDED: 1,
+            models.FLEET_FAILED: 1,
+            models.FLEET_PARKED: 0
+        })
+
+
+class HistoryTest(TestCase):
+    def setUp(self):
+        problem = models.Problem.objects.create(
+            slug="web", name="web", desc="", category="test"
+        )
+        self.vm = models.VirtualMachine.objects.create(problem=problem)
+        # A VM without any state must not keep others from being purged
+        models.VirtualMachine.objects.create(problem=problem)
+
+    def _state(self, name, days_ago, last_seen_days_ago=None):
+        now = timezone.now()
+        state = models.State.objects.create(vm=self.vm, name=name)
+        last_seen = None
+        if last_seen_days_ago is not None:
+            last_seen = now - timedelta(days=last_seen_days_ago)
+        models.State.objects.filter(pk=state.pk).update(
+            created=now - timedelta(days=days_ago), last_seen=last_seen
+        )
+        return state
+
+    def test_compact_states(self):
+        first = self._state("running", 5)
+        self._state("running", 4, 3)
+        self._state("stopped", 2)
+        self.assertEqual(history.compact_states(self.vm), 1)
+        states = list(self.vm.state_set.order_by('created'))
+        self.assertEqual([s.name for s in states], ["running", "stopped"])
+        self.assertEqual(states[0].pk, first.pk)
+        self.assertEqual(states[0].last_seen.date(),
+                         (timezone.now() - timedelta(days=3)).date())
+        self.assertEqual(history.compact_states(self.vm), 0)
+
+    def test_purge_states_keeps_latest(self):
+        self._state("running", 10)
+        latest = self._state("stopped", 9)
+        self.assertEqual(history.purge_states(timedelta(days=1)), 1)
+        self.assertEqual(list(models.State.objects.all()), [latest])
+
+    def test_purge_states_keeps_recent(self):
+        self._state("running", 10, 0)
+        self._state("stopped", 0)
+        self.assertEqual(history.purge_states(timedelta(days=1)), 0)
+
+    def test_purge_tasks(self):
+        for status in [task_models.DONE, task_models.WAITING]:
+            queued = task_models.TaskQueue.objects.create(
+                module="vmmanage.tasks", function="run_on_vagr",
+                status=status
+            )
+            self.vm.add_task(queued, "start")
+        models.Task.objects.update(
+            creation_date=timezone.now() - timedelta(days=10)
+        )
+        self.assertEqual(history.purge_tasks(timedelta(days=1)), 1)
+        self.assertEqual(
+            list(models.Task.objects.values_list('task__status', flat=True)),
+            [task_models.WAITING]
+        )
+
+    def test_fill_current_states(self):
+        self._state("running", 2)
+        self._state("stopped", 1)
+        models.VirtualMachine.objects.update(current_state="")
+        self.assertEqual(history.fill_current_states(), 1)
+        self.vm.refresh_from_db()
+        self.assertEqual(self.vm.current_state, "stopped")
+        self.assertEqual(self.vm.state_changed,
+                         self.vm.state_set.latest().created)
+
+
+GLOBAL_STATUS = """\
+id       name   provider   state    directory
+------------------------------------------------------------------------
+1a2b3c4  web    virtualbox running  /srv/berlyne/problems/web/web
+5d6e7f8  other  virtualbox poweroff /home/user/other
+9a8b7c6  pwn-3  docker     stopped  /srv/berlyne/instances/pwn-3/pwn-3
+
+The above shows information about all known Vagrant environments
+on this machine. This data is cached and may not be completely
+up-to-date (use "vagrant global-status --prune" to prune invalid
+entries). To interact with any of the machines, you can go to that
+directory and run Vagrant, or you can use the ID directly with
+Vagrant commands from any directory. For example:
+"vagrant destroy 1a2b3c4"
+"""
+
+DOCKER_PS = """\
+web_web_1577836800\tUp 2 hours
+pwn_pwn\tExited (0) 3 days ago
+crypto_crypto_1577836800\tUp 5 minutes (Paused)
+unrelated\tUp 1 hour
+"""
+
+
+class SweeperTest(TestCase):
+    def test_parse_global_status(self):
+        self.assertEqual(
+            sweeper.parse_global_status(GLOBAL_STATUS,
+                                        "/srv/berlyne/problems"),
+            {"web": ("virtualbox", "running")}
+        )
+        self.assertEqual(
+            sweeper.parse_global_status(GLOBAL_STATUS,
+                                        "/srv/berlyne/instances"),
+            {"pwn-3": ("docker", "stopped")}
+        )
+
+    def test_parse_docker_ps(self):
+        self.assertEqual(
+            sweeper.parse_docker_ps(DOCKER_PS,
+                                    {"web", "pwn", "crypto", "misc"}),
+            {
+                "web": sweeper.STATE_RUNNING,
+                "pwn": sweeper.STATE_STOPPED,
+                "crypto": sweeper.STATE_STOPPED
+            }
+        )
+
+    def test_sweep(self):
+        problem = models.Problem.objects.create(
+            slug="web", name="web", desc="", category="test"
+        )
+        vm = models.VirtualMachine.objects.create(
+            problem=problem, provider="virtualbox"
+        )
+        vm.record_state("running")
+        found = {vm.pk: ("virtualbox", "running")}
+        with mock.patch.object(sweeper, "collect_states", return_value=found):
+            self.assertEqual(sweeper.sweep(), 0)
+        self.assertIsNotNone(vm.state_set.get().last_seen)
+
+        found = {vm.pk: ("virtualbox", "poweroff")}
+        with mock.patch.object(sweeper, "collect_states", return_value=found):
+            self.assertEqual(sweeper.sweep(), 1)
+        vm.refresh_from_db()
+        self.assertEqual(vm.current_state, "poweroff")
+        self.assertEqual(vm.state_changed, vm.state_set.latest().created)
+
+    def test_sweep_keeps_newer_state(self):
+        problem = models.Problem.objects.create(
+            slug="web", name="web", desc="", category="test"
+        )
+        vm = models.VirtualMachine.objects.create(problem=problem)
+        vm.record_state("poweroff")
+
+        def collect_states(vms):
+            # An action starts the VM while the backends are queried
+            models.VirtualMachine.objects.get(pk=vm.pk).record_state(
+                "running"
+            )
+            return {vm.pk: ("virtualbox", "poweroff")}
+
+        with mock.patch.object(sweeper, "collect_states", collect_states):
+            self.assertEqual(sweeper.sweep(), 0)
+        vm.refresh_from_db()
+        self.assertEqual(vm.current_state, "running")
+        self.assertEqual(vm.provider, "")
+        self.assertEqual(
+            list(vm.state_set.values_list('name', flat=True)),
+            ["running", "poweroff"]
+        )
+
+
+class TaskMetricsTest(TestCase):
+    def test_spans_are_recorded(self):
+        problem = models.Problem.objects.create(
+            slug="web", name="web", desc="", category="test", flag="web"
+        )
+        vm = models.VirtualMachine.objects.create(problem=problem)
+        vm.add_task(
+            task_models.TaskQueue.objects.create(
+                module="vmmanage.tasks",
+                function="run_on_vagr",
+                status=task_models.RUNNING
+            ),
+            "start"
+        )
+        tasks.perform_action(vm.get_vagrant(), "start", vm)
+
+        task = models.Task.objects.get(virtual_machine=vm)
+        self.assertEqual(task.provider, "docker")
+        for span in models.TASK_SPANS:
+            if span != "callback":
+                self.assertIsNotNone(getattr(task, span + "_time"), span)
+        self.assertEqual(metrics.action_percentiles()[0]['count'], 1)
+        self.assertEqual(metrics.queue_depth()['running'], 1)
+        self.assertIn(('start', 'docker', 'run'), {
+            (s[0]['action'], s[0]['provider'], s[0]['span'])
+            for s in metrics.collect()[2][3]
+        })
+
+        user = User.objects.create_superuser(
+            "admin", "admin@localhost", "NoGood123"
+        )
+        self.client.force_login(user)
+        response = self.client.get(reverse('vmmanage_task_dashboard'))
+        self.assertContains(response, "web")
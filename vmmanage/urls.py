@@ -21,13 +21,20 @@ urlpatterns = [
     url(r"^problem/", include([
         url(r'^install/$', views.show_installable_problems, name="vmmanage_show_installable"),
         url(r'^install_problem/$', views.install_problem, name="vmmanage_install_problem"),
+        url(r'^install_problems/$', views.install_problems, name="vmmanage_install_problems"),
         url(r'^problem/(?P<problem_slug>[\w-]+)/', include([
             url(r'^$', views.problem_detail, name="vmmanage_detail_problem"),
             url(r'^action/(?P<action_name>[\w-]+)$',
                 views.perform_action, name="vmmanage_perform_action"),
             url(r'destroy/$', views.problem_destroy, name='vmmanage_problem_destroy'),
             url(r'^edit/$', views.edit_problem, name="vmmanage_edit_problem"),
+            url(r'^history/(?P<kind>states|tasks)/$',
+                views.problem_history, name="vmmanage_problem_history"),
         ])),
     ])),
     url(r'problems/$', views.problem_overview, name="vmmanage_show_problems"),
+    url(r'fleet/$', views.fleet_overview, name="vmmanage_show_fleet"),
+    url(r'tasks/$', views.task_dashboard, name="vmmanage_task_dashboard"),
+    url(r'fleet/(?P<operation_pk>\d+)/$', views.fleet_operation,
+        name="vmmanage_show_fleet_operation"),
 ]
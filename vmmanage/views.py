@@ -15,20 +15,23 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from django.conf import settings
 from django.contrib.auth.decorators import permission_required
+from django.core.paginator import Paginator
 from django.db import IntegrityError
+from django.db.models import Prefetch
 from django.http import HttpResponseNotAllowed
 from django.shortcuts import get_object_or_404, render, redirect
 from django.urls import reverse
 from django.utils.translation import ugettext_lazy as _
 
 import vmmanage.models
-from uptomate.Deployment import (
-    VAGRANT_RUNNING_STATES,
-    VAGRANT_STOPPED_STATES
-)
+from uptomate.Deployment import VAGRANT_RUNNING_STATES
+from . import catalogue
 from . import deploy_controller
 from . import forms
+from . import metrics
 from . import models
+from . import tasks
+from . import warm_pool
 
 _INSTALL_MSGS = {
     'formerror': _("The submitted form was invalid!"),
@@ -38,46 +41,52 @@ _INSTALL_MSGS = {
     'exists': _("A problem with that slug is already installed!")
 }
 
+FLEET_OVERVIEW_LEN = 50
+DETAIL_HISTORY_LEN = 10
+HISTORY_PAGE_LEN = 50
+
 
 def start_used_vms(vms=None):
-    deploy_controller.vm_action_on_states(settings.DEFAULT_USED_ACTION, VAGRANT_STOPPED_STATES, vms)
+    if vms is None:
+        vms = models.VirtualMachine.objects.all()
+    return warm_pool.start_vms(
+        vms.filter(owner=None).select_related('problem')
+    )
 
 
 def stop_unused_vms(vms):
     # Check if really unused
-    unused_vms = []
-    for vm in vms:
-        if not vm.problem.courseproblems_set.exists():
-            unused_vms.append(vm)
-    if unused_vms:
-        deploy_controller.vm_action_on_states(settings.DEFAULT_UNUSED_ACTION, VAGRANT_RUNNING_STATES, unused_vms)
+    unused_vms = models.VirtualMachine.objects.filter(
+        pk__in=[vm.pk for vm in vms],
+        owner=None,
+        problem__courseproblems__isnull=True
+    ).select_related('problem')
+    # VMs of the warm pool are suspended instead, so they are quick to resume
+    pool_vms, other_vms = warm_pool.split_pool(unused_vms)
+    if pool_vms:
+        warm_pool.refill(pool_vms)
+    return deploy_controller.vm_action_on_states(settings.DEFAULT_UNUSED_ACTION, VAGRANT_RUNNING_STATES, other_vms)
 
 
 def stop_unused_problems(problems):
-    vms = []
-    for problem in problems:
-        if problem.vm:
-            vms.append(problem.vm)
-    stop_unused_vms(vms)
+    return stop_unused_vms(
+        models.VirtualMachine.objects.filter(problem__in=problems)
+    )
 
 
 def _run_task_on_existing_vm(action, problem_slug, **kwargs):
-    vm = get_object_or_404(models.VirtualMachine, problem__slug=problem_slug)
+    vm = get_object_or_404(models.VirtualMachine, problem__slug=problem_slug,
+                           owner=None)
     return deploy_controller.run_on_existing(action, vm, **kwargs)
 
 
 
 # TODO: Make nicer, enhance usability in case of F-5s and get param
-@permission_required("can_manage_vm")
-def show_installable_problems(request):
+def _render_installable(request, msgs, bulk_form=None):
     problems = deploy_controller.find_installable_problems()
-    msgs = []
     if not problems:
         msgs.append(_("No problems are available for installation"))
-
-    _msg = request.GET.get("m", "")
-    if _msg:
-        msgs.append(_INSTALL_MSGS[_msg])
+    valid_slugs = [p.slug for p in problems if p.is_valid]
 
     return render(
         request,
@@ -87,11 +96,57 @@ def show_installable_problems(request):
             "vagrant_form": forms.VagrantFilesForm(
                 initial={'vagrant_file': settings.VAGR_DEFAULT_VAGR_FILE}
             ),
+            "bulk_form": bulk_form or forms.BulkInstallForm(
+                problem_slugs=valid_slugs,
+                initial={'vagrant_file': settings.VAGR_DEFAULT_VAGR_FILE}
+            ),
             "errors": msgs,
         }
     )
 
 
+@permission_required("can_manage_vm")
+def show_installable_problems(request):
+    if request.POST.get("refresh"):
+        catalogue.refresh()
+        return redirect('vmmanage_show_installable')
+    msgs = []
+
+    _msg = request.GET.get("m", "")
+    if _msg:
+        msgs.append(_INSTALL_MSGS[_msg])
+
+    return _render_installable(request, msgs)
+
+
+@permission_required("can_manage_vm")
+def install_problems(request):
+    if not request.POST:
+        return redirect('vmmanage_show_installable')
+    form = forms.BulkInstallForm(
+        request.POST,
+        problem_slugs=[
+            p.slug for p in deploy_controller.find_installable_problems()
+            if p.is_valid
+        ]
+    )
+    if not form.is_valid():
+        return _render_installable(request, [_INSTALL_MSGS['formerror']], form)
+    try:
+        operation = deploy_controller.create_problems(
+            form.cleaned_data['problems'],
+            form.cleaned_data['vagrant_file'],
+            form.cleaned_data['concurrency']
+        )
+    except deploy_controller.BulkInstallError as ex:
+        return _render_installable(
+            request,
+            ["{}: {}".format(k, v) for k, v in ex.errors.items()],
+            form
+        )
+    return redirect('vmmanage_show_fleet_operation', operation_pk=operation.pk)
+
+
 @permission_required("can_manage_vm")
 def problem_destroy(request, problem_slug):
     problem = get_object_or_404(models.Problem, slug=problem_slug)
@@ -132,11 +187,66 @@ def install_problem(request):
 
 @permission_required("can_manage_vm")
 def problem_overview(request):
+    if request.POST.get("sweep"):
+        tasks.sweep_states_now()
+        return redirect('vmmanage_show_problems')
     return render(
         request,
         "vms/overview.html",
         {
-            "problems": models.Problem.objects.all()
+            "problems": models.Problem.objects.prefetch_related(
+                Prefetch(
+                    'virtualmachine_set',
+                    queryset=models.VirtualMachine.objects.select_related(
+                        'last_task__task'
+                    )
+                )
+            )
+        }
+    )
+
+
+@permission_required("can_manage_vm")
+def fleet_overview(request):
+    operations = list(
+        models.FleetOperation.objects.prefetch_related(
+            'fleetresult_set'
+        )[:FLEET_OVERVIEW_LEN]
+    )
+    models.FleetOperation.prefetch_counts(operations)
+    return render(
+        request,
+        "vms/fleet.html",
+        {
+            "operations": operations,
+            "warm_pool": warm_pool.stats(),
+        }
+    )
+
+
+@permission_required("can_manage_vm")
+def task_dashboard(request):
+    return render(
+        request,
+        "vms/task_dashboard.html",
+        {
+            "depth": metrics.queue_depth(),
+            "actions": metrics.action_percentiles(),
+            "slowest_vms": metrics.slowest_vms(),
+            "window": settings.TASK_METRICS_WINDOW,
+        }
+    )
+
+
+@permission_required("can_manage_vm")
+def fleet_operation(request, operation_pk):
+    return render(
+        request,
+        "vms/fleet_operation.html",
+        {
+            "operation": get_object_or_404(
+                models.FleetOperation, pk=operation_pk
+            )
         }
     )
 
@@ -153,19 +263,45 @@ def perform_action(request, problem_slug, action_name):
     )
 
 
+def _vm_history(vm, kind):
+    if kind == "states":
+        return vm.state_set.all()
+    return vm.task_set.select_related('task')
+
+
 @permission_required("can_manage_vm")
 def problem_detail(request, problem_slug):
+    problem = get_object_or_404(models.Problem, slug=problem_slug)
+    vm = problem.vm
     return render(
         request,
         "vms/detail.html",
         {
-            "problem": get_object_or_404(models.Problem,
-                                         slug=problem_slug),
+            "problem": problem,
+            "vm": vm,
+            "states": _vm_history(vm, "states")[:DETAIL_HISTORY_LEN] if vm else [],
+            "tasks": _vm_history(vm, "tasks")[:DETAIL_HISTORY_LEN] if vm else [],
             "actions": vmmanage.models.LEGAL_API_VM_ACTIONS
         }
     )
 
 
+@permission_required("can_manage_vm")
+def problem_history(request, problem_slug, kind):
+    vm = get_object_or_404(models.VirtualMachine, problem__slug=problem_slug,
+                           owner=None)
+    paginator = Paginator(_vm_history(vm, kind), HISTORY_PAGE_LEN)
+    return render(
+        request,
+        "vms/history.html",
+        {
+            "problem": vm.problem,
+            "kind": kind,
+            "page": paginator.get_page(request.GET.get("page"))
+        }
+    )
+
+
 @permission_required("can_manage_vm")
 def edit_problem(request, problem_slug):
     problem = get_object_or_404(models.Problem, slug=problem_slug)
@@ -175,6 +311,7 @@ def edit_problem(request, problem_slug):
                                      instance=problem)
         if form.is_valid():
             form.save()
+            problem.invalidate_config()
     else:
         form = forms.ProblemEditForm(instance=problem)
 
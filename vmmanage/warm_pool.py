@@ -0,0 +1,130 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Keeps the VMs of high-demand problems suspended while no course uses
+them, so they are available within seconds when a course needs them.
+"""
+from django.conf import settings
+
+from uptomate.Deployment import VAGRANT_RUNNING_STATES, VAGRANT_STOPPED_STATES
+
+from . import deploy_controller
+from .models import VirtualMachine
+
+# States of a booted VM that only needs to be resumed
+SUSPENDED_STATES = ["saved", "paused"]
+
+
+def pool_vms():
+    """
+    :return: VMs of warm problems no course uses, at most WARM_POOL_SIZE
+    """
+    return list(
+        VirtualMachine.objects.filter(
+            owner=None,
+            problem__keep_warm=True,
+            problem__courseproblems__isnull=True
+        ).select_related('problem').order_by('problem__slug')[
+            :settings.WARM_POOL_SIZE
+        ]
+    )
+
+
+def split_pool(vms):
+    """
+    :return: tuple of the given VMs that are in the pool and the others
+    """
+    pool = {vm.pk for vm in pool_vms()}
+    vms = list(vms)
+    return (
+        [vm for vm in vms if vm.pk in pool],
+        [vm for vm in vms if vm.pk not in pool]
+    )
+
+
+def suspend_after_start(vagr_depl, action, vm_db, **kwargs):
+    """
+    Callback of the start of cold pool VMs. It runs while the start
+    still holds the lock of the VM, so nothing gets in between.
+    """
+    vagr_depl.suspend()
+
+
+def refill(vms=None):
+    """
+    Boots pool VMs that are not ready and suspends them right after,
+    in the same task. Running ones are suspended.
+    :param vms: VMs of the pool, by default pool_vms()
+    :return: tuple of the start and suspend FleetOperations, both may be None
+    """
+    vms = pool_vms() if vms is None else list(vms)
+    states = VirtualMachine.predict_states(vms)
+    cold = [
+        vm for vm in vms
+        if states[vm.pk] not in VAGRANT_RUNNING_STATES + SUSPENDED_STATES
+    ]
+    started = None
+    if cold:
+        started = deploy_controller.run_fleet_action(
+            'start', cold, callback=suspend_after_start
+        )
+    suspended = deploy_controller.action_on_state(
+        [vm for vm in vms if vm not in cold], 'suspend',
+        VAGRANT_RUNNING_STATES
+    )
+    return started, suspended
+
+
+def start_vms(vms):
+    """
+    Starts VMs that are about to be used. Suspended ones are resumed,
+    stopped ones get settings.DEFAULT_USED_ACTION.
+    :return: list of the FleetOperations
+    """
+    vms = list(vms)
+    states = VirtualMachine.predict_states(vms)
+    suspended = [vm for vm in vms if states[vm.pk] in SUSPENDED_STATES]
+    others = [vm for vm in vms if states[vm.pk] not in SUSPENDED_STATES]
+    operations = [
+        deploy_controller.action_on_state(
+            suspended, 'resume', SUSPENDED_STATES
+        ),
+        deploy_controller.action_on_state(
+            others, settings.DEFAULT_USED_ACTION,
+            VAGRANT_STOPPED_STATES
+        ),
+    ]
+    return [o for o in operations if o]
+
+
+def stats():
+    """
+    :return: dict with the size of the pool, the number of VMs
+    ready to be resumed and the number still being prepared
+    """
+    vms = pool_vms()
+    states = VirtualMachine.predict_states(vms)
+    ready = len([
+        vm for vm in vms
+        if vm.current_state in SUSPENDED_STATES and
+        states[vm.pk] in SUSPENDED_STATES
+    ])
+    return {
+        'size': settings.WARM_POOL_SIZE,
+        'members': len(vms),
+        'ready': ready,
+        'warming': len(vms) - ready,
+    }
@@ -20,3 +20,4 @@ from . import models
 admin.site.register(models.Course)
 admin.site.register(models.CourseProblems)
 admin.site.register(models.Submission)
+admin.site.register(models.Score)
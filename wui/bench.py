@@ -0,0 +1,281 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Generates courses with many participants and submissions and drives the
+student facing views concurrently, to benchmark them.
+"""
+import os
+import random
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from time import perf_counter
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from vmmanage.bench import FakeVagrant, percentile
+from vmmanage.models import Download, Port, Problem, VirtualMachine
+from . import models
+
+BULK_SIZE = 5000
+
+BenchData = namedtuple('BenchData', ['courses', 'users', 'problems'])
+BenchProblem = namedtuple('BenchProblem', ['slug', 'flag', 'download_pk'])
+Sample = namedtuple('Sample', ['time', 'queries', 'status'])
+
+
+def generate(courses=2, problems=30, participants=2000,
+             submissions=200000, seed=1):
+    """
+    Creates courses sharing the same problems and participants. Every
+    problem has a VM, whose state comes from a fake vagrant deployment,
+    and a download stored below settings.VAGR_DEPLOYMENT_PATH.
+    :param submissions: number of submissions over all courses, about
+    a tenth of them correct
+    :return: BenchData
+    """
+    rng = random.Random(seed)
+    now = timezone.now()
+    teacher = User.objects.create(username="bench-teacher")
+    User.objects.bulk_create(
+        [User(username="bench-user{}".format(i)) for i in range(participants)],
+        batch_size=BULK_SIZE
+    )
+    user_pks = list(User.objects.filter(
+        username__startswith="bench-user"
+    ).values_list('pk', flat=True))
+
+    bench_problems = [_create_problem(i) for i in range(problems)]
+
+    course_names = []
+    for i in range(courses):
+        course = models.Course.objects.create(
+            name="bench-course{}".format(i), description="Benchmark",
+            teacher=teacher, point_threshold=0, writeups=False,
+            start_time=now - timedelta(days=1),
+            deadline=now + timedelta(days=30)
+        )
+        course_names.append(course.name)
+        models.Course.participants.through.objects.bulk_create([
+            models.Course.participants.through(course=course, user_id=pk)
+            for pk in user_pks
+        ], batch_size=BULK_SIZE)
+        models.CourseProblems.objects.bulk_create([
+            models.CourseProblems(
+                course=course, problem_id=p.pk, points=rng.randint(1, 10) * 10
+            )
+            for p in Problem.objects.filter(slug__startswith="bench-")
+        ])
+        # Not every database returns the pks of bulk created rows
+        course_problems = list(
+            models.CourseProblems.objects.filter(
+                course=course
+            ).select_related('problem')
+        )
+        _create_submissions(
+            rng, course_problems, user_pks, submissions // courses
+        )
+        models.Score.rebuild(course)
+
+    return BenchData(course_names, user_pks, bench_problems)
+
+
+def _create_problem(i):
+    slug = "bench-problem{}".format(i)
+    flag = "flag{{bench{}}}".format(i)
+    problem = Problem.objects.create(
+        slug=slug, name=slug, category="category{}".format(i % 5), flag=flag,
+        desc="Connect to {{HOST}}:{{PORT_80}} and get [the file]({{DL_file{}}})."
+        "\n\n*Problem {}*".format(i, i)
+    )
+
+    vagrant = FakeVagrant(slug)
+    vagrant.start()
+    status = vagrant.status()
+    vm = VirtualMachine.objects.create(
+        problem=problem, provider=status.provider,
+        ip_addr=vagrant.service_network_address()
+    )
+    vm.record_state(status.state)
+    Port.objects.create(
+        vm=vm, guest_port=80, host_port=20000 + i, description="web"
+    )
+
+    name = "{}.bin".format(slug)
+    file_path = problem.get_vagrant().normalize_dl_path(name, absolut=True)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    with open(file_path, "wb") as f:
+        f.write(os.urandom(64 * 1024))
+    download = Download.objects.create(
+        slug="file{}".format(i), problem=problem,
+        path=problem.get_vagrant().normalize_dl_path(name)
+    )
+    download.update_manifest()
+    return BenchProblem(slug, flag, download.pk)
+
+
+def _create_submissions(rng, course_problems, user_pks, count):
+    """
+    Creates count submissions of random users, about a tenth of them
+    being the first correct one of a user.
+    """
+    solved = set()
+    batch = []
+    for i in range(count):
+        user_pk = rng.choice(user_pks)
+        course_problem = rng.choice(course_problems)
+        correct = rng.random() < 0.1 and (user_pk, course_problem.pk) not in solved
+        if correct:
+            solved.add((user_pk, course_problem.pk))
+        batch.append(models.Submission(
+            user_id=user_pk, problem=course_problem, correct=correct,
+            flag=course_problem.problem.flag if correct else
+            "flag{{wrong{}}}".format(i)
+        ))
+        if len(batch) == BULK_SIZE:
+            models.Submission.objects.bulk_create(batch)
+            batch = []
+    models.Submission.objects.bulk_create(batch)
+
+
+def scenarios(data):
+    """
+    :return: dict of scenario name -> function(rng) returning the
+    (method, url, data) of a request
+    """
+    def course(rng):
+        return rng.choice(data.courses)
+
+    def submit(rng):
+        problem = rng.choice(data.problems)
+        return (
+            "post",
+            reverse('wui_course_problems', args=[course(rng)]),
+            {
+                'problem_slug': problem.slug,
+                # Mostly wrong flags, like in a running course
+                'flag': problem.flag if rng.random() < 0.1 else
+                "flag{{guess{}}}".format(rng.random())
+            }
+        )
+
+    return {
+        'courses': lambda rng: ("get", reverse('wui_courses'), None),
+        'course_problems': lambda rng: (
+            "get", reverse('wui_course_problems', args=[course(rng)]), None
+        ),
+        'submit_flag': submit,
+        'scoreboard': lambda rng: (
+            "get", reverse('wui_course_scoreboard', args=[course(rng)]), None
+        ),
+        'download': lambda rng: (
+            "get",
+            reverse('wui_download_file', kwargs={
+                'download_id': rng.choice(data.problems).download_pk
+            }),
+            None
+        ),
+    }
+
+
+def run(scenario, data, requests, concurrency, seed=1):
+    """
+    Sends requests of a scenario from concurrency threads, each with
+    its own logged in participant.
+    :return: tuple of the Samples and the wall time of the run
+    """
+    def worker(index):
+        rng = random.Random(seed + index)
+        client = Client()
+        client.force_login(User.objects.get(pk=rng.choice(data.users)))
+        samples = []
+        try:
+            for _ in range(index, requests, concurrency):
+                method, url, post_data = scenario(rng)
+                with CaptureQueriesContext(connection) as queries:
+                    start = perf_counter()
+                    try:
+                        response = getattr(client, method)(url, post_data)
+                        # Streamed responses are only done once they were read
+                        if response.streaming:
+                            for _ in response.streaming_content:
+                                pass
+                        status = response.status_code
+                    except Exception:
+                        # The test client raises errors of the view
+                        status = 500
+                    elapsed = perf_counter() - start
+                samples.append(Sample(elapsed, len(queries), status))
+        finally:
+            connection.close()
+        return samples
+
+    start = perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(worker, range(concurrency)))
+    return [s for samples in results for s in samples], perf_counter() - start
+
+
+def summarize(samples, duration):
+    """
+    :return: dict of throughput, latency percentiles in ms,
+    query counts and errors of a run
+    """
+    times = sorted(s.time for s in samples)
+    queries = [s.queries for s in samples]
+    return {
+        'requests': len(samples),
+        'throughput': len(samples) / duration if duration else 0.0,
+        'p50': percentile(times, 50) * 1000,
+        'p95': percentile(times, 95) * 1000,
+        'p99': percentile(times, 99) * 1000,
+        'queries_avg': sum(queries) / len(queries) if queries else 0.0,
+        'queries_max': max(queries, default=0),
+        'errors': len([s for s in samples if s.status >= 400]),
+    }
+
+
+def regressions(result, baseline, tolerance):
+    """
+    Compares the summary of a run to the one of the baseline.
+    :param tolerance: share by which latency and throughput may be worse
+    :return: list of descriptions of the regressions
+    """
+    found = []
+    for key in ('p50', 'p95', 'p99'):
+        if result[key] > baseline[key] * (1 + tolerance):
+            found.append("{} {:.1f}ms > {:.1f}ms".format(
+                key, result[key], baseline[key]
+            ))
+    if result['throughput'] < baseline['throughput'] * (1 - tolerance):
+        found.append("throughput {:.1f}/s < {:.1f}/s".format(
+            result['throughput'], baseline['throughput']
+        ))
+    # Query counts do not depend on the machine, any increase is a regression
+    if result['queries_max'] > baseline['queries_max']:
+        found.append("{} queries > {}".format(
+            result['queries_max'], baseline['queries_max']
+        ))
+    if result['errors'] > baseline['errors']:
+        found.append("{} errors > {}".format(
+            result['errors'], baseline['errors']
+        ))
+    return found
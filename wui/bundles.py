@@ -0,0 +1,113 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Zip archives of many downloads, streamed while they are written.
+Files are stored uncompressed, so the size of the archive is known
+before the first byte is sent.
+"""
+import struct
+import time
+import zlib
+
+CHUNK_SIZE = 64 * 1024
+# Without ZIP64, sizes and offsets are limited to 32 bit
+MAX_ZIP_SIZE = 0xFFFFFFFF
+MAX_ZIP_ENTRIES = 0xFFFF
+
+# General purpose flags: sizes and CRC follow the data, UTF-8 names
+ZIP_FLAGS = 0x0808
+ZIP_VERSION = 20
+LOCAL_HEADER = struct.Struct('<IHHHHHIIIHH')
+DATA_DESCRIPTOR = struct.Struct('<IIII')
+CENTRAL_HEADER = struct.Struct('<IHHHHHHIIIHHHHHII')
+END_OF_CENTRAL_DIR = struct.Struct('<IHHHHIIH')
+
+
+class BundleTooBig(ValueError):
+    pass
+
+
+def dos_time(mtime):
+    t = time.localtime(max(mtime, 315532800))  # zip dates start 1980
+    return (
+        t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2,
+        (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+    )
+
+
+class ZipStream:
+    """
+    Iterable over the bytes of a zip archive of files.
+    :param entries: list of (name in the archive, file path, os.stat())
+    :raises BundleTooBig: the archive would need ZIP64
+    """
+
+    def __init__(self, entries):
+        self.entries = [
+            (name.encode(), file_path, stat)
+            for name, file_path, stat in entries
+        ]
+        if len(self.entries) > MAX_ZIP_ENTRIES or self.size > MAX_ZIP_SIZE:
+            raise BundleTooBig(
+                "{} files, {} bytes".format(len(self.entries), self.size)
+            )
+
+    @property
+    def size(self):
+        return sum(
+            LOCAL_HEADER.size + DATA_DESCRIPTOR.size +
+            CENTRAL_HEADER.size + 2 * len(name) + stat.st_size
+            for name, _, stat in self.entries
+        ) + END_OF_CENTRAL_DIR.size
+
+    def __iter__(self):
+        offset = 0
+        central_dir = []
+        for name, file_path, stat in self.entries:
+            mod_time, mod_date = dos_time(stat.st_mtime)
+            header = LOCAL_HEADER.pack(
+                0x04034b50, ZIP_VERSION, ZIP_FLAGS, 0, mod_time, mod_date,
+                0, 0, 0, len(name), 0
+            ) + name
+            yield header
+
+            crc = 0
+            remaining = stat.st_size
+            with open(file_path, 'rb') as f:
+                while remaining:
+                    chunk = f.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise IOError("{} got shorter".format(file_path))
+                    crc = zlib.crc32(chunk, crc)
+                    remaining -= len(chunk)
+                    yield chunk
+            yield DATA_DESCRIPTOR.pack(
+                0x08074b50, crc, stat.st_size, stat.st_size
+            )
+
+            central_dir.append(CENTRAL_HEADER.pack(
+                0x02014b50, ZIP_VERSION, ZIP_VERSION, ZIP_FLAGS, 0,
+                mod_time, mod_date, crc, stat.st_size, stat.st_size,
+                len(name), 0, 0, 0, 0, 0, offset
+            ) + name)
+            offset += len(header) + stat.st_size + DATA_DESCRIPTOR.size
+
+        central_dir_size = sum(len(h) for h in central_dir)
+        yield b''.join(central_dir)
+        yield END_OF_CENTRAL_DIR.pack(
+            0x06054b50, 0, 0, len(central_dir), len(central_dir),
+            central_dir_size, offset, 0
+        )
@@ -0,0 +1,255 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Serving of download files. Depending on settings.DOWNLOAD_BACKEND
+files are sent by Django itself, with conditional and range requests,
+or handed over to the front-end server with X-Accel-Redirect (nginx)
+or X-Sendfile (Apache, lighttpd).
+"""
+import base64
+import os
+import re
+from http.client import (
+    PARTIAL_CONTENT as HTTP_PARTIAL_CONTENT,
+    REQUESTED_RANGE_NOT_SATISFIABLE as HTTP_RANGE_NOT_SATISFIABLE,
+)
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    StreamingHttpResponse
+)
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+
+DOWNLOAD_CONTENT_TYPE = 'application/force-download'
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def file_etag(stat):
+    return '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)
+
+
+def parse_range(header, size):
+    """
+    Parses a range header with a single byte range.
+    :return: (first byte, last byte), None to send the whole file
+    :raises ValueError: the range can't be satisfied
+    """
+    match = RANGE_RE.match(header or '')
+    if not match or match.groups() == ('', ''):
+        # Multiple ranges are answered with the whole file
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range, the last bytes of the file
+        first, last = max(size - int(last), 0), size - 1
+    else:
+        first = int(first)
+        last = min(int(last), size - 1) if last else size - 1
+    if first > last or first >= size:
+        raise ValueError("Range {} not satisfiable".format(header))
+    return first, last
+
+
+def read_range(f, first, last):
+    """
+    Yields the bytes first to last (inclusive) of a file and closes it.
+    """
+    try:
+        f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def _if_range_matches(request, etag, mtime):
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if not if_range:
+        return True
+    if if_range.startswith('"') or if_range.startswith('W/'):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == int(mtime)
+
+
+def serve_direct(request, file_path, stat):
+    etag = file_etag(stat)
+    try:
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), stat.st_size)
+    except ValueError:
+        response = HttpResponse(status=HTTP_RANGE_NOT_SATISFIABLE)
+        response['Content-Range'] = 'bytes */{}'.format(stat.st_size)
+        return response
+
+    if byte_range and _if_range_matches(request, etag, stat.st_mtime):
+        first, last = byte_range
+        response = StreamingHttpResponse(
+            read_range(open(file_path, 'rb'), first, last),
+            status=HTTP_PARTIAL_CONTENT,
+            content_type=DOWNLOAD_CONTENT_TYPE
+        )
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(
+            first, last, stat.st_size
+        )
+        response['Content-Length'] = last - first + 1
+    else:
+        # Uses wsgi.file_wrapper, e.g. sendfile(), where available
+        response = FileResponse(
+            open(file_path, 'rb'),
+            content_type=DOWNLOAD_CONTENT_TYPE
+        )
+        response['Content-Length'] = stat.st_size
+    response['Accept-Ranges'] = 'bytes'
+    return response
+
+
+def _accel_path(file_path):
+    """
+    :return: path of a file relative to settings.DOWNLOAD_ACCEL_ROOT,
+    None if it is outside of it
+    """
+    root = os.path.realpath(settings.DOWNLOAD_ACCEL_ROOT)
+    rel_path = os.path.relpath(os.path.realpath(file_path), root)
+    if rel_path.startswith(os.pardir):
+        return None
+    return rel_path
+
+
+def serve_x_accel_redirect(request, file_path, stat):
+    rel_path = _accel_path(file_path)
+    if rel_path is None:
+        raise Http404("Download outside of DOWNLOAD_ACCEL_ROOT")
+    response = HttpResponse(content_type=DOWNLOAD_CONTENT_TYPE)
+    response['X-Accel-Redirect'] = settings.DOWNLOAD_ACCEL_PREFIX + quote(
+        rel_path.replace(os.sep, '/')
+    )
+    return response
+
+
+def serve_x_sendfile(request, file_path, stat):
+    response = HttpResponse(content_type=DOWNLOAD_CONTENT_TYPE)
+    response['X-Sendfile'] = file_path
+    return response
+
+
+BACKENDS = {
+    'direct': serve_direct,
+    'x-accel-redirect': serve_x_accel_redirect,
+    'x-sendfile': serve_x_sendfile,
+}
+
+
+def accepted_encodings(header):
+    """
+    Parses an Accept-Encoding header.
+    :return: dict of content coding -> q-value, codings with a
+    malformed q-value get 0
+    """
+    encodings = {}
+    for item in header.split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        if not coding:
+            continue
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value.strip())
+                except ValueError:
+                    q = 0.0
+        encodings[coding.lower()] = q
+    return encodings
+
+
+def accepts_gzip(request):
+    encodings = accepted_encodings(
+        request.META.get('HTTP_ACCEPT_ENCODING', '')
+    )
+    for coding in ['gzip', 'x-gzip', '*']:
+        if coding in encodings:
+            return encodings[coding] > 0
+    return False
+
+
+def servable(file_path):
+    """
+    :return: whether the configured backend can send the file, nginx
+    only serves files below settings.DOWNLOAD_ACCEL_ROOT
+    """
+    if settings.DOWNLOAD_BACKEND == 'x-accel-redirect':
+        return _accel_path(file_path) is not None
+    return True
+
+
+def serve(request, file_path, filename, stat=None, sha256="", gzip_path=""):
+    """
+    Sends a file as attachment with the configured backend. Requests
+    that still have the current version get a 304 response.
+    :param file_path: absolute path of the file, checked by the caller
+    :param filename: name the file is saved as
+    :param stat: os.stat() of the file, if already known
+    :param sha256: hex digest of the file, sent as Digest header
+    :param gzip_path: compressed copy of the file, sent to clients
+    that accept gzip if the backend can send it
+    """
+    content_encoding = None
+    if gzip_path and not servable(gzip_path):
+        gzip_path = ""
+    if gzip_path and accepts_gzip(request):
+        try:
+            stat = os.stat(gzip_path)
+        except OSError:
+            pass
+        else:
+            file_path = gzip_path
+            content_encoding = 'gzip'
+    if stat is None:
+        stat = os.stat(file_path)
+
+    etag = file_etag(stat)
+    not_modified = get_conditional_response(
+        request, etag=etag, last_modified=int(stat.st_mtime)
+    )
+    if not_modified is None:
+        response = BACKENDS[settings.DOWNLOAD_BACKEND](
+            request, file_path, stat
+        )
+        response['Content-Disposition'] = \
+            'attachment; filename="{}"'.format(filename)
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(stat.st_mtime)
+        if content_encoding:
+            response['Content-Encoding'] = content_encoding
+        elif sha256:
+            response['Digest'] = 'sha-256=' + base64.b64encode(
+                bytes.fromhex(sha256)
+            ).decode()
+    else:
+        response = not_modified
+    if gzip_path:
+        response['Vary'] = 'Accept-Encoding'
+    return response
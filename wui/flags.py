@@ -0,0 +1,158 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Verification of submitted flags. The flags of a course are kept as
+salted digests in the cache, shared by all processes, and in memory.
+Any change of a problem or of the problems of a course invalidates
+them, see signals.py.
+"""
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.crypto import constant_time_compare, salted_hmac
+
+from vmmanage.models import bump_cache_version, cache_versions
+from . import models
+
+FLAGS_CACHE_KEY = "wui_course_flags_{course_pk}_{version}"
+FLAGS_VERSION_CACHE_KEY = "wui_course_flags_version"
+DIGEST_SALT = "wui.flags"
+
+_local = {}
+_local_lock = threading.Lock()
+
+
+def digest(flag):
+    return salted_hmac(DIGEST_SALT, flag).hexdigest()
+
+
+def invalidate():
+    """
+    Drops the flags of all courses in all processes.
+    """
+    bump_cache_version(FLAGS_VERSION_CACHE_KEY)
+
+
+def course_flags(course_pk):
+    """
+    :return: dict of problem slug -> (course problem pk, flag digest)
+    """
+    key = FLAGS_CACHE_KEY.format(
+        course_pk=course_pk,
+        version=cache_versions([FLAGS_VERSION_CACHE_KEY])[
+            FLAGS_VERSION_CACHE_KEY
+        ]
+    )
+    flags = _local.get(key)
+    if flags is None:
+        flags = cache.get(key)
+        if flags is None:
+            flags = {
+                slug: (pk, digest(flag))
+                for pk, slug, flag in models.CourseProblems.objects.filter(
+                    course_id=course_pk
+                ).values_list('pk', 'problem__slug', 'problem__flag')
+            }
+            cache.set(key, flags, settings.FLAGS_CACHE_TTL)
+        with _local_lock:
+            # Entries of old versions are never used again
+            for old_key in [k for k in _local if k.startswith(
+                    FLAGS_CACHE_KEY.format(course_pk=course_pk, version=""))]:
+                del _local[old_key]
+            _local[key] = flags
+    return flags
+
+
+def verify(course_pk, problem_slug, flag):
+    """
+    :return: whether the flag is correct and the pk of the course problem
+    :raises CourseProblems.DoesNotExist: the course has no such problem
+    """
+    try:
+        course_problem_pk, flag_digest = course_flags(course_pk)[problem_slug]
+    except KeyError:
+        raise models.CourseProblems.DoesNotExist(
+            "Course {} has no problem {}".format(course_pk, problem_slug)
+        )
+    return constant_time_compare(digest(flag), flag_digest), course_problem_pk
+
+
+def verify_many(submissions):
+    """
+    Verifies many flags at once, the flags of each course are only
+    loaded once.
+    :param submissions: iterable of (course pk, problem slug, flag)
+    :return: list of (correct, course problem pk), the pk is None
+    for unknown problems
+    """
+    results = []
+    flags_of = {}
+    for course_pk, problem_slug, flag in submissions:
+        if course_pk not in flags_of:
+            flags_of[course_pk] = course_flags(course_pk)
+        try:
+            course_problem_pk, flag_digest = flags_of[course_pk][problem_slug]
+        except KeyError:
+            results.append((False, None))
+            continue
+        results.append(
+            (constant_time_compare(digest(flag), flag_digest),
+             course_problem_pk)
+        )
+    return results
+
+
+def regrade(course):
+    """
+    Checks all submissions of a course against the current flags,
+    e.g. after a flag was fixed, and rebuilds the scores.
+    Submissions whose new result already exists are left as they are.
+    :return: number of changed submissions
+    """
+    submissions = list(
+        models.Submission.objects.filter(
+            problem__course=course
+        ).select_related(
+            'problem__problem'
+        ).only(
+            'flag', 'correct', 'user_id', 'problem_id', 'problem__problem__slug'
+        )
+    )
+    existing = {
+        (s.flag, s.correct, s.user_id, s.problem_id) for s in submissions
+    }
+    results = verify_many(
+        (course.pk, s.problem.problem.slug, s.flag) for s in submissions
+    )
+
+    changed = []
+    for submission, (correct, _) in zip(submissions, results):
+        if correct == submission.correct:
+            continue
+        unique = (submission.flag, correct, submission.user_id,
+                  submission.problem_id)
+        if unique in existing:
+            continue
+        existing.add(unique)
+        submission.correct = correct
+        changed.append(submission)
+
+    with transaction.atomic():
+        models.Submission.objects.bulk_update(changed, ['correct'])
+        models.Score.rebuild(course)
+    return len(changed)
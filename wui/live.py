@@ -0,0 +1,139 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Live updates of courses, sent to the browsers as server sent events.
+The events of a course are numbered and kept in the cache, so all
+processes share them. Browsers poll: a request returns the events after
+the last one the browser got and ends, the browser reconnects after
+settings.LIVE_RETRY seconds with the id of its last event. Open
+scoreboards don't hold on to a worker.
+"""
+import json
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import models
+
+SEQ_CACHE_KEY = "wui_live_seq_{course_pk}"
+EVENT_CACHE_KEY = "wui_live_event_{course_pk}_{seq}"
+LISTENING_CACHE_KEY = "wui_live_listening_{course_pk}"
+# Tells the client when to poll again
+RETRY_MESSAGE = "retry: {}\n\n"
+# Sets the id the client sends with its next poll
+ID_MESSAGE = "id: {}\n\n"
+
+
+def encode_event(seq, event, data):
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(
+        seq, event, json.dumps(data)
+    )
+
+
+def _last_seq(course_pk):
+    key = SEQ_CACHE_KEY.format(course_pk=course_pk)
+    cache.add(key, 0, None)
+    return cache.get(key, 0)
+
+
+def publish(course_pk, event, data):
+    """
+    Adds an event to the stream of a course.
+    :return: number of the event
+    """
+    key = SEQ_CACHE_KEY.format(course_pk=course_pk)
+    cache.add(key, 0, None)
+    try:
+        seq = cache.incr(key)
+    except ValueError:
+        # Evicted right after it was added, clients start over
+        seq = 1
+        cache.set(key, seq, None)
+    cache.set(
+        EVENT_CACHE_KEY.format(course_pk=course_pk, seq=seq),
+        encode_event(seq, event, data),
+        settings.LIVE_EVENT_TTL
+    )
+    return seq
+
+
+def has_listeners(course_pk):
+    """
+    :return: whether a client polled the course recently
+    """
+    return cache.get(LISTENING_CACHE_KEY.format(course_pk=course_pk), False)
+
+
+def poll(course_pk, last_event_id=None):
+    """
+    The events of a course a client did not get yet. New clients
+    only get the id to continue from.
+    :param last_event_id: the Last-Event-ID header of the client
+    :return: the events as event stream
+    """
+    cache.set(LISTENING_CACHE_KEY.format(course_pk=course_pk), True,
+              settings.LIVE_RETRY * 3)
+    last = _last_seq(course_pk)
+    messages = [RETRY_MESSAGE.format(settings.LIVE_RETRY * 1000)]
+    try:
+        seen = int(last_event_id)
+    except (TypeError, ValueError):
+        seen = last
+    if not 0 <= seen <= last:
+        # The numbers started over
+        seen = last
+    # Clients far behind skip the older events
+    first = max(seen + 1, last - settings.LIVE_QUEUE_LEN + 1)
+    keys = [
+        EVENT_CACHE_KEY.format(course_pk=course_pk, seq=seq)
+        for seq in range(first, last + 1)
+    ]
+    events = cache.get_many(keys)
+    messages.extend(events[key] for key in keys if key in events)
+    messages.append(ID_MESSAGE.format(last))
+    return "".join(messages)
+
+
+def publish_solve(submission):
+    """
+    Pushes a correct submission and the resulting ranking to the
+    listeners of its course. Call it once the submission is committed.
+    :param submission: the correct Submission
+    """
+    course_problem = submission.problem
+    course = course_problem.course
+    if not has_listeners(course.pk):
+        return
+
+    solve = {
+        'problem': course_problem.problem.slug,
+        'title': course_problem.problem.name,
+        'points': course_problem.points,
+        'first_blood': models.Submission.objects.filter(
+            problem=course_problem,
+            correct=True
+        ).count() == 1,
+        'user': None,
+    }
+    if course.show_scoreboard:
+        solve['user'] = submission.user.username
+    publish(course.pk, 'solve', solve)
+
+    if course.show_scoreboard:
+        publish(course.pk, 'scoreboard', [
+            {'username': score.user.username, 'points': score.points}
+            for score in models.Score.ranking(course)
+        ])
@@ -0,0 +1,98 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Measures concurrent downloads of one large file with each download
+backend, without a front-end server. For the offloading backends
+this is the time the application server is busy per download.
+"""
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+from django.test.utils import override_settings
+
+from vmmanage.bench import percentile
+from wui import downloads
+
+MB = 1024 * 1024
+
+
+class Command(BaseCommand):
+    help = "benchmarks concurrent downloads with the download backends"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', type=int, default=100,
+                            help="size of the downloaded file in MB")
+        parser.add_argument('--clients', type=int, default=20,
+                            help="number of concurrent downloads")
+        parser.add_argument('--downloads', type=int, default=100,
+                            help="number of downloads per backend")
+        parser.add_argument('--resume', type=float, default=0.0,
+                            help="share of downloads resuming at half "
+                                 "of the file")
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory() as root:
+            file_path = os.path.join(root, 'download.bin')
+            with open(file_path, 'wb') as f:
+                for _ in range(options['size']):
+                    f.write(os.urandom(MB))
+
+            with override_settings(DOWNLOAD_ACCEL_ROOT=root):
+                for backend in sorted(downloads.BACKENDS):
+                    with override_settings(DOWNLOAD_BACKEND=backend):
+                        self._run(backend, file_path, options)
+
+    def _run(self, backend, file_path, options):
+        factory = RequestFactory()
+        resume_every = (int(1 / options['resume'])
+                        if options['resume'] else 0)
+
+        def download(i):
+            headers = {}
+            if resume_every and i % resume_every == 0:
+                headers['HTTP_RANGE'] = 'bytes={}-'.format(
+                    options['size'] * MB // 2
+                )
+            start = perf_counter()
+            response = downloads.serve(
+                factory.get('/download', **headers), file_path, 'bench.bin'
+            )
+            size = sum(len(chunk) for chunk in response)
+            response.close()
+            return perf_counter() - start, size
+
+        start = perf_counter()
+        with ThreadPoolExecutor(options['clients']) as executor:
+            results = list(executor.map(download, range(options['downloads'])))
+        total = perf_counter() - start
+
+        times = sorted(t for t, _ in results)
+        sent = sum(size for _, size in results)
+        self.stdout.write(
+            "{}: {:.1f}s, {:.1f} MB/s sent by the app, "
+            "p50 {:.2f}ms, p95 {:.2f}ms, max {:.2f}ms".format(
+                backend,
+                total,
+                sent / MB / total,
+                percentile(times, 50) * 1000,
+                percentile(times, 95) * 1000,
+                percentile(times, 100) * 1000,
+            )
+        )
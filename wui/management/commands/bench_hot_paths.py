@@ -0,0 +1,135 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmarks the student facing views against generated courses, in a
+database of its own. Results can be stored as baseline, later runs fail
+if they are slower or need more queries than the baseline.
+"""
+import json
+import os
+import tempfile
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from wui import bench
+from wui import submissions
+
+
+class Command(BaseCommand):
+    help = "benchmarks course pages, flag submissions and downloads"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--courses', type=int, default=2)
+        parser.add_argument('--problems', type=int, default=30,
+                            help="problems per course")
+        parser.add_argument('--participants', type=int, default=2000,
+                            help="participants of every course")
+        parser.add_argument('--submissions', type=int, default=200000,
+                            help="submissions over all courses")
+        parser.add_argument('--requests', type=int, default=500,
+                            help="requests per scenario")
+        parser.add_argument('--concurrency', type=int, default=8,
+                            help="number of concurrent clients")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--scenario', action='append',
+                            help="scenarios to run, all by default")
+        parser.add_argument('--baseline',
+                            help="JSON file of a previous run to compare to")
+        parser.add_argument('--save-baseline',
+                            help="JSON file to store the results in")
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help="share by which latency and throughput may "
+                                 "be worse than the baseline")
+
+    def handle(self, *args, **options):
+        baseline = {}
+        if options['baseline']:
+            with open(options['baseline']) as f:
+                baseline = json.load(f)
+
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True
+        )
+        try:
+            with tempfile.TemporaryDirectory() as root:
+                results = self._run(root, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+        failed = 0
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            for regression in bench.regressions(
+                    result, baseline[name], options['tolerance']
+            ):
+                failed += 1
+                self.stderr.write("{}: {}".format(name, regression))
+        if failed:
+            raise CommandError("{} regressions".format(failed))
+
+    def _run(self, root, options):
+        caches = {
+            alias: dict(config, KEY_PREFIX="bench-" + uuid.uuid4().hex)
+            for alias, config in settings.CACHES.items()
+        }
+        # Measures the views, not the rate limit and over budget logging
+        with override_settings(
+            CACHES=caches,
+            VAGR_DEPLOYMENT_PATH=root,
+            DOWNLOAD_GZIP_PATH=root,
+            SUBMISSION_BURST=10 ** 9,
+            SUBMISSION_SPOOL_PATH=os.path.join(root, "spool"),
+            INSTRUMENTATION_ENABLED=False,
+        ):
+            self.stdout.write("Generating data...")
+            data = bench.generate(
+                courses=options['courses'],
+                problems=options['problems'],
+                participants=options['participants'],
+                submissions=options['submissions'],
+                seed=options['seed']
+            )
+
+            results = {}
+            scenarios = bench.scenarios(data)
+            for name in options['scenario'] or sorted(scenarios):
+                if name not in scenarios:
+                    raise CommandError("Unknown scenario '{}'".format(name))
+                samples, duration = bench.run(
+                    scenarios[name], data, options['requests'],
+                    options['concurrency'], options['seed']
+                )
+                results[name] = result = bench.summarize(samples, duration)
+                self.stdout.write(
+                    "{}: {:.1f} req/s, p50 {:.1f}ms, p95 {:.1f}ms, "
+                    "p99 {:.1f}ms, {:.1f} queries (max {}), {} errors".format(
+                        name, result['throughput'], result['p50'],
+                        result['p95'], result['p99'], result['queries_avg'],
+                        result['queries_max'], result['errors']
+                    )
+                )
+            # Pending wrong submissions belong to the test database
+            submissions.batch.flush()
+        return results
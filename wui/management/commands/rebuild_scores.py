@@ -0,0 +1,45 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Recomputes the scoreboard ledger from the submissions.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from wui import models
+
+
+class Command(BaseCommand):
+    help = "rebuilds the scores of courses from their submissions"
+
+    def add_arguments(self, parser):
+        parser.add_argument('courses', nargs='*',
+                            help="names of the courses, all if omitted")
+
+    def handle(self, *args, **options):
+        courses = models.Course.objects.all()
+        if options['courses']:
+            courses = courses.filter(name__in=options['courses'])
+            missing = set(options['courses']) - set(
+                courses.values_list('name', flat=True)
+            )
+            if missing:
+                raise CommandError(
+                    "Unknown course(s): {}".format(", ".join(sorted(missing)))
+                )
+
+        for course in courses:
+            count = models.Score.rebuild(course)
+            self.stdout.write("{}: {} scores".format(course.name, count))
@@ -14,11 +14,15 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 from django.contrib.auth import models as auth_models
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Min
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 import vmmanage.models
+from vmmanage.models import bump_cache_version, cache_versions
+
+COURSES_VERSION_CACHE_KEY = "wui_course_list_version"
 
 
 class Course(models.Model):
@@ -67,6 +71,25 @@ class Course(models.Model):
 
         return self.participants.filter(username=user).exists()
 
+    @staticmethod
+    def list_cache_version():
+        """
+        Version of the cached course list, it is part of the key of
+        the list fragment and changes on invalidate_list().
+        :return: version
+        """
+        return cache_versions(
+            [COURSES_VERSION_CACHE_KEY]
+        )[COURSES_VERSION_CACHE_KEY]
+
+    @staticmethod
+    def invalidate_list():
+        """
+        Drops the cached course list, called when a course or a
+        teacher changes.
+        """
+        bump_cache_version(COURSES_VERSION_CACHE_KEY)
+
 
 class CourseProblems(models.Model):
     course = models.ForeignKey(Course, on_delete=models.CASCADE)
@@ -79,15 +102,6 @@ class CourseProblems(models.Model):
     class Meta:
         unique_together = ('course', 'problem')
 
-    @staticmethod
-    def check_problem_flag(course, problem_slug, flag):
-        cp = CourseProblems.objects.get(
-            course=course,
-            problem__slug=problem_slug
-        )
-        correct = cp.problem.flag == flag
-        return correct, cp
-
     def __str__(self):
         return "{}[{}]".format(str(self.problem).capitalize(), self.points)
 
@@ -105,3 +119,106 @@ class Submission(models.Model):
 
     def __str__(self):
         return "<{}:{}>".format(self.correct, self.flag)
+
+
+class Score(models.Model):
+    """
+    Points of a participant in a course. They are kept up to date
+    on correct submissions, so the scoreboard is a single query.
+    """
+    course = models.ForeignKey(Course, on_delete=models.CASCADE)
+    user = models.ForeignKey(auth_models.User, on_delete=models.CASCADE)
+    points = models.IntegerField(_('points'), default=0)
+    solves = models.PositiveIntegerField(_('solves'), default=0)
+    last_solve = models.DateTimeField(_('last solve'), null=True)
+
+    class Meta:
+        unique_together = ('course', 'user')
+        index_together = [('course', 'points', 'last_solve')]
+
+    @staticmethod
+    def ranking(course):
+        """
+        :return: scores of the participants of a course, best first
+        """
+        return Score.objects.filter(
+            course=course
+        ).exclude(
+            user_id=course.teacher_id
+        ).select_related(
+            'user'
+        ).order_by(
+            '-points',
+            F('last_solve').asc(nulls_last=True),
+            'user__username'
+        )
+
+    @staticmethod
+    def record_solve(submission):
+        """
+        Adds a correct submission to the score of its user. Has to run
+        in the transaction that created the submission. Solving a
+        problem again, e.g. after its flag changed, does not count.
+        :param submission: the correct Submission
+        """
+        course_problem = submission.problem
+        with transaction.atomic():
+            if Submission.objects.filter(
+                    problem=course_problem,
+                    user_id=submission.user_id,
+                    correct=True
+            ).exclude(pk=submission.pk).exists():
+                return
+            Score.objects.get_or_create(
+                course_id=course_problem.course_id,
+                user_id=submission.user_id
+            )
+            Score.objects.filter(
+                course_id=course_problem.course_id,
+                user_id=submission.user_id
+            ).update(
+                points=F('points') + course_problem.points,
+                solves=F('solves') + 1,
+                last_solve=submission.creation_time
+            )
+
+    @staticmethod
+    def rebuild(course, user_ids=None):
+        """
+        Recomputes scores of a course from its submissions, e.g. after
+        the points of its problems changed.
+        :param course: the Course
+        :param user_ids: only rebuild the scores of these users
+        :return: number of scores
+        """
+        participants = course.participants.all()
+        solves = Submission.objects.filter(
+            problem__course=course,
+            correct=True
+        )
+        old_scores = Score.objects.filter(course=course)
+        if user_ids is not None:
+            participants = participants.filter(pk__in=user_ids)
+            solves = solves.filter(user_id__in=user_ids)
+            old_scores = old_scores.filter(user_id__in=user_ids)
+
+        with transaction.atomic():
+            scores = {
+                user_id: Score(course=course, user_id=user_id)
+                for user_id in participants.values_list('pk', flat=True)
+            }
+            for solve in solves.values(
+                    'user_id', 'problem_id', 'problem__points'
+            ).annotate(solved=Min('creation_time')):
+                score = scores.setdefault(
+                    solve['user_id'],
+                    Score(course=course, user_id=solve['user_id'])
+                )
+                score.points += solve['problem__points']
+                score.solves += 1
+                if not score.last_solve or score.last_solve < solve['solved']:
+                    score.last_solve = solve['solved']
+
+            old_scores.delete()
+            Score.objects.bulk_create(scores.values())
+        return len(scores)
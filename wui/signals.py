@@ -13,12 +13,70 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-from django.db.models.signals import post_migrate
+from django.db.models.signals import (
+    m2m_changed,
+    post_delete,
+    post_migrate,
+    post_save
+)
 from django.dispatch import receiver
 from django.apps import apps
+from django.contrib.auth.models import User
+from vmmanage.models import Problem
 from . import db_setup
+from . import flags
+from . import models
 
 
 @receiver(post_migrate, sender=apps.get_app_config('wui'))
 def init_groups(sender, **kwargs):
     db_setup.setup()
+
+
+@receiver(m2m_changed, sender=models.Course.participants.through)
+def sync_scores(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Participants get their score when they join a course, and
+    lose it when they leave.
+    """
+    if action == 'post_add':
+        if reverse:
+            for course in models.Course.objects.filter(pk__in=pk_set):
+                models.Score.rebuild(course, [instance.pk])
+        else:
+            models.Score.rebuild(instance, pk_set)
+    elif action in ('post_remove', 'pre_clear'):
+        if reverse:
+            scores = models.Score.objects.filter(user=instance)
+            if pk_set is not None:
+                scores = scores.filter(course_id__in=pk_set)
+        else:
+            scores = models.Score.objects.filter(course=instance)
+            if pk_set is not None:
+                scores = scores.filter(user_id__in=pk_set)
+        scores.delete()
+
+
+@receiver(post_save, sender=Problem)
+@receiver(post_save, sender=models.CourseProblems)
+@receiver(post_delete, sender=models.CourseProblems)
+def invalidate_flags(sender, **kwargs):
+    flags.invalidate()
+
+
+@receiver(post_save, sender=models.Course)
+@receiver(post_delete, sender=models.Course)
+def invalidate_course_list(sender, **kwargs):
+    models.Course.invalidate_list()
+
+
+@receiver(post_save, sender=User)
+def invalidate_teacher_name(sender, instance, update_fields, **kwargs):
+    """
+    The course list shows the names of the teachers. Logins only
+    update last_login and keep the list.
+    """
+    if update_fields and set(update_fields) == {'last_login'}:
+        return
+    if instance.teacher_courses.exists():
+        models.Course.invalidate_list()
@@ -0,0 +1,245 @@
+# Berlyne IT security trainings platform
+# Copyright (C) 2016 Ruben Gonzalez <rg@ht11.org>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Handling of flag submissions. Submissions are rate limited per user
+and problem, repeated flags are answered from the cache and wrong
+flags are written in batches. Correct ones are written right away,
+as they change the scores.
+The rate limits and repeated flags rely on add() and incr() of the
+cache being atomic, as in memcached.
+"""
+import atexit
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, IntegrityError, transaction
+
+from . import flags
+from . import live
+from . import models
+
+CORRECT = "correct"
+INCORRECT = "incorrect"
+DUPLICATE = "duplicate"
+RATE_LIMITED = "rate_limited"
+
+BUCKET_CACHE_KEY = "wui_submission_bucket_{user_pk}_{course_problem_pk}_{window}"
+SEEN_CACHE_KEY = "wui_submission_seen_{user_pk}_{course_problem_pk}_{digest}"
+SPOOL_SUFFIX = ".jsonl"
+
+Result = namedtuple('Result', ['status', 'course_problem_pk', 'retry_after'])
+
+logger = logging.getLogger(__name__)
+
+
+def take_token(user_pk, course_problem_pk):
+    """
+    Rate limit of a user for a problem, settings.SUBMISSION_BURST
+    submissions per window of settings.SUBMISSION_BURST /
+    settings.SUBMISSION_RATE seconds. The counter of a window is only
+    changed with add() and incr(), so concurrent requests can't pass it.
+    :return: 0 if a token was taken, otherwise the seconds
+    until the next window
+    """
+    length = settings.SUBMISSION_BURST / settings.SUBMISSION_RATE
+    now = time.time()
+    window = int(now // length)
+    key = BUCKET_CACHE_KEY.format(
+        user_pk=user_pk, course_problem_pk=course_problem_pk, window=window
+    )
+    timeout = int(length) + 1
+    cache.add(key, 0, timeout)
+    try:
+        taken = cache.incr(key)
+    except ValueError:
+        # Evicted right after it was added
+        cache.set(key, 1, timeout)
+        taken = 1
+    if taken > settings.SUBMISSION_BURST:
+        return (window + 1) * length - now
+    return 0
+
+
+def _write_spool(spool):
+    """
+    Writes the submissions of a spool file and empties it.
+    :return: number of written submissions
+    """
+    spool.seek(0)
+    pending = [
+        models.Submission(correct=False, **json.loads(line))
+        # The last line is incomplete if the process was killed writing it
+        for line in spool if line.endswith("\n")
+    ]
+    # Duplicates that were not in the cache are dropped here
+    models.Submission.objects.bulk_create(pending, ignore_conflicts=True)
+    spool.truncate(0)
+    return len(pending)
+
+
+class SubmissionBatch:
+    """
+    Collects wrong submissions and writes them with one query, once
+    settings.SUBMISSION_BATCH_SIZE are pending or the oldest one is
+    settings.SUBMISSION_BATCH_DELAY seconds old.
+    Pending submissions are kept in a spool file of the process in
+    settings.SUBMISSION_SPOOL_PATH, which is locked as long as the
+    process lives. Spool files of killed processes are written by the
+    next flush of another one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._timer = None
+        self._spool = None
+
+    def _open_spool(self):
+        """
+        :return: the spool file of this process, forked processes get
+        their own one
+        """
+        path = os.path.join(
+            settings.SUBMISSION_SPOOL_PATH,
+            "{}-{}{}".format(socket.gethostname(), os.getpid(), SPOOL_SUFFIX)
+        )
+        if self._spool is None or self._spool.name != path:
+            if self._spool is not None:
+                self._spool.close()
+            os.makedirs(settings.SUBMISSION_SPOOL_PATH, exist_ok=True)
+            self._spool = open(path, 'a+')
+            fcntl.flock(self._spool, fcntl.LOCK_EX)
+        return self._spool
+
+    def add(self, submission):
+        line = json.dumps({
+            'flag': submission.flag,
+            'problem_id': submission.problem_id,
+            'user_id': submission.user_id
+        })
+        with self._lock:
+            spool = self._open_spool()
+            spool.write(line + "\n")
+            spool.flush()
+            self._pending += 1
+            full = self._pending >= settings.SUBMISSION_BATCH_SIZE
+            if not full and self._timer is None:
+                self._timer = threading.Timer(
+                    settings.SUBMISSION_BATCH_DELAY, self._flush_delayed
+                )
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending submissions and those left by killed processes.
+        :return: number of written submissions
+        """
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            written = 0
+            if self._pending:
+                written = _write_spool(self._open_spool())
+                self._pending = 0
+        return written + self._recover()
+
+    def _recover(self):
+        """
+        Writes the spool files no process holds a lock on anymore.
+        :return: number of written submissions
+        """
+        try:
+            names = os.listdir(settings.SUBMISSION_SPOOL_PATH)
+        except FileNotFoundError:
+            return 0
+        written = 0
+        for name in names:
+            path = os.path.join(settings.SUBMISSION_SPOOL_PATH, name)
+            if not name.endswith(SPOOL_SUFFIX) or (
+                    self._spool is not None and self._spool.name == path):
+                continue
+            with open(path, 'a+') as spool:
+                try:
+                    fcntl.flock(spool, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # The process is still running
+                    continue
+                written += _write_spool(spool)
+                os.remove(path)
+        if written:
+            logger.info("Wrote %d submissions of killed processes", written)
+        return written
+
+    def _flush_delayed(self):
+        try:
+            self.flush()
+        finally:
+            connection.close()
+
+
+batch = SubmissionBatch()
+atexit.register(batch.flush)
+
+
+def submit(user, course, problem_slug, flag):
+    """
+    Checks and stores a submitted flag.
+    :return: Result, retry_after is set if the user has to wait
+    :raises CourseProblems.DoesNotExist: the course has no such problem
+    """
+    correct, course_problem_pk = flags.verify(course.pk, problem_slug, flag)
+
+    retry_after = take_token(user.pk, course_problem_pk)
+    if retry_after:
+        return Result(RATE_LIMITED, course_problem_pk, retry_after)
+
+    seen_key = SEEN_CACHE_KEY.format(
+        user_pk=user.pk, course_problem_pk=course_problem_pk,
+        digest=flags.digest(flag)
+    )
+    if not cache.add(seen_key, True, settings.SUBMISSION_SEEN_TTL):
+        return Result(DUPLICATE, course_problem_pk, 0)
+
+    submission = models.Submission(
+        flag=flag,
+        problem_id=course_problem_pk,
+        correct=correct,
+        user=user
+    )
+    status = CORRECT if correct else INCORRECT
+    if correct:
+        try:
+            with transaction.atomic():
+                submission.save()
+                models.Score.record_solve(submission)
+                transaction.on_commit(lambda: live.publish_solve(submission))
+        except IntegrityError:
+            status = DUPLICATE
+    else:
+        batch.add(submission)
+    return Result(status, course_problem_pk, 0)
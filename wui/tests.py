@@ -13,6 +13,525 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-# from django.test import TestCase
+import io
+import json
+import os
+import shutil
+import tempfile
+import zipfile
+from datetime import timedelta
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.shortcuts import render
+from django.core.cache import cache
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    override_settings
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from berlyne import instrumentation
+from vmmanage.models import Problem, VirtualMachine
+from . import downloads
+from . import flags
+from . import live
+from . import models
+from . import submissions
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+}, SUBMISSION_SPOOL_PATH=tempfile.mkdtemp())
+class CourseTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(submissions.batch.flush)
+        self.user = User.objects.create_user("student", password="NoGood123")
+        self.client.force_login(self.user)
+        self.course = models.Course.objects.create(
+            name="course",
+            teacher=User.objects.create_user("teacher"),
+            point_threshold=0,
+            start_time=timezone.now() - timedelta(days=1),
+            deadline=timezone.now() + timedelta(days=1),
+            writeups=False
+        )
+        self.course.participants.add(self.user)
+
+    def _add_problems(self, count):
+        offset = Problem.objects.count()
+        for i in range(offset, offset + count):
+            slug = "problem{}".format(i)
+            problem = Problem.objects.create(
+                slug=slug, name=slug, desc="*{}*".format(slug),
+                category="cat{}".format(i % 3), flag=slug
+            )
+            course_problem = models.CourseProblems.objects.create(
+                course=self.course, problem=problem, points=i
+            )
+            models.Submission.objects.create(
+                flag=slug, problem=course_problem, correct=True,
+                user=self.user if i % 2 else self.course.teacher
+            )
+
+    def _count_queries(self, url):
+        # Warm up per process caches, e.g. the rendered descriptions
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx), response
+
+
+
+class CourseProblemsQueryCountTest(CourseTestCase):
+    def test_course_problems_query_count(self):
+        url = reverse('wui_course_problems', args=[self.course.name])
+        self._add_problems(1)
+        queries, _ = self._count_queries(url)
+        self._add_problems(10)
+        more_queries, response = self._count_queries(url)
+        self.assertEqual(queries, more_queries)
+        self.assertEqual(
+            response.context['user_points'],
+            sum(i for i in range(11) if i % 2)
+        )
+
+
+class CourseListTest(CourseTestCase):
+    def setUp(self):
+        super().setUp()
+        self.url = reverse('wui_courses')
+
+    def _add_course(self, name):
+        return models.Course.objects.create(
+            name=name, teacher=self.course.teacher, point_threshold=0,
+            start_time=self.course.start_time, deadline=self.course.deadline,
+            writeups=False
+        )
+
+    def _count_rendered(self):
+        models.Course.invalidate_list()
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(self.url)
+        return len(ctx)
+
+    def test_cached_list(self):
+        self._add_course("second")
+        cached, response = self._count_queries(self.url)
+        self.assertContains(response, "Leave", 1)
+        self.assertContains(response, "Join", 1)
+        rendered = self._count_rendered()
+        self.assertEqual(rendered, cached + 1)
+        # Courses, teachers and membership are a single query
+        for i in range(5):
+            self._add_course("more{}".format(i))
+        self.assertEqual(self._count_queries(self.url)[0], cached)
+        self.assertEqual(self._count_rendered(), rendered)
+
+    def test_invalidated_on_changes(self):
+        self.client.get(self.url)
+        course = self._add_course("second")
+        self.assertContains(self.client.get(self.url), "second")
+        self.course.teacher.last_name = "Teacher"
+        self.course.teacher.save()
+        self.assertContains(self.client.get(self.url), "Teacher")
+        course.delete()
+        self.assertNotContains(self.client.get(self.url), "second")
+        self.course.participants.remove(self.user)
+        self.assertContains(self.client.get(self.url), "Leave", 0)
+
+
+class ScoreTest(CourseTestCase):
+    def _submit(self, slug, flag):
+        self.client.post(
+            reverse('wui_course_problems', args=[self.course.name]),
+            {'problem_slug': slug, 'flag': flag}
+        )
+
+    def _ranking(self):
+        return [
+            (s.user.username, s.points, s.solves)
+            for s in models.Score.ranking(self.course)
+        ]
+
+    def test_scores_follow_submissions(self):
+        self._add_problems(3)
+        other = User.objects.create_user("other")
+        self.course.participants.add(other)
+        # The submissions were not made through the view
+        self.assertEqual(self._ranking(), [("other", 0, 0), ("student", 0, 0)])
+        models.Score.rebuild(self.course)
+        self.assertEqual(self._ranking(), [("student", 1, 1), ("other", 0, 0)])
+
+        self._submit("problem0", "wrong")
+        self._submit("problem2", "problem2")
+        self.assertEqual(self._ranking(), [("student", 3, 2), ("other", 0, 0)])
+
+        models.CourseProblems.objects.filter(problem__slug="problem1").update(
+            points=10
+        )
+        models.Score.rebuild(self.course)
+        self.assertEqual(self._ranking(), [("student", 12, 2), ("other", 0, 0)])
+
+        self.course.participants.remove(self.user)
+        self.assertEqual(self._ranking(), [("other", 0, 0)])
+
+    def test_scores_follow_course_management(self):
+        self._add_problems(3)
+        models.Score.rebuild(self.course)
+        self._submit("problem2", "problem2")
+        self.assertEqual(self._ranking(), [("student", 3, 2)])
+
+        self.client.force_login(
+            User.objects.create_superuser("admin", "admin@localhost", "x")
+        )
+        kept = Problem.objects.filter(slug__in=["problem0", "problem2"])
+        response = self.client.post(
+            reverse('wui_course_manage_problems', args=[self.course.name]),
+            {'problems': [p.pk for p in kept]}
+        )
+        self.assertRedirects(
+            response,
+            reverse('wui_points_to_problems', args=[self.course.name])
+        )
+        # Problems are added with their default points
+        self.assertEqual(self._ranking(), [("student", 0, 1)])
+
+        response = self.client.post(
+            reverse('wui_points_to_problems', args=[self.course.name]),
+            {'problem0-points': 1, 'problem2-points': 5}
+        )
+        self.assertRedirects(response, reverse('wui_courses'))
+        self.assertEqual(self._ranking(), [("student", 5, 1)])
+
+    def test_scoreboard_query_count(self):
+        url = reverse('wui_course_scoreboard', args=[self.course.name])
+        queries, _ = self._count_queries(url)
+        for i in range(10):
+            self.course.participants.add(
+                User.objects.create_user("user{}".format(i))
+            )
+        self.assertEqual(queries, self._count_queries(url)[0])
+
+
+class InstanceTest(CourseTestCase):
+    def test_instance_is_started_on_request(self):
+        deployment_path = tempfile.mkdtemp()
+        os.makedirs(os.path.join(deployment_path, "web"))
+        problem = Problem.objects.create(
+            slug="web", name="web", desc="port {PORT_80}", category="test",
+            flag="web", instance_per_user=True
+        )
+        problem.assign_vm([{'guest': 80, 'host': None, 'desc': "web"}])
+        models.CourseProblems.objects.create(
+            course=self.course, problem=problem, points=1
+        )
+        url = reverse('wui_course_problems', args=[self.course.name])
+        self.assertContains(self.client.get(url), "Start my instance")
+
+        with override_settings(VAGR_DEPLOYMENT_PATH=deployment_path,
+                               VAGR_INSTANCE_PATH=tempfile.mkdtemp(),
+                               SNAPSHOT_AFTER_INSTALL=False):
+            self.client.post(
+                reverse('wui_course_instance', args=[self.course.name, "web"])
+            )
+        instance = VirtualMachine.objects.get(owner=self.user)
+        response = self.client.get(url)
+        self.assertContains(
+            response, "port {}".format(instance.port_set.get().host_port)
+        )
+        self.assertNotContains(response, "Start my instance")
+
+
+class InstrumentationTest(CourseTestCase):
+    def setUp(self):
+        super().setUp()
+        instrumentation.registry.views.clear()
+
+    def test_metrics(self):
+        url = reverse('wui_course_problems', args=[self.course.name])
+        self._add_problems(2)
+        with override_settings(INSTRUMENTATION_VIEW_BUDGETS={
+            'wui_course_problems': (0, 0)
+        }):
+            with self.assertLogs('berlyne.instrumentation', 'WARNING'):
+                self.client.get(url)
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+
+        self.client.force_login(
+            User.objects.create_superuser("admin", "admin@localhost", "x")
+        )
+        metrics = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn(
+            'berlyne_requests_total{method="GET",status="200",'
+            'view="wui_course_problems"} 1', metrics
+        )
+        self.assertRegex(
+            metrics,
+            r'berlyne_db_queries_total\{view="wui_course_problems"\} [1-9]'
+        )
+        self.assertIn(
+            'berlyne_request_duration_seconds_count'
+            '{view="wui_course_problems"} 1', metrics
+        )
+
+    def test_cache_and_template_counters(self):
+        def view(request):
+            cache.get("missing")
+            cache.set("found", 1)
+            cache.get_many(["found", "missing"])
+            return render(request, "courses/join_pw.html", {})
+
+        request = RequestFactory().get("/")
+        request.user = self.user
+        instrumentation.InstrumentationMiddleware(view)(request)
+        metrics = instrumentation.registry.views["unresolved"]
+        self.assertEqual(metrics.cache_hits, 1)
+        self.assertEqual(metrics.cache_misses, 2)
+        self.assertGreater(metrics.template_time, 0)
+
+
+class LiveTest(CourseTestCase):
+    def _poll(self, last_event_id=None):
+        headers = {}
+        if last_event_id is not None:
+            headers['HTTP_LAST_EVENT_ID'] = last_event_id
+        response = self.client.get(
+            reverse('wui_course_live', args=[self.course.name]), **headers
+        )
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = response.content.decode()
+        return content, content.rsplit("id: ", 1)[1].strip()
+
+    def test_solve_is_published(self):
+        self._add_problems(1)
+        models.Score.rebuild(self.course)
+        # Nobody listens, nothing is published
+        live.publish_solve(models.Submission.objects.get())
+        content, last_id = self._poll()
+        self.assertNotIn("event:", content)
+
+        live.publish_solve(models.Submission.objects.get())
+        content, last_id = self._poll(last_id)
+        events = content.split("\n\n")
+        solve = next(e for e in events if "event: solve" in e)
+        self.assertTrue(json.loads(solve.split("data: ")[1])['first_blood'])
+        self.assertIn("event: scoreboard", content)
+
+        content, _ = self._poll(last_id)
+        self.assertNotIn("event:", content)
+        # Clients that missed events get them
+        content, _ = self._poll("0")
+        self.assertIn("event: solve", content)
+
+    def test_stream_needs_membership(self):
+        url = reverse('wui_course_live', args=[self.course.name])
+        self.course.participants.remove(self.user)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+
+class FlagTest(CourseTestCase):
+    def test_flag_change_and_regrade(self):
+        self._add_problems(2)
+        models.Score.rebuild(self.course)
+        self.assertEqual(
+            [c for c, _ in flags.verify_many([
+                (self.course.pk, "problem0", "problem0"),
+                (self.course.pk, "problem1", "wrong"),
+                (self.course.pk, "missing", "problem0"),
+            ])],
+            [True, False, False]
+        )
+
+        problem = Problem.objects.get(slug="problem1")
+        problem.assign_flag("fixed")
+        problem.save()
+        self.assertFalse(flags.verify(self.course.pk, "problem1", "problem1")[0])
+        self.assertTrue(flags.verify(self.course.pk, "problem1", "fixed")[0])
+
+        self.assertEqual(flags.regrade(self.course), 1)
+        self.assertFalse(
+            models.Submission.objects.get(flag="problem1").correct
+        )
+        self.assertEqual(models.Score.objects.get(user=self.user).points, 0)
+
+
+@override_settings(SUBMISSION_BATCH_SIZE=1, SUBMISSION_BURST=3)
+class SubmissionTest(CourseTestCase):
+    def _submit(self, flag, slug="problem0"):
+        return self.client.post(
+            reverse('wui_course_submit', args=[self.course.name]),
+            {'problem_slug': slug, 'flag': flag}
+        )
+
+    def test_submissions_are_limited(self):
+        self._add_problems(1)
+        models.Submission.objects.all().delete()
+
+        response = self._submit("wrong")
+        self.assertEqual(response.json()['status'], submissions.INCORRECT)
+        self.assertEqual(
+            self._submit("wrong").json()['status'], submissions.DUPLICATE
+        )
+        self.assertEqual(models.Submission.objects.count(), 1)
+
+        self.assertEqual(
+            self._submit("problem0").json()['status'], submissions.CORRECT
+        )
+        response = self._submit("again")
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json()['status'], submissions.RATE_LIMITED)
+        self.assertIn('Retry-After', response)
+        self.assertEqual(models.Score.objects.get(user=self.user).solves, 1)
+
+    @override_settings(SUBMISSION_BATCH_SIZE=10)
+    def test_wrong_submissions_are_spooled(self):
+        self._add_problems(1)
+        models.Submission.objects.all().delete()
+        self._submit("wrong")
+        self.assertEqual(models.Submission.objects.count(), 0)
+        self.assertEqual(submissions.batch.flush(), 1)
+        self.assertEqual(models.Submission.objects.count(), 1)
+
+        # Left by a killed process
+        spool_path = os.path.join(settings.SUBMISSION_SPOOL_PATH,
+                                  "host-1" + submissions.SPOOL_SUFFIX)
+        with open(spool_path, "w") as f:
+            f.write(json.dumps({
+                'flag': "lost", 'user_id': self.user.pk,
+                'problem_id': models.CourseProblems.objects.get().pk
+            }) + "\n")
+        self.assertEqual(submissions.batch.flush(), 1)
+        self.assertFalse(os.path.exists(spool_path))
+        self.assertTrue(
+            models.Submission.objects.filter(flag="lost").exists()
+        )
+
+    def test_unknown_problem(self):
+        self.assertEqual(self._submit("flag", slug="missing").status_code, 404)
+
+
+@override_settings(DOWNLOAD_BACKEND='direct')
+class DownloadTest(SimpleTestCase):
+    def setUp(self):
+        fd, self.file_path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b"0123456789")
+        self.addCleanup(os.remove, self.file_path)
+
+    def _get(self, **headers):
+        response = downloads.serve(
+            RequestFactory().get('/', **headers), self.file_path, "file"
+        )
+        return response, b"".join(response)
+
+    def test_ranges(self):
+        response, content = self._get()
+        self.assertEqual(content, b"0123456789")
+        response, content = self._get(HTTP_RANGE="bytes=2-4")
+        self.assertEqual((response.status_code, content), (206, b"234"))
+        self.assertEqual(response['Content-Range'], "bytes 2-4/10")
+        response, content = self._get(HTTP_RANGE="bytes=-3")
+        self.assertEqual(content, b"789")
+        response, _ = self._get(HTTP_RANGE="bytes=20-")
+        self.assertEqual(response.status_code, 416)
+        response, content = self._get(HTTP_RANGE="bytes=2-4",
+                                      HTTP_IF_RANGE='"outdated"')
+        self.assertEqual((response.status_code, content),
+                         (200, b"0123456789"))
+
+    def test_conditional_get(self):
+        response, _ = self._get()
+        response, content = self._get(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual((response.status_code, content), (304, b""))
+
+    @override_settings(DOWNLOAD_BACKEND='x-accel-redirect',
+                       DOWNLOAD_ACCEL_PREFIX='/protected/')
+    def test_x_accel_redirect(self):
+        with override_settings(
+                DOWNLOAD_ACCEL_ROOT=os.path.dirname(self.file_path)):
+            response, content = self._get()
+        self.assertEqual(content, b"")
+        self.assertEqual(response['X-Accel-Redirect'],
+                         "/protected/" + os.path.basename(self.file_path))
+
+    @override_settings(DOWNLOAD_BACKEND='x-accel-redirect',
+                       DOWNLOAD_ACCEL_PREFIX='/protected/')
+    def test_x_accel_redirect_gzip(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        file_path = os.path.join(root, "files", "file")
+        gzip_path = os.path.join(root, "compressed", "file.gz")
+        for path in (file_path, gzip_path):
+            os.mkdir(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(b"0123456789")
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING="gzip")
+        with override_settings(DOWNLOAD_ACCEL_ROOT=root):
+            response = downloads.serve(request, file_path, "file",
+                                       gzip_path=gzip_path)
+        self.assertEqual(response['X-Accel-Redirect'],
+                         "/protected/compressed/file.gz")
+        self.assertEqual(response['Content-Encoding'], "gzip")
+        # Copies outside of the root are not sent
+        with override_settings(DOWNLOAD_ACCEL_ROOT=os.path.dirname(file_path)):
+            response = downloads.serve(request, file_path, "file",
+                                       gzip_path=gzip_path)
+        self.assertEqual(response['X-Accel-Redirect'], "/protected/file")
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    def test_accepts_gzip(self):
+        for header, accepted in [
+            ("gzip", True),
+            ("deflate, GZIP;q=0.5", True),
+            ("br;q=1.0, *;q=0.1", True),
+            ("gzip;q=0", False),
+            ("gzip; q=0.000, *", False),
+            ("x-gzip-foo, nogzip", False),
+            ("gzip;q=abc", False),
+            ("", False),
+        ]:
+            request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=header)
+            self.assertEqual(downloads.accepts_gzip(request), accepted, header)
+
+
+class DownloadBundleTest(CourseTestCase):
+    def test_bundle(self):
+        self._add_problems(2)
+        deployment_path = tempfile.mkdtemp()
+        with override_settings(VAGR_DEPLOYMENT_PATH=deployment_path):
+            for problem in Problem.objects.all():
+                file_path = problem.get_vagrant().normalize_dl_path(
+                    "file.txt", absolut=True
+                )
+                os.makedirs(os.path.dirname(file_path))
+                with open(file_path, "w") as f:
+                    f.write(problem.slug)
+                problem.assign_downloads({"file": "file.txt"})
+
+            url = reverse('wui_course_download_bundle',
+                          args=[self.course.name])
+            response = self.client.get(url)
+            content = b"".join(response.streaming_content)
+            self.assertEqual(int(response['Content-Length']), len(content))
+            bundle = zipfile.ZipFile(io.BytesIO(content))
+            self.assertEqual(
+                sorted(bundle.read(name) for name in bundle.namelist()),
+                [b"problem0", b"problem1"]
+            )
+
+            response = self.client.get(url, {'category': 'cat1'})
+            bundle = zipfile.ZipFile(
+                io.BytesIO(b"".join(response.streaming_content))
+            )
+            self.assertEqual(len(bundle.namelist()), 1)
+
+            self.course.participants.remove(self.user)
+            self.assertEqual(self.client.get(url).status_code, 404)
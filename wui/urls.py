@@ -37,8 +37,12 @@ urlpatterns = [
             url(r'^join_pw/$', views.course_join_pw, name='wui_course_join_pw'),
             url(r'^leave/$', views.course_leave, name='wui_course_leave'),
             url(r'^problems/$', views.course_problems, name='wui_course_problems'),
+            url(r'^submit/$', views.course_submit, name='wui_course_submit'),
+            url(r'^downloads/$', views.course_download_bundle, name='wui_course_download_bundle'),
+            url(r'^instance/(?P<problem_slug>[\w.,-]+)/$', views.course_instance, name='wui_course_instance'),
             url(r'^problem_writeup/(?P<problem_slug>[\w.,-]+)/$', views.writeup, name='wui_course_problem_writeup'),
             url(r'^scoreboard/$', views.course_scoreboard, name='wui_course_scoreboard'),
+            url(r'^live/$', views.course_live, name='wui_course_live'),
             url(r'^manage_problems/$', views.course_manage_problems, name='wui_course_manage_problems'),
             url(r'^manage_points/$', views.course_manage_points, name='wui_points_to_problems'),
             url(r'^writeups/$', views.course_writeups, name='wui_course_writeups'),
@@ -13,32 +13,56 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
-from http.client import NOT_FOUND as HTTP_NOT_FOUND
+import math
+import os
+from http.client import (
+    BAD_REQUEST as HTTP_BAD_REQUEST,
+    FORBIDDEN as HTTP_FORBIDDEN,
+    NOT_FOUND as HTTP_NOT_FOUND,
+    REQUEST_ENTITY_TOO_LARGE as HTTP_REQUEST_ENTITY_TOO_LARGE,
+    TOO_MANY_REQUESTS as HTTP_TOO_MANY_REQUESTS,
+)
 from os import path
-from wsgiref.util import FileWrapper
+from stat import S_ISREG
 import markdown
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required, permission_required
-from django.db import IntegrityError
+from django.core.cache import cache
+from django.db import transaction
 from django.db.models import (
-    Sum,
-    Max,
-    Case,
-    When,
-    F,
-    Value,
-    IntegerField,
+    Count,
+    Exists,
+    OuterRef,
+    prefetch_related_objects,
     Q
 )
-from django.http import HttpResponse
+from django.http import (
+    HttpResponse,
+    HttpResponseForbidden,
+    HttpResponseNotAllowed,
+    JsonResponse,
+    StreamingHttpResponse
+)
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.text import slugify
 from django.utils.translation import ugettext_lazy as _
 
+from uptomate.Deployment import VAGRANT_STOPPED_STATES
+from vmmanage import instances
 from vmmanage import views as vm_views
-from vmmanage.models import Download
+from vmmanage.models import (
+    Download,
+    Problem,
+    VirtualMachine
+)
+from . import bundles
+from . import downloads
+from . import live
 from . import models
+from . import submissions
 from .forms import (
     UserForm,
     CourseForm,
@@ -57,7 +81,16 @@ MESSAGES = {
     'deleted': _("You deleted the course"),
     'left': _("You left the course"),
     'join_first': _("Join the course first"),
-    'problem_not_ready': _("The problem has not been initialized yet")
+    'problem_not_ready': _("The problem has not been initialized yet"),
+    'instance_missing': _("Start your own instance of the problem to solve it"),
+    'instance_queued': _("Your instance is queued, it starts as soon as "
+                         "another one stops")
+}
+SUBMISSION_MESSAGES = {
+    submissions.CORRECT: _("Flag was correct!"),
+    submissions.INCORRECT: _("Flag was incorrect!"),
+    submissions.DUPLICATE: _("You already tried that..."),
+    submissions.RATE_LIMITED: _("Too many tries, wait a moment"),
 }
 
 
@@ -105,14 +138,29 @@ def course_edit(request, course_slug=None):
                                                        'form': form})
 
 
-# TODO: make in one query
 @login_required()
 def courses(request):
+    """
+    Lists all courses. The table is cached per course list version and
+    the courses of the user, so participants of the same courses share
+    it. The courses are only queried when the table is rendered.
+    """
+    user_courses = request.user.course_set.order_by('pk').values_list(
+        'pk', flat=True
+    )
+    member = models.Course.participants.through.objects.filter(
+        course=OuterRef('pk'), user=request.user
+    )
     return render(request, 'courses/list.html', {
         'headline': _('Courses'),
-        'courses': models.Course.objects.all(),
+        'courses': models.Course.objects.select_related('teacher').annotate(
+            joined=Exists(member)
+        ),
         'message': MESSAGES.get(request.GET.get('m', ''), 'Invalid message'),
-        'user_courses': request.user.course_set.all()
+        'can_manage': request.user.has_perm('can_manage_course'),
+        'list_version': models.Course.list_cache_version(),
+        'user_courses': ",".join(str(pk) for pk in user_courses),
+        'cache_ttl': settings.COURSES_CACHE_TTL
     })
 
 
@@ -191,38 +239,140 @@ def course_leave(request, course_slug):
     return redirect(reverse('wui_courses') + "?m=left")
 
 
+def _render_descs(problems):
+    """
+    Renders the descriptions of problems as HTML. Rendered
+    descriptions are cached until the problem or its VM changes.
+    :param problems: list of Problems
+    :return: dict of problem pk -> HTML
+    """
+    keys = Problem.desc_cache_keys(problems)
+    cached = cache.get_many(keys.values())
+    missing = [p for p in problems if keys[p.pk] not in cached]
+    # Only what parse_desc() needs for uncached descriptions
+    prefetch_related_objects(
+        missing,
+        'download_set',
+        'virtualmachine_set__port_set'
+    )
+
+    rendered = {}
+    new = {}
+    for problem in problems:
+        key = keys[problem.pk]
+        if key not in cached:
+            desc = problem.parse_desc()
+            if desc is None:
+                # Not cached, the VM gets ready soon
+                rendered[problem.pk] = markdown.markdown(
+                    str(MESSAGES['problem_not_ready'])
+                )
+                continue
+            new[key] = cached[key] = markdown.markdown(desc)
+        rendered[problem.pk] = cached[key]
+    cache.set_many(new, settings.DESC_CACHE_TTL)
+    return rendered
+
+
+def _render_instance_descs(problems, user):
+    """
+    Renders the descriptions of problems with an instance per user,
+    showing the address of the instance of user. These are not cached.
+    :return: dict of problem pk -> (HTML, instance or None)
+    """
+    if not problems:
+        return {}
+    vms = {
+        vm.problem_id: vm for vm in VirtualMachine.objects.filter(
+            problem__in=problems, owner=user
+        ).prefetch_related('port_set')
+    }
+    # Keeps the instances from being reaped while they are looked at
+    instances.touch(vms.values())
+
+    rendered = {}
+    for problem in problems:
+        vm = vms.get(problem.pk)
+        if vm is None:
+            desc, msg = None, 'instance_missing'
+        elif vm.queued is not None:
+            desc, msg = None, 'instance_queued'
+        else:
+            desc, msg = problem.parse_desc(vm), 'problem_not_ready'
+        rendered[problem.pk] = (
+            markdown.markdown(desc if desc is not None else str(MESSAGES[msg])),
+            vm
+        )
+    return rendered
+
+
 def _course_problem_dict(course, user):
+    """
+    Collects the problems of a course, in a fixed number of queries.
+    :return: problems by category, total points and points of the user
+    """
     categories = {}
     total_points = 0
-    for course_prob in models.CourseProblems.objects.filter(course=course):
+    user_points = 0
+    course_probs = list(
+        models.CourseProblems.objects.filter(
+            course=course
+        ).select_related(
+            'problem'
+        ).prefetch_related(
+            'problem__download_set'
+        ).annotate(
+            solved_count=Count('submission', filter=Q(submission__correct=True)),
+            solved=Exists(
+                models.Submission.objects.filter(
+                    problem=OuterRef('pk'),
+                    user=user,
+                    correct=True
+                )
+            )
+        )
+    )
+    descs = _render_descs(
+        [cp.problem for cp in course_probs if not cp.problem.instance_per_user]
+    )
+    instance_descs = _render_instance_descs(
+        [cp.problem for cp in course_probs if cp.problem.instance_per_user],
+        user
+    )
+    for course_prob in course_probs:
         category = course_prob.problem.category.capitalize()
         problems = categories.get(category, [])
 
+        desc, instance = instance_descs.get(
+            course_prob.problem.pk,
+            (descs.get(course_prob.problem.pk), None)
+        )
         problems.append({
             'title': course_prob.problem.name,
             'slug': course_prob.problem.slug,
             'points': course_prob.points,
-            'desc': markdown.markdown(course_prob.problem.parse_desc() or
-                        MESSAGES['problem_not_ready']),
+            'desc': desc,
+            'instance_startable': course_prob.problem.instance_per_user and (
+                instance is None or
+                instance.current_state in VAGRANT_STOPPED_STATES
+            ),
+            'downloads': course_prob.problem.download_set.all(),
             'form': SubmissionForm(initial={
                 'problem_slug': course_prob.problem.slug}
             ),
-            'solved_count': course_prob.submission_set.filter(
-                correct=True
-            ).count(),
-            'solved': course_prob.submission_set.filter(
-                user=user,
-                correct=True,
-            ).exists()
+            'solved_count': course_prob.solved_count,
+            'solved': course_prob.solved
         })
 
         total_points += course_prob.points
+        if course_prob.solved:
+            user_points += course_prob.points
         # In case new list was created
         categories[category] = problems
-    return categories, total_points
+    return categories, total_points, user_points
 
 
-# TODO: put in fewer queries and split view
+# TODO: split view
 @login_required()
 def course_problems(request, course_slug):
     course = get_object_or_404(models.Course, name=course_slug)
@@ -242,48 +392,33 @@ def course_problems(request, course_slug):
         else:
             form = SubmissionForm(request.POST)
             if form.is_valid():
-                flag_correct, course_problem =\
-                    models.CourseProblems.check_problem_flag(
-                        course,
-                        form.cleaned_data['problem_slug'],
-                        form.cleaned_data['flag']
-                    )
-                try:
-                    models.Submission.objects.create(
-                        flag=form.cleaned_data['flag'],
-                        problem=course_problem,
-                        correct=flag_correct,
-                        user=request.user
-                    )
-                    if flag_correct and course.writeups:
-                        return redirect(
-                            reverse(
-                                'wui_course_problem_writeup',
-                                kwargs={
-                                    'course_slug': course_slug,
-                                    'problem_slug': course_problem.problem.slug
-                                }
-                            )
+                result = submissions.submit(
+                    request.user,
+                    course,
+                    form.cleaned_data['problem_slug'],
+                    form.cleaned_data['flag']
+                )
+                if result.status == submissions.CORRECT and course.writeups:
+                    return redirect(
+                        reverse(
+                            'wui_course_problem_writeup',
+                            kwargs={
+                                'course_slug': course_slug,
+                                'problem_slug':
+                                    form.cleaned_data['problem_slug']
+                            }
                         )
-                except IntegrityError:
-                    errors.append(_("You already tried that..."))
+                    )
 
-                if flag_correct:
-                    success.append(_("Flag was correct!"))
+                if result.status == submissions.CORRECT:
+                    success.append(SUBMISSION_MESSAGES[result.status])
                 else:
-                    errors.append(_("Flag was incorrect!"))
+                    errors.append(SUBMISSION_MESSAGES[result.status])
             else:
                 errors.append(_("Form was invalid"))
 
-    categories, total_points = _course_problem_dict(course, request.user)
-    user_points = sum(
-        [
-            sub.problem.points for sub in models.Submission.objects.filter(
-                user=request.user,
-                correct=True,
-                problem__course=course
-            )
-        ]
+    categories, total_points, user_points = _course_problem_dict(
+        course, request.user
     )
 
     return render(
@@ -303,44 +438,121 @@ def course_problems(request, course_slug):
 
 
 @login_required()
-def course_scoreboard(request, course_slug):
+def course_instance(request, course_slug, problem_slug):
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
     course = get_object_or_404(models.Course, name=course_slug)
+    if not course.has_user(request.user):
+        return redirect(reverse('wui_courses') + "?m=join_first")
+    if course.has_ended or (not course.has_begun and
+                            course.teacher != request.user):
+        return HttpResponseForbidden()
+    course_prob = get_object_or_404(
+        models.CourseProblems.objects.select_related('problem'),
+        course=course,
+        problem__slug=problem_slug,
+        problem__instance_per_user=True
+    )
+    instances.request_instance(course_prob.problem, request.user)
+    return redirect(
+        reverse('wui_course_problems', kwargs={'course_slug': course_slug}) +
+        "?slug=" + problem_slug
+    )
 
-    # Create list with user and points
-    user_points = course.participants.values(
-        'username',
-        'last_name'
-    ).annotate(
-        point_sum=Sum(
-            Case(
-                When(
-                    Q(submission__correct=True) & Q(submission__problem__course__name=course_slug),
-                    then=F('submission__problem__points'),
-                ),
-                default=Value(0),
-                output_field=IntegerField()
-            )
+
+@login_required()
+def course_submit(request, course_slug):
+    """
+    Takes a flag submission and answers with a small JSON result,
+    used by the problem page instead of posting the whole page.
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    course = get_object_or_404(models.Course, name=course_slug)
+    if not course.has_user(request.user):
+        return JsonResponse(
+            {'status': 'forbidden', 'message': str(MESSAGES['join_first'])},
+            status=HTTP_FORBIDDEN
         )
-    ).annotate(
-        newest_submission=Max('submission__creation_time')
-    ).exclude(
-        username__exact=course.teacher.username
-    ).order_by(
-        '-point_sum',
-        'newest_submission'
-    )
+    if course.has_ended or (not course.has_begun and
+                            course.teacher_id != request.user.pk):
+        return JsonResponse(
+            {'status': 'closed', 'message': str(_("The course is over."))},
+            status=HTTP_FORBIDDEN
+        )
+
+    form = SubmissionForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse(
+            {'status': 'invalid', 'message': str(_("Form was invalid"))},
+            status=HTTP_BAD_REQUEST
+        )
+    try:
+        result = submissions.submit(
+            request.user,
+            course,
+            form.cleaned_data['problem_slug'],
+            form.cleaned_data['flag']
+        )
+    except models.CourseProblems.DoesNotExist:
+        return JsonResponse(
+            {'status': 'invalid', 'message': str(_("Form was invalid"))},
+            status=HTTP_NOT_FOUND
+        )
+
+    data = {
+        'status': result.status,
+        'message': str(SUBMISSION_MESSAGES[result.status]),
+    }
+    if result.status == submissions.CORRECT and course.writeups:
+        data['writeup'] = reverse(
+            'wui_course_problem_writeup',
+            kwargs={
+                'course_slug': course_slug,
+                'problem_slug': form.cleaned_data['problem_slug']
+            }
+        )
+    if result.status == submissions.RATE_LIMITED:
+        response = JsonResponse(data, status=HTTP_TOO_MANY_REQUESTS)
+        response['Retry-After'] = math.ceil(result.retry_after)
+        return response
+    return JsonResponse(data)
+
+
+@login_required()
+def course_scoreboard(request, course_slug):
+    course = get_object_or_404(models.Course, name=course_slug)
 
     return render(
         request,
         'courses/scoreboard.html',
         {
             'course': course,
-            'user_points': enumerate(user_points, 1),
+            'user_points': enumerate(models.Score.ranking(course), 1),
             'page': 'scoreboard'
         }
     )
 
 
+@login_required()
+def course_live(request, course_slug):
+    """
+    Event stream of new solves and the ranking of a course. It ends
+    right away, browsers poll it, see live.poll().
+    """
+    course = get_object_or_404(models.Course, name=course_slug)
+    if course.teacher_id != request.user.pk and \
+            not course.has_user(request.user):
+        return HttpResponseForbidden()
+
+    response = HttpResponse(
+        live.poll(course.pk, request.META.get('HTTP_LAST_EVENT_ID')),
+        content_type='text/event-stream'
+    )
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
 @permission_required('can_manage_course')
 def course_manage_problems(request, course_slug):
     course = get_object_or_404(models.Course, name=course_slug)
@@ -355,20 +567,19 @@ def course_manage_problems(request, course_slug):
             ).exclude(problem__in=new_problems)
 
             problems = [c.problem for c in removed_cprobs]
-            removed_cprobs.delete()
+            with transaction.atomic():
+                # Deletes the submissions of removed problems as well
+                removed_cprobs.delete()
+                for problem in new_problems:
+                    models.CourseProblems.objects.update_or_create(
+                        course=course, problem=problem, defaults={'points': problem.default_points}
+                    )
+                models.Score.rebuild(course)
             vm_views.stop_unused_problems(problems)
 
-            for problem in new_problems:
-                models.CourseProblems.objects.update_or_create(
-                    course=course, problem=problem, defaults={'points': problem.default_points}
-                )
-
-            new_problem_vms = []
-            for p in new_problems:
-                if p.vm:
-                    new_problem_vms.append(p.vm)
-
-            vm_views.start_used_vms(new_problem_vms)
+            vm_views.start_used_vms(
+                VirtualMachine.objects.filter(problem__in=new_problems)
+            )
             return redirect(reverse('wui_points_to_problems',
                                     kwargs={'course_slug': course_slug}))
         else:
@@ -388,32 +599,33 @@ def course_manage_problems(request, course_slug):
 @permission_required('can_manage_course')
 def course_manage_points(request, course_slug):
     course = get_object_or_404(models.Course, name=course_slug)
-    problems = models.CourseProblems.objects.filter(course=course)
-    cp_forms = []
+    problems = models.CourseProblems.objects.filter(
+        course=course
+    ).select_related('problem')
 
     if request.POST:
-        for prob in problems:
-            form = PointToProbForm(request.POST, prefix=prob.problem.slug)
-            cp_forms.append(form)
-            if form.is_valid():
-                models.CourseProblems.objects.filter(
-                    course=course,
-                    problem=prob.problem
-                ).update(
-                    points=form.cleaned_data['points']
-                )
-            else:
-                break
-        else:
+        cp_forms = [
+            PointToProbForm(request.POST, prefix=cp.problem.slug)
+            for cp in problems
+        ]
+        if all(form.is_valid() for form in cp_forms):
+            with transaction.atomic():
+                for cp, form in zip(problems, cp_forms):
+                    models.CourseProblems.objects.filter(
+                        pk=cp.pk
+                    ).update(
+                        points=form.cleaned_data['points']
+                    )
+                models.Score.rebuild(course)
             return redirect(reverse('wui_courses'))
     else:
-        for cp in problems:
-            cp_forms.append(
-                PointToProbForm(
-                    prefix=cp.problem.slug,
-                    initial={'points': cp.points}
-                )
+        cp_forms = [
+            PointToProbForm(
+                prefix=cp.problem.slug,
+                initial={'points': cp.points}
             )
+            for cp in problems
+        ]
 
     return render(
         request,
@@ -529,32 +741,95 @@ def show_writeup(request, course_slug, problem_name, user_name):
     )
 
 
-def _download_wrapped_file(download):
+def _download_wrapped_file(request, download):
     download_path = download.abspath
+    try:
+        stat = os.lstat(download_path)
+    except OSError:
+        stat = None
     # We do not allow symlinks as downloads for security reasons
-    if not path.exists(download_path) or path.islink(download_path):
+    if stat is None or not S_ISREG(stat.st_mode):
         return HttpResponse("Download not found", status=HTTP_NOT_FOUND)
-    wrapper = FileWrapper(open(download_path, "rb"))
-    response = HttpResponse(wrapper, content_type='application/force-download')
-    response['Content-Disposition'] = 'attachment; filename="{}"'.format(
+
+    extras = {}
+    if download.matches_manifest(stat):
+        extras = {'sha256': download.sha256, 'gzip_path': download.gzip_path}
+    return downloads.serve(
+        request,
+        download_path,
         DOWNLOAD_FNAME_TEMLATE.format(
             filename=path.basename(download_path),
             download_pk=download.pk,
             problem_slug=download.problem.slug
+        ),
+        stat=stat,
+        **extras
+    )
+
+
+@login_required()
+def course_download_bundle(request, course_slug):
+    """
+    All downloads of a course, or of one category with ?category=,
+    as one zip archive.
+    """
+    course = get_object_or_404(models.Course, name=course_slug)
+    if not course.has_user(request.user):
+        return HttpResponse("Not Found", status=HTTP_NOT_FOUND)
+
+    course_downloads = Download.objects.filter(
+        problem__course=course
+    ).select_related('problem').order_by('problem__slug', 'slug')
+    category = request.GET.get('category', '')
+    if category:
+        course_downloads = course_downloads.filter(
+            problem__category__iexact=category
         )
+
+    entries = []
+    for download in course_downloads:
+        download_path = download.abspath
+        try:
+            stat = os.lstat(download_path)
+        except OSError:
+            continue
+        # We do not allow symlinks as downloads for security reasons
+        if S_ISREG(stat.st_mode):
+            entries.append((
+                DOWNLOAD_FNAME_TEMLATE.format(
+                    filename=path.basename(download_path),
+                    download_pk=download.pk,
+                    problem_slug=download.problem.slug
+                ),
+                download_path,
+                stat
+            ))
+
+    try:
+        bundle = bundles.ZipStream(entries)
+    except bundles.BundleTooBig:
+        return HttpResponse(
+            _("Too big for one archive, download the files one by one"),
+            status=HTTP_REQUEST_ENTITY_TOO_LARGE
+        )
+    response = StreamingHttpResponse(bundle, content_type='application/zip')
+    response['Content-Length'] = bundle.size
+    response['Content-Disposition'] = 'attachment; filename="{}.zip"'.format(
+        "_".join(filter(None, [course.name, slugify(category)]))
     )
-    response['Content-Length'] = path.getsize(download_path)
     return response
 
 
 @login_required()
 def download_file(request, download_id):
-    download = get_object_or_404(Download, pk=download_id)
+    download = get_object_or_404(
+        Download.objects.select_related('problem'), pk=download_id
+    )
 
     if download.problem.course_set.filter(
             participants__pk=request.user.pk
     ).exists():
-            return _download_wrapped_file(download)
+            return _download_wrapped_file(request, download)
 
     return HttpResponse(
         "Not Found", status=HTTP_NOT_FOUND